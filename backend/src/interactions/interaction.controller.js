@@ -1,6 +1,6 @@
 const mongoose = require('mongoose');
 const Interaction = require('./interaction.model');
-const { triggerRecommendationRebuild } = require('../recommendations/recommendation.update');
+const { triggerRecommendationRebuild, publishRecommendationEvent } = require('../recommendations/recommendation.update');
 
 // track view counts per user to trigger recommendations after multiple views
 const viewCounts = new Map();
@@ -61,9 +61,9 @@ const logInteraction = async (req, res) => {
 
         await interaction.save();
 
-        if (interactionType.toLowerCase() === 'view') {
-            checkAndTriggerForViews(userId);
-        }
+        // a delivered event rescores the user; views only count towards a rebuild when it was not
+        const onFailure = interactionType.toLowerCase() === 'view' ? () => checkAndTriggerForViews(userId) : undefined;
+        setImmediate(() => publishRecommendationEvent({ userId, bookId, interactionType }, onFailure));
 
         res.status(201).json({ success: true, message: 'Interaction logged' });
     } catch (error) {
@@ -1,7 +1,20 @@
 const mongoose = require("mongoose");
 const Order = require("./order.model");
 const Book = require("../books/book.model");
-const { triggerRecommendationRebuild } = require("../recommendations/recommendation.update");
+const {
+  triggerRecommendationRebuild,
+  publishRecommendationEvent
+} = require("../recommendations/recommendation.update");
+
+const buildOrderEvent = (order) => ({
+  userId: order.userId.toString(),
+  interactionType: "order",
+  products: (order.products || []).map((product) => ({
+    productId: (product.productId && product.productId._id ? product.productId._id : product.productId).toString(),
+    quantity: product.quantity,
+    price: product.price
+  }))
+});
 
 const createAOrder = async (req, res) => {
   try {
@@ -88,8 +101,11 @@ const updateOrderStatus = async (req, res) => {
     const updated = await order.save();
     await updated.populate('products.productId', 'title');
     
-    if (isNowCompleted) {
-        setImmediate(() => triggerRecommendationRebuild("order-completed"));
+    if (!wasCompleted && isNowCompleted) {
+        setImmediate(() => publishRecommendationEvent(
+          buildOrderEvent(updated),
+          () => triggerRecommendationRebuild("order-completed")
+        ));
     }
     
     res.status(200).json(updated);
@@ -141,7 +157,10 @@ const confirmOrderReceipt = async (req, res) => {
 
     // trigger recommendation rebuild when order is completed via buyer confirmation
     if (!wasCompleted && updated.completed) {
-      setImmediate(() => triggerRecommendationRebuild("order-completed"));
+      setImmediate(() => publishRecommendationEvent(
+        buildOrderEvent(updated),
+        () => triggerRecommendationRebuild("order-completed")
+      ));
     }
 
     return res.status(200).json(updated);
@@ -10,6 +10,8 @@ const pipelineEnabled = process.env.DISABLE_AUTO_RECOMMENDATIONS !== "true";
 const DEFAULT_SERVICE_URL = process.env.RECOMMENDATION_SERVICE_URL || "http://localhost:8000";
 const REBUILD_ENDPOINT =
     process.env.RECOMMENDATION_REBUILD_ENDPOINT || "/api/recommendations/build";
+const EVENTS_ENDPOINT = process.env.RECOMMENDATION_EVENTS_ENDPOINT || "/api/events";
+const eventsEnabled = pipelineEnabled && process.env.DISABLE_RECOMMENDATION_EVENTS !== "true";
 
 const buildRequestBody = () => {
     const parseNumber = (value, fallback) => {
@@ -23,6 +25,7 @@ const buildRequestBody = () => {
         cf_weight: parseNumber(process.env.RECOMMENDATION_CF_WEIGHT, 0.6),
         cb_weight: parseNumber(process.env.RECOMMENDATION_CB_WEIGHT, 0.4),
         report: truthy(process.env.RECOMMENDATION_FORCE_REPORT),
+        mode: process.env.RECOMMENDATION_BUILD_MODE || "incremental",
     };
 };
 
@@ -67,7 +70,17 @@ const callRecommendationService = (reason) => {
         });
         res.on("end", () => {
             jobInFlight = false;
-            if (res.statusCode >= 200 && res.statusCode < 300) {
+            if (res.statusCode === 202) {
+                let jobId = "unknown";
+                try {
+                    jobId = JSON.parse(data).jobId || jobId;
+                } catch (error) {
+                    // keep the default id, the rebuild was still accepted
+                }
+                console.info(
+                    `[recommendations] Recommendation rebuild queued as job ${jobId}.`
+                );
+            } else if (res.statusCode >= 200 && res.statusCode < 300) {
                 console.info(
                     `[recommendations] Recommendation rebuild succeeded with status ${res.statusCode}.`
                 );
@@ -134,7 +147,81 @@ const triggerRecommendationRebuild = (reason = "manual-trigger") => {
     setImmediate(() => launchJob(reason));
 };
 
+// fire-and-forget: the service folds the event into the next micro-batch, the stored
+// document stays the source of truth if the call is lost. onFailure runs at most once, when
+// the event could not be delivered, so callers can fall back to a rebuild.
+const publishRecommendationEvent = (event, onFailure) => {
+    if (!event) {
+        return;
+    }
+    let failed = false;
+    const fail = () => {
+        if (!failed && onFailure) {
+            failed = true;
+            onFailure();
+        }
+    };
+    if (!eventsEnabled) {
+        fail();
+        return;
+    }
+    let serviceUrl;
+    try {
+        serviceUrl = new URL(EVENTS_ENDPOINT, DEFAULT_SERVICE_URL);
+    } catch (error) {
+        console.error(
+            "[recommendations] Invalid RECOMMENDATION_SERVICE_URL or RECOMMENDATION_EVENTS_ENDPOINT",
+            error
+        );
+        fail();
+        return;
+    }
+
+    const isHttps = serviceUrl.protocol === "https:";
+    const client = isHttps ? https : http;
+    const payload = JSON.stringify(event);
+
+    const req = client.request(
+        {
+            method: "POST",
+            hostname: serviceUrl.hostname,
+            port: serviceUrl.port || (isHttps ? 443 : 80),
+            path: serviceUrl.pathname + serviceUrl.search,
+            headers: {
+                "Content-Type": "application/json",
+                "Content-Length": Buffer.byteLength(payload),
+            },
+            timeout: Number(process.env.RECOMMENDATION_EVENT_TIMEOUT || 5000),
+        },
+        (res) => {
+            res.resume();
+            if (res.statusCode === 429) {
+                console.warn("[recommendations] Recommendation event queue full, event dropped.");
+                fail();
+            } else if (res.statusCode >= 300) {
+                console.error(
+                    `[recommendations] Recommendation event rejected with status ${res.statusCode}.`
+                );
+                fail();
+            }
+        }
+    );
+
+    req.on("error", (error) => {
+        console.error("[recommendations] Error publishing recommendation event:", error.message);
+        fail();
+    });
+
+    req.on("timeout", () => {
+        req.destroy(new Error("Request timed out"));
+    });
+
+    req.write(payload);
+    req.end();
+};
+
 module.exports = {
     triggerRecommendationRebuild,
+    publishRecommendationEvent,
 };
 
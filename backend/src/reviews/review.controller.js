@@ -1,7 +1,7 @@
 const mongoose = require('mongoose');
 const Review = require('./review.model');
 const Book = require('../books/book.model');
-const { triggerRecommendationRebuild } = require('../recommendations/recommendation.update');
+const { triggerRecommendationRebuild, publishRecommendationEvent } = require('../recommendations/recommendation.update');
 
 const updateBookRatingAndCount = async (productId) => {
     try {
@@ -62,7 +62,11 @@ const createReview = async (req, res) => {
 
         await newReview.save();        
         await updateBookRatingAndCount(productId);       
-        setImmediate(() => triggerRecommendationRebuild("review-created"));       
+        // only a new review adds a signal; an edited one replaces its rating, which the rebuild picks up
+        setImmediate(() => publishRecommendationEvent(
+            { userId, productId, rating, interactionType: 'review' },
+            () => triggerRecommendationRebuild("review-created")
+        ));
         res.status(201).send({ message: 'Review created successfully', review: newReview });
     } catch (error) {
         console.error('Error creating review', error);
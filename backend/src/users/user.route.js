@@ -4,7 +4,7 @@ const Address = require('../address/address.model');
 const mongoose = require('mongoose');
 const Book = require('../books/book.model');
 const Interaction = require('../interactions/interaction.model');
-const { triggerRecommendationRebuild } = require('../recommendations/recommendation.update');
+const { triggerRecommendationRebuild, publishRecommendationEvent } = require('../recommendations/recommendation.update');
 const upload = require('../middleware/upload');
 const { uploadFile } = require('../utils/uploadToCloud');
 
@@ -263,9 +263,15 @@ router.post("/customers/:email/wishlist", async (req, res) => {
                     interactionType: 'wishlist'
                 });
                 await interaction.save();
-                
-                // trigger recommendation rebuild after wishlist addition
-                setImmediate(() => triggerRecommendationRebuild("wishlist-added"));
+                // the rebuild is only the fallback for an event the service did not take
+                setImmediate(() => publishRecommendationEvent(
+                    {
+                        userId: user._id.toString(),
+                        bookId,
+                        interactionType: 'wishlist'
+                    },
+                    () => triggerRecommendationRebuild("wishlist-added")
+                ));
             } catch (interactionError) {
                 console.error('Failed to log wishlist interaction:', interactionError);
             }
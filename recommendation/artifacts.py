@@ -0,0 +1,355 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from caches import PIPELINE_STATE
+from scoring import (
+    HashingTfidf,
+    TrendingIndex,
+    build_book_matrix,
+    build_popularity_ranking,
+    build_tfidf_vectorizer,
+    prepare_books_dataframe,
+    vectorizer_kind,
+)
+from search import SearchIndex, SearchSegment
+from settings import LOGGER, MODEL_DIR
+from similarity import SimilarityIndex
+from store import BOOK_CONTENT_FIELDS, UserRegistry, fetch_book_references, read_review_columns, stream_collection
+
+MODEL_VERSIONS_KEPT = int(os.getenv("RECOMMENDATION_MODEL_VERSIONS_KEPT", 3))
+CATALOG_CHANGE_THRESHOLD = float(os.getenv("RECOMMENDATION_CATALOG_CHANGE_THRESHOLD", 0.05))
+# how long a failed load (no artifacts, or a catalog that drifted past them) is remembered before trying again
+MODEL_STATE_RETRY = float(os.getenv("RECOMMENDATION_MODEL_STATE_RETRY", 60))
+ARTIFACT_FORMAT = 1
+
+_MODEL_STATE_LOCK = threading.Lock()
+
+
+def book_fingerprint(book):
+    payload = json.dumps([book.get(field) for field in BOOK_CONTENT_FIELDS], default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def _file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_model_artifacts(state, model_dir=MODEL_DIR):
+    created_at = state["fittedAt"]
+    version = created_at.strftime("%Y%m%dT%H%M%S%f")
+    model_dir = Path(model_dir)
+    staging_dir = model_dir / f".{version}.tmp"
+    staging_dir.mkdir(parents=True, exist_ok=True)
+
+    book_matrix = state["book_matrix"]
+    tfidf = state["tfidf"]
+    item_factors_df = state["item_factors_df"]
+    user_factors_df = state["user_factors_df"]
+    arrays = {
+        "book_matrix_data": book_matrix.data,
+        "book_matrix_indices": book_matrix.indices,
+        "book_matrix_indptr": book_matrix.indptr,
+        "tfidf_idf": tfidf.idf_,
+        "item_factors": item_factors_df.to_numpy(dtype=float),
+        "user_factors": user_factors_df.to_numpy(dtype=float),
+    }
+    trending = state.get("trending")
+    if trending is not None:
+        arrays["trending_scores"] = trending.scores
+    similarity_index = state.get("similarity_index")
+    if similarity_index is not None:
+        for kind, (indices, values) in similarity_index.neighbors.items():
+            arrays[f"similar_{kind}_indices"] = indices
+            arrays[f"similar_{kind}_scores"] = values
+    search_index = state.get("search_index")
+    if search_index is not None:
+        search_segment = search_index.compacted()
+        arrays.update({
+            "search_offsets": search_segment.offsets,
+            "search_docs": search_segment.docs,
+            "search_freqs": search_segment.freqs,
+            "search_lengths": search_segment.lengths,
+        })
+    documents = {
+        "books": {
+            "ids": state["books_df"]["bookId"].tolist(),
+            "fingerprints": state["book_fingerprints"],
+            "genreIds": state["books_df"]["genreId"].tolist(),
+            "authorIds": state["books_df"]["authorId"].tolist(),
+        },
+        "factors": {
+            "items": item_factors_df.index.tolist(),
+            "users": user_factors_df.index.tolist(),
+            "columns": item_factors_df.columns.tolist(),
+        },
+    }
+
+    if search_index is not None:
+        documents["search"] = {"ids": search_segment.book_ids, "terms": search_segment.terms}
+    if vectorizer_kind(tfidf) == "tfidf":
+        documents["tfidf_vocabulary"] = {term: int(idx) for term, idx in tfidf.vocabulary_.items()}
+
+    files = {}
+    for name, values in arrays.items():
+        path = staging_dir / f"{name}.npy"
+        np.save(path, np.ascontiguousarray(values))
+        files[path.name] = _file_checksum(path)
+    for name, payload in documents.items():
+        path = staging_dir / f"{name}.json"
+        path.write_text(json.dumps(payload), encoding="utf-8")
+        files[path.name] = _file_checksum(path)
+
+    manifest = {
+        "format": ARTIFACT_FORMAT,
+        "version": version,
+        "createdAt": created_at.isoformat(),
+        "params": list(state["params"]),
+        "strengthRange": list(state["strength_range"]) if state["strength_range"] else None,
+        "bookMatrixShape": list(book_matrix.shape),
+        "vectorizer": vectorizer_kind(tfidf),
+        "collaborative": state.get("cf_model") or {"algorithm": "svd", "generation": 0},
+        "trendingAsOf": trending.as_of.isoformat() if trending is not None else None,
+        "files": files,
+    }
+    (staging_dir / "manifest.json").write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+
+    version_dir = model_dir / version
+    os.replace(staging_dir, version_dir)
+    current_tmp = model_dir / "CURRENT.tmp"
+    current_tmp.write_text(version, encoding="utf-8")
+    os.replace(current_tmp, model_dir / "CURRENT")
+
+    versions = sorted(path for path in model_dir.iterdir() if path.is_dir() and not path.name.startswith("."))
+    for stale_dir in versions[:-MODEL_VERSIONS_KEPT]:
+        shutil.rmtree(stale_dir, ignore_errors=True)
+    LOGGER.info("Saved model artifacts version %s to %s", version, model_dir)
+    return version
+
+
+def load_model_artifacts(model_dir=MODEL_DIR, verify=True):
+    model_dir = Path(model_dir)
+    current_path = model_dir / "CURRENT"
+    if not current_path.exists():
+        return None
+    version_dir = model_dir / current_path.read_text(encoding="utf-8").strip()
+    manifest_path = version_dir / "manifest.json"
+    if not manifest_path.exists():
+        LOGGER.warning("Model artifacts at %s have no manifest; ignoring them", version_dir)
+        return None
+    manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+    if manifest.get("format") != ARTIFACT_FORMAT:
+        LOGGER.warning("Model artifacts at %s use an unsupported format; ignoring them", version_dir)
+        return None
+    if verify:
+        for name, checksum in manifest["files"].items():
+            if _file_checksum(version_dir / name) != checksum:
+                LOGGER.warning("Checksum mismatch for %s in %s; ignoring artifacts", name, version_dir)
+                return None
+
+    def load_array(name):
+        return np.load(version_dir / f"{name}.npy", mmap_mode="r")
+
+    def load_document(name):
+        return json.loads((version_dir / f"{name}.json").read_text(encoding="utf-8"))
+
+    book_matrix = sparse.csr_matrix(
+        (load_array("book_matrix_data"), load_array("book_matrix_indices"), load_array("book_matrix_indptr")),
+        shape=tuple(manifest["bookMatrixShape"]),
+        copy=False
+    )
+    if manifest.get("vectorizer", "tfidf") == "hashing":
+        tfidf = HashingTfidf(n_features=manifest["bookMatrixShape"][1], idf=load_array("tfidf_idf"))
+    else:
+        tfidf = build_tfidf_vectorizer(vocabulary=load_document("tfidf_vocabulary"))
+        tfidf.idf_ = np.asarray(load_array("tfidf_idf"))
+    books = load_document("books")
+    factors = load_document("factors")
+    item_factors_df = pd.DataFrame(
+        load_array("item_factors"),
+        index=factors["items"],
+        columns=factors["columns"],
+        copy=False
+    )
+    user_factors_df = pd.DataFrame(
+        load_array("user_factors"),
+        index=factors["users"],
+        columns=factors["columns"],
+        copy=False
+    )
+    similar = {
+        kind: (load_array(f"similar_{kind}_indices"), load_array(f"similar_{kind}_scores"))
+        for kind in SimilarityIndex.KINDS
+        if f"similar_{kind}_indices.npy" in manifest["files"]
+    }
+    search_index = None
+    if "search.json" in manifest["files"]:
+        search = load_document("search")
+        search_index = SearchIndex([SearchSegment(
+            search["ids"],
+            search["terms"],
+            load_array("search_offsets"),
+            load_array("search_docs"),
+            load_array("search_freqs"),
+            load_array("search_lengths")
+        )])
+    trending = None
+    if "trending_scores.npy" in manifest["files"]:
+        trending = TrendingIndex(
+            books["ids"],
+            load_array("trending_scores"),
+            datetime.fromisoformat(manifest["trendingAsOf"]),
+            books["genreIds"],
+            books["authorIds"]
+        )
+    strength_range = manifest.get("strengthRange")
+    return {
+        "version": manifest["version"],
+        "book_ids": books["ids"],
+        "book_fingerprints": books["fingerprints"],
+        "book_matrix": book_matrix,
+        "tfidf": tfidf,
+        "item_factors_df": item_factors_df if not item_factors_df.empty else pd.DataFrame(),
+        "user_factors_df": user_factors_df if not user_factors_df.empty else pd.DataFrame(),
+        "cf_model": manifest.get("collaborative", {"algorithm": "svd", "generation": 0}),
+        "similarity_index": SimilarityIndex(books["ids"], similar) if similar else None,
+        "search_index": search_index,
+        "trending": trending,
+        "strength_range": tuple(strength_range) if strength_range else None,
+        "params": tuple(manifest["params"]),
+        "fittedAt": datetime.fromisoformat(manifest["createdAt"]),
+    }
+
+
+def sync_catalog(db, state, books_df):
+    previous_ids = state["book_ids"]
+    previous_fingerprints = dict(zip(previous_ids, state["book_fingerprints"]))
+    fingerprints = [book_fingerprint(raw) for raw in books_df["raw"]]
+    current_ids = books_df["bookId"].tolist()
+
+    stale_ids = [
+        book_id
+        for book_id, fingerprint in zip(current_ids, fingerprints)
+        if previous_fingerprints.get(book_id) != fingerprint
+    ]
+    removed_count = len(set(previous_ids) - set(current_ids))
+    drift = (len(stale_ids) + removed_count) / max(len(previous_ids), 1)
+    if drift > CATALOG_CHANGE_THRESHOLD:
+        LOGGER.info("Catalog drift %.1f%% exceeds threshold; model must be refit", drift * 100)
+        return False
+
+    book_matrix = state["book_matrix"]
+    previous_positions = {book_id: position for position, book_id in enumerate(previous_ids)}
+    order = np.array([previous_positions.get(book_id, -1) for book_id in current_ids], dtype=np.int64)
+    stale_df = None
+    if stale_ids:
+        # vectorize new or edited books with the stored vocabulary/idf instead of refitting TF-IDF
+        stale_set = set(stale_ids)
+        stale_books = [raw for raw in books_df["raw"] if str(raw["_id"]) in stale_set]
+        authors, genres = fetch_book_references(db, stale_books)
+        reviews = read_review_columns(stream_collection(db, "review", {"productId": {"$in": stale_ids}}))
+        stale_df = prepare_books_dataframe(stale_books, authors, genres, reviews)
+        stale_matrix, _ = build_book_matrix(stale_df, tfidf=state["tfidf"])
+        # a budgeted build may have kept the matrix in float32
+        stale_matrix = stale_matrix.astype(book_matrix.dtype, copy=False)
+        stale_positions = {book_id: book_matrix.shape[0] + idx for idx, book_id in enumerate(stale_df["bookId"])}
+        order = np.array([
+            stale_positions.get(book_id, position)
+            for book_id, position in zip(current_ids, order)
+        ], dtype=np.int64)
+        book_matrix = sparse.vstack([book_matrix, stale_matrix]).tocsr()
+    if stale_ids or previous_ids != current_ids:
+        book_matrix = book_matrix[order]
+
+    item_factors_df = state["item_factors_df"]
+    if not item_factors_df.empty:
+        # new books have no collaborative signal until the next refit
+        item_factors_df = item_factors_df.reindex(current_ids, fill_value=0.0)
+
+    item_features = item_factors_df.to_numpy(dtype=float) if not item_factors_df.empty else None
+    similarity_index = state.get("similarity_index")
+    if similarity_index is None:
+        similarity_index = SimilarityIndex.build(current_ids, book_matrix, item_features)
+    elif stale_ids or previous_ids != current_ids:
+        similarity_index = similarity_index.refresh(current_ids, book_matrix, item_features, stale_ids)
+
+    search_index = state.get("search_index")
+    if search_index is None:
+        search_index = SearchIndex.build(books_df)
+    elif stale_ids or previous_ids != current_ids:
+        search_index = search_index.refresh(current_ids, stale_df)
+
+    popularity_ids = build_popularity_ranking(books_df)
+    trending = state.get("trending")
+    if trending is not None:
+        trending = trending.realign(books_df, popularity_ids)
+    else:
+        trending = TrendingIndex.build(books_df, popularity_ids)
+
+    # one update() so concurrent online requests never see a half-synced catalog
+    state.update({
+        "books_df": books_df,
+        "book_ids": current_ids,
+        "book_index": pd.Index(current_ids),
+        "book_fingerprints": fingerprints,
+        "book_matrix": book_matrix,
+        "item_factors_df": item_factors_df,
+        "similarity_index": similarity_index,
+        "search_index": search_index,
+        "popularity_ids": popularity_ids,
+        "trending": trending,
+        "book_summaries": None,
+    })
+    return True
+
+
+def load_model_state(db):
+    artifacts = load_model_artifacts()
+    if artifacts is None:
+        return None
+    LOGGER.info("Warm-starting recommendation model from artifacts version %s", artifacts["version"])
+    books = list(stream_collection(db, "book"))
+    authors = list(stream_collection(db, "author"))
+    genres = list(stream_collection(db, "genre"))
+    users = list(stream_collection(db, "user"))
+    books_df = prepare_books_dataframe(books, authors, genres, None)
+    if books_df.empty:
+        return None
+    state = {
+        **artifacts,
+        "books_df": None,
+        "user_registry": UserRegistry(users),
+    }
+    if not sync_catalog(db, state, books_df):
+        return None
+    return state
+
+
+def get_model_state(db):
+    state = PIPELINE_STATE.get("model")
+    if state is not None:
+        return state
+    # one loader at a time: concurrent requests wait for it instead of each reading every collection
+    with _MODEL_STATE_LOCK:
+        state = PIPELINE_STATE.get("model")
+        if state is None and PIPELINE_STATE.get("retry_at", 0.0) <= time.monotonic():
+            state = load_model_state(db)
+            if state is not None:
+                PIPELINE_STATE["model"] = state
+            else:
+                # until a build stores a model, requests fall back without reloading
+                PIPELINE_STATE["retry_at"] = time.monotonic() + MODEL_STATE_RETRY
+    return state
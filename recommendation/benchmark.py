@@ -0,0 +1,788 @@
+"""Benchmark the recommendation pipeline against synthetic BookStore data.
+
+The generator produces book, author, genre, user, interaction, review and order
+documents shaped like the backend's mongoose models, with power-law book
+popularity. Source collections are regenerated deterministically on every
+``find`` so memory stays flat from 1k to 1M users.
+
+    python benchmark.py --users 1000 10000 --output results.json
+    python benchmark.py --users 1000 --compare results.json
+    python benchmark.py --users 20000 --memory-budget 800 --reset-peak-rss
+
+Every run also times a cold ``import recommendation`` in fresh interpreters; the
+service must come up without loading the numerical stack, so a heavy module
+imported at module level counts as a regression.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from bson import ObjectId
+from pymongo import UpdateOne
+
+ID_PREFIXES = {
+    "book": 0x0B,
+    "author": 0x0A,
+    "genre": 0x06,
+    "user": 0x01,
+    "interaction": 0x02,
+    "review": 0x03,
+    "order": 0x04,
+}
+INTERACTION_TYPES = ("view", "wishlist", "rating", "order")
+INTERACTION_TYPE_SHARE = (0.6, 0.2, 0.05, 0.15)
+WORDS = (
+    "magic dragon love war space ship detective murder history king queen robot future past city river "
+    "ocean star empire garden winter summer secret letter island mountain forest night light shadow "
+    "family friend journey storm fire child mother father school doctor science music painter"
+).split()
+GENRES = ("Fantasy", "Science Fiction", "Mystery", "Romance", "History", "Biography", "Thriller", "Poetry")
+GENERATED_AT = datetime(2025, 1, 1, tzinfo=timezone.utc)
+USER_CHUNK = 10000
+# imported lazily by the service; none of them may load with the module
+HEAVY_MODULES = ("numpy", "pandas", "scipy", "sklearn", "tabulate")
+IMPORT_PROBE = (
+    "import json, sys, time\n"
+    "started = time.perf_counter()\n"
+    "import recommendation\n"
+    "seconds = time.perf_counter() - started\n"
+    "print(json.dumps({'seconds': seconds, 'heavyModules': [name for name in %r if name in sys.modules]}))\n"
+) % (HEAVY_MODULES,)
+
+
+def _oid(kind, index):
+    return ObjectId(f"{ID_PREFIXES[kind]:08x}{index:016x}")
+
+
+def _text(rng, count):
+    return " ".join(rng.choice(WORDS, size=count))
+
+
+class SyntheticBookStore:
+    """Deterministic document factories for every collection the pipeline reads."""
+
+    def __init__(self, n_users, n_books=None, interactions_per_user=8.0, popularity_skew=1.1, seed=42):
+        self.n_users = n_users
+        self.n_books = n_books or max(200, min(n_users // 10, 100000))
+        self.n_authors = max(20, self.n_books // 20)
+        self.interactions_per_user = interactions_per_user
+        self.seed = seed
+        ranks = np.arange(1, self.n_books + 1, dtype=float)
+        popularity = ranks ** -popularity_skew
+        self.popularity = popularity / popularity.sum()
+
+    def _rng(self, kind, chunk=0):
+        return np.random.default_rng([self.seed, ID_PREFIXES[kind], chunk])
+
+    def collection(self, name, only=None):
+        if name in ("interaction", "review", "order"):
+            return getattr(self, name)(only)
+        return getattr(self, name)()
+
+    def genre(self):
+        for index, name in enumerate(GENRES):
+            yield {"_id": _oid("genre", index), "name": name}
+
+    def author(self):
+        rng = self._rng("author")
+        for index in range(self.n_authors):
+            yield {"_id": _oid("author", index), "name": f"Author {index}", "bio": _text(rng, 12)}
+
+    def book(self):
+        rng = self._rng("book")
+        for index in range(self.n_books):
+            # sales follow the same power law the interactions are sampled from
+            sold = int(self.popularity[index] * self.n_users * self.interactions_per_user * 0.15)
+            yield {
+                "_id": _oid("book", index),
+                "title": _text(rng, 3).title(),
+                "description": _text(rng, 40),
+                "authorId": _oid("author", int(rng.integers(self.n_authors))),
+                "genreId": _oid("genre", int(rng.integers(len(GENRES)))),
+                "publisher": f"Publisher {int(rng.integers(50))}",
+                "language": "English",
+                "soldQuantity": sold,
+                "reviewsCount": sold // 10,
+                "averageRating": round(float(rng.uniform(2.5, 5.0)), 1),
+                "createdAt": GENERATED_AT,
+                "updatedAt": GENERATED_AT,
+            }
+
+    def user(self):
+        for index in range(self.n_users):
+            yield {
+                "_id": _oid("user", index),
+                "role": "user",
+                "email": f"reader{index}@example.com",
+                "firebaseId": f"firebase-{index}",
+                "createdAt": GENERATED_AT,
+                "updatedAt": GENERATED_AT,
+            }
+
+    def _user_chunks(self, kind, only=None):
+        """Per-chunk RNGs, so a lookup for a few users regenerates only their chunks."""
+        chunks = range(0, self.n_users, USER_CHUNK)
+        if only is not None:
+            chunks = sorted({user - user % USER_CHUNK for user in only if 0 <= user < self.n_users})
+        for start in chunks:
+            users = np.arange(start, min(start + USER_CHUNK, self.n_users))
+            # ids are numbered per chunk, leaving room for 4096 documents per user
+            yield users, self._rng(kind, start // USER_CHUNK), start << 12
+
+    def interaction(self, only=None):
+        for users, rng, sequence in self._user_chunks("interaction", only):
+            counts = rng.geometric(1.0 / self.interactions_per_user, size=len(users))
+            owners = np.repeat(users, counts)
+            books = rng.choice(self.n_books, size=len(owners), p=self.popularity)
+            types = rng.choice(len(INTERACTION_TYPES), size=len(owners), p=INTERACTION_TYPE_SHARE)
+            minutes = rng.integers(0, 525600, size=len(owners))
+            for owner, book, kind, minute in zip(owners, books, types, minutes):
+                yield {
+                    "_id": _oid("interaction", sequence),
+                    "userId": _oid("user", int(owner)),
+                    "bookId": _oid("book", int(book)),
+                    "interactionType": INTERACTION_TYPES[kind],
+                    "createdAt": GENERATED_AT + timedelta(minutes=int(minute)),
+                }
+                sequence += 1
+
+    def review(self, only=None):
+        for users, rng, sequence in self._user_chunks("review", only):
+            reviewers = users[rng.random(len(users)) < 0.3]
+            books = rng.choice(self.n_books, size=len(reviewers), p=self.popularity)
+            ratings = rng.choice(5, size=len(reviewers), p=(0.05, 0.1, 0.2, 0.35, 0.3)) + 1
+            for reviewer, book, rating in zip(reviewers, books, ratings):
+                yield {
+                    "_id": _oid("review", sequence),
+                    "userId": _oid("user", int(reviewer)),
+                    "username": f"reader{reviewer}",
+                    "productId": str(_oid("book", int(book))),
+                    "rating": int(rating),
+                    "content": _text(rng, 20),
+                    "createdAt": GENERATED_AT,
+                    "updatedAt": GENERATED_AT,
+                }
+                sequence += 1
+
+    def order(self, only=None):
+        for users, rng, sequence in self._user_chunks("order", only):
+            buyers = users[rng.random(len(users)) < 0.4]
+            lines = rng.integers(1, 4, size=len(buyers))
+            for buyer, line_count in zip(buyers, lines):
+                books = rng.choice(self.n_books, size=line_count, p=self.popularity)
+                order = {
+                    "_id": _oid("order", sequence),
+                    "email": f"reader{buyer}@example.com",
+                    "products": [{
+                        "productId": _oid("book", int(book)),
+                        "quantity": int(rng.integers(1, 4)),
+                        "price": float(rng.integers(5, 40)),
+                    } for book in books],
+                    "completed": bool(rng.random() < 0.8),
+                    "createdAt": GENERATED_AT,
+                    "updatedAt": GENERATED_AT,
+                }
+                # a slice of legacy orders only carries the buyer's email
+                if rng.random() < 0.9:
+                    order["userId"] = _oid("user", int(buyer))
+                yield order
+                sequence += 1
+
+
+def _user_hint(query):
+    """Synthetic user indices a query is restricted to, or None when it may touch any user."""
+    if not query:
+        return None
+    clauses = query.get("$or", [query])
+    users = set()
+    for clause in clauses:
+        condition = clause.get("userId")
+        if not isinstance(condition, dict) or "$in" not in condition:
+            if any(field in clause for field in ("firebaseId", "customerId", "email")):
+                continue
+            return None
+        for value in condition["$in"]:
+            text = str(value)
+            if len(text) == 24 and text.startswith(f"{ID_PREFIXES['user']:08x}"):
+                users.add(int(text[8:], 16))
+    return users
+
+
+def _get_path(document, path):
+    value = document
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return None, False
+        value = value[key]
+    return value, True
+
+
+def _matches(document, query):
+    for field, condition in (query or {}).items():
+        if field == "$or":
+            if not any(_matches(document, clause) for clause in condition):
+                return False
+            continue
+        if field == "$and":
+            if not all(_matches(document, clause) for clause in condition):
+                return False
+            continue
+        value, present = _get_path(document, field)
+        if isinstance(condition, dict) and any(key.startswith("$") for key in condition):
+            for operator, operand in condition.items():
+                if operator == "$in" and value not in operand:
+                    return False
+                if operator == "$exists" and present != bool(operand):
+                    return False
+                if operator == "$gt" and not (present and value is not None and value > operand):
+                    return False
+                if operator == "$gte" and not (present and value is not None and value >= operand):
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+class RecordedUpdate(UpdateOne):
+    """UpdateOne that keeps its filter and update readable; pymongo only hands them to a real bulk write."""
+
+    def __init__(self, filter, update, *args, **kwargs):
+        super().__init__(filter, update, *args, **kwargs)
+        self.filter = filter
+        self.update = update
+
+
+# modules whose writes go through bulk_write
+WRITER_MODULES = ("pipeline", "similarity")
+
+
+def record_updates():
+    """Make the writer modules of this process build RecordedUpdate operations; idempotent."""
+    for name in WRITER_MODULES:
+        module = importlib.import_module(name)
+        if module.UpdateOne is not RecordedUpdate:
+            module.UpdateOne = RecordedUpdate
+
+
+class FakeCollection:
+    """The slice of the pymongo collection API the pipeline uses; projections are ignored."""
+
+    def __init__(self, factory=None, unique_user=False, database=None):
+        self._factory = factory
+        self._documents = {}
+        # recommendation writes look documents up by userId, keep that a dict hit
+        self._by_user = {} if unique_user else None
+        self._database = database
+
+    def _iterate(self, query):
+        if self._factory is not None:
+            yield from self._factory(_user_hint(query))
+        yield from list(self._documents.values())
+
+    def _round_trip(self):
+        if self._database is not None:
+            self._database.round_trips += 1
+            if self._database.round_trip_seconds:
+                time.sleep(self._database.round_trip_seconds)
+
+    def find(self, query=None, projection=None, batch_size=None):
+        self._round_trip()
+        return self._find(query)
+
+    def _find(self, query):
+        if self._by_user is not None and query and set(query) == {"userId"}:
+            users = query["userId"]
+            if not isinstance(users, dict):
+                return iter([self._by_user[users]] if users in self._by_user else [])
+            if "$in" in users:
+                return iter([self._by_user[user] for user in users["$in"] if user in self._by_user])
+        return (document for document in self._iterate(query) if _matches(document, query))
+
+    def find_one(self, query=None, projection=None):
+        return next(self.find(query), None)
+
+    def aggregate(self, pipeline, batchSize=None):
+        self._round_trip()
+        return iter(self._aggregate(pipeline))
+
+    def _aggregate(self, pipeline):
+        """$match, $project and $unionWith; as in find(), projections only add their $literal fields."""
+        documents = None
+        for stage in pipeline:
+            (operator, argument), = stage.items()
+            if operator == "$match":
+                documents = list(self._find(argument)) if documents is None else [
+                    document for document in documents if _matches(document, argument)
+                ]
+            elif operator == "$project":
+                literals = {
+                    field: value["$literal"] for field, value in argument.items()
+                    if isinstance(value, dict) and "$literal" in value
+                }
+                source = self._find(None) if documents is None else documents
+                documents = [{**document, **literals} for document in source]
+            elif operator == "$unionWith":
+                other = self._database[argument["coll"]]._aggregate(argument.get("pipeline", []))
+                documents = (list(self._find(None)) if documents is None else documents) + other
+            else:
+                raise ValueError(f"FakeCollection.aggregate does not support {operator}")
+        return list(self._find(None)) if documents is None else documents
+
+    def insert_one(self, document):
+        document.setdefault("_id", ObjectId())
+        self._documents[document["_id"]] = document
+        if self._by_user is not None and "userId" in document:
+            self._by_user[document["userId"]] = document
+
+    def insert_many(self, documents):
+        for document in documents:
+            self.insert_one(document)
+
+    def update_one(self, query, update, upsert=False):
+        document = next((doc for doc in self._documents.values() if _matches(doc, query)), None)
+        if document is None:
+            if not upsert:
+                return
+            document = {key: value for key, value in query.items() if not isinstance(value, dict)}
+            self.insert_one(document)
+        document.update(update.get("$set", {}))
+
+    def bulk_write(self, requests, ordered=True):
+        for operation in requests:
+            if not isinstance(operation, RecordedUpdate):
+                raise TypeError("FakeCollection.bulk_write needs RecordedUpdate operations; see record_updates()")
+            query, update = operation.filter, operation.update
+            document = self._by_user.get(query.get("userId"))
+            if document is None:
+                document = dict(query)
+                self.insert_one(document)
+            document.update(update.get("$set", {}))
+
+    def count_documents(self, query):
+        return sum(1 for _ in self.find(query))
+
+
+class FakeDatabase:
+    def __init__(self, store=None, round_trip_ms=0.0):
+        # shard workers open their own database, so this also covers the writes of spawned processes
+        record_updates()
+        # find() and aggregate() calls, each of which would be a round trip to Mongo; optionally slowed down like one
+        self.round_trips = 0
+        self.round_trip_seconds = round_trip_ms / 1e3
+        self._collections = {}
+        if store is not None:
+            self._collections = {
+                name: FakeCollection(lambda users, name=name: store.collection(name, users), database=self)
+                for name in ID_PREFIXES
+            }
+
+    def add_collection(self, name, documents):
+        self._collections[name] = FakeCollection(database=self)
+        self._collections[name].insert_many(documents)
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(unique_user=True, database=self)
+        return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+
+def _stage_rows(stage):
+    counts = stage.get("counts") or {}
+    return max(counts.values()) if counts else 0
+
+
+def _summarize_stages(stages):
+    summary = {}
+    for stage in stages:
+        rows = _stage_rows(stage)
+        duration = stage.get("durationSeconds", 0.0)
+        summary[stage["name"]] = {
+            "status": stage["status"],
+            "seconds": duration,
+            "cpuSeconds": stage.get("cpuSeconds"),
+            "peakRssMb": stage.get("peakRssMb"),
+            "allocatedPeakMb": stage.get("allocatedPeakMb"),
+            "counts": stage.get("counts", {}),
+            "rowsPerSecond": round(rows / duration, 1) if duration > 0 and rows else None,
+        }
+    return summary
+
+
+def _reset_peak_rss():
+    """Restart this process's RSS high-water mark (Linux clear_refs); False where the kernel won't allow it."""
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as handle:
+            handle.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_comparison(summary, run_scoped):
+    planned = (summary.get("plan") or {}).get("estimatedPeakMb")
+    measured = (summary.get("memory") or {}).get("peakRssMb")
+    if measured is not None:
+        # spawned shard workers are fresh processes, so their own peaks are scoped to this build
+        measured += sum(shard.get("peakRssMb") or 0.0 for shard in summary.get("shards") or ())
+    return {
+        "plannedMb": planned,
+        "measuredMb": measured,
+        "runScoped": run_scoped,
+        "ratio": round(measured / planned, 2) if planned and measured is not None else None,
+    }
+
+
+def _timed_run(db, mode, args):
+    from pipeline import run_pipeline
+
+    # without the reset the measured peak is the process's lifetime high, which an earlier scale may have set
+    run_scoped = _reset_peak_rss() if args.reset_peak_rss else False
+    started = time.perf_counter()
+    summary = run_pipeline(
+        top_n=args.top_n,
+        cf_weight=args.cf_weight,
+        cb_weight=args.cb_weight,
+        mode=mode,
+        db=db,
+        memory_budget=args.memory_budget
+    )
+    seconds = time.perf_counter() - started
+    return {
+        "mode": summary["mode"],
+        "fallbackReason": summary.get("fallbackReason"),
+        "usersUpdated": summary["usersUpdated"],
+        "seconds": round(seconds, 3),
+        "usersPerSecond": round(summary["usersUpdated"] / seconds, 1) if seconds > 0 else None,
+        "stages": _summarize_stages(summary["stages"]),
+        "plan": summary.get("plan"),
+        "memory": summary.get("memory"),
+        "peak": _peak_comparison(summary, run_scoped),
+    }
+
+
+def _touch_users(db, store, count, seed):
+    rng = np.random.default_rng([seed, 99])
+    now = datetime.now(timezone.utc)
+    users = rng.choice(store.n_users, size=min(count, store.n_users), replace=False)
+    books = rng.choice(store.n_books, size=len(users), p=store.popularity)
+    db.interaction.insert_many({
+        "userId": _oid("user", int(user)),
+        "bookId": _oid("book", int(book)),
+        "interactionType": "wishlist",
+        "createdAt": now,
+    } for user, book in zip(users, books))
+
+
+def _online_latency(db, store, args, round_trip_ms=0.0):
+    from artifacts import get_model_state
+    from serving import recommend_for_user
+
+    state = get_model_state(db)
+    if state is None:
+        return None
+    rng = np.random.default_rng([args.seed, 7])
+    users = rng.choice(store.n_users, size=min(args.online_samples, store.n_users), replace=False)
+    # history lookups hit a database holding only the sampled users, so generation stays out of the timings
+    sample_db = FakeDatabase(round_trip_ms=round_trip_ms)
+    sample_ids = {_oid("user", int(user)) for user in users}
+    sample_emails = {f"reader{user}@example.com" for user in users}
+    for name in ("interaction", "review", "order"):
+        sample_db.add_collection(name, (
+            document for document in store.collection(name, set(users.tolist()))
+            if document.get("userId") in sample_ids or document.get("email") in sample_emails
+        ))
+    sample_db.round_trips = 0
+    timings = []
+    for user in users:
+        started = time.perf_counter()
+        recommend_for_user(
+            sample_db,
+            dict(state),
+            str(_oid("user", int(user))),
+            args.top_n,
+            args.cf_weight,
+            args.cb_weight
+        )
+        timings.append(time.perf_counter() - started)
+    return {
+        "samples": len(timings),
+        "roundTripMs": round_trip_ms,
+        "roundTripsPerRequest": round(sample_db.round_trips / max(len(timings), 1), 2),
+        "p50Ms": round(float(np.percentile(timings, 50)) * 1e3, 2),
+        "p99Ms": round(float(np.percentile(timings, 99)) * 1e3, 2),
+    }
+
+
+def _search_latency(db, args):
+    from artifacts import get_model_state
+    from search import search_books
+
+    state = get_model_state(db)
+    if state is None or state.get("search_index") is None:
+        return None
+    rng = np.random.default_rng([args.seed, 11])
+    search_index = state["search_index"]
+    titles = state["books_df"]["title"].tolist()
+    queries = []
+    for position in rng.integers(len(titles), size=args.search_samples):
+        tokens = search_index.analyze(titles[position] or "")[:int(rng.integers(1, 4))]
+        # every other query is cut short, the way type-ahead sends it
+        query = " ".join(tokens)
+        queries.append(query[:-2] if position % 2 and tokens and len(tokens[-1]) > 3 else query)
+    timings = []
+    for query in queries:
+        started = time.perf_counter()
+        search_books(db, state, query, 20)
+        timings.append(time.perf_counter() - started)
+    return {
+        "samples": len(timings),
+        "p50Ms": round(float(np.percentile(timings, 50)) * 1e3, 2),
+        "p99Ms": round(float(np.percentile(timings, 99)) * 1e3, 2),
+    }
+
+
+def measure_import_time(samples):
+    """Median wall time of ``import recommendation`` in fresh interpreters, and any heavy modules it pulled in."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    probes = []
+    for _ in range(samples):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_PROBE],
+            cwd=directory,
+            # the probe times the import itself, not the warm-up it would start
+            env={**os.environ, "RECOMMENDATION_WARMUP": "false"},
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout
+        probes.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        "samples": samples,
+        "seconds": round(float(np.median([probe["seconds"] for probe in probes])), 3),
+        "heavyModules": sorted({name for probe in probes for name in probe["heavyModules"]}),
+    }
+
+
+def run_scale(n_users, args):
+    store = SyntheticBookStore(
+        n_users,
+        n_books=args.books,
+        interactions_per_user=args.interactions_per_user,
+        seed=args.seed
+    )
+    db = FakeDatabase(store)
+    result = {"users": n_users, "books": store.n_books, "runs": {}}
+
+    result["runs"]["full"] = _timed_run(db, "full", args)
+    _touch_users(db, store, max(1, n_users // 1000), args.seed)
+    result["runs"]["incremental"] = _timed_run(db, "incremental", args)
+    if args.online_samples:
+        result["online"] = _online_latency(db, store, args)
+        if args.online_round_trip_ms:
+            # the same requests against a database that answers each query after a network round trip
+            result["onlineRemote"] = _online_latency(db, store, args, round_trip_ms=args.online_round_trip_ms)
+    if args.search_samples:
+        result["search"] = _search_latency(db, args)
+    return result
+
+
+def compare_results(current, baseline, tolerance):
+    """Stage timings that grew by more than ``tolerance`` relative to the baseline."""
+    regressions = []
+    imported, previous_import = current.get("import"), baseline.get("import")
+    if imported and imported["heavyModules"]:
+        regressions.append({
+            "users": 0,
+            "mode": "import",
+            "stage": "eager " + ",".join(imported["heavyModules"]),
+            "seconds": imported["seconds"],
+            "baselineSeconds": previous_import["seconds"] if previous_import else imported["seconds"],
+            "ratio": None,
+        })
+    if imported and previous_import and previous_import["seconds"] >= 0.01:
+        if imported["seconds"] > previous_import["seconds"] * tolerance:
+            regressions.append({
+                "users": 0,
+                "mode": "import",
+                "stage": "total",
+                "seconds": imported["seconds"],
+                "baselineSeconds": previous_import["seconds"],
+                "ratio": round(imported["seconds"] / previous_import["seconds"], 2),
+            })
+    baseline_scales = {scale["users"]: scale for scale in baseline.get("scales", [])}
+    for scale in current["scales"]:
+        previous = baseline_scales.get(scale["users"])
+        if previous is None:
+            continue
+        for mode, run in scale["runs"].items():
+            previous_run = previous["runs"].get(mode)
+            if previous_run is None:
+                continue
+            checks = [("total", run["seconds"], previous_run["seconds"])]
+            checks.extend(
+                (name, stage["seconds"], previous_run["stages"][name]["seconds"])
+                for name, stage in run["stages"].items()
+                if name in previous_run["stages"]
+            )
+            for name, seconds, previous_seconds in checks:
+                # sub-10ms stages are mostly timer noise
+                if previous_seconds >= 0.01 and seconds > previous_seconds * tolerance:
+                    regressions.append({
+                        "users": scale["users"],
+                        "mode": mode,
+                        "stage": name,
+                        "seconds": seconds,
+                        "baselineSeconds": previous_seconds,
+                        "ratio": round(seconds / previous_seconds, 2),
+                    })
+        for name in ("online", "onlineRemote"):
+            latency, previous_latency = scale.get(name), previous.get(name)
+            if not latency or not previous_latency:
+                continue
+            # only runs against the same simulated round trip are comparable
+            if previous_latency.get("roundTripMs", 0.0) != latency["roundTripMs"]:
+                continue
+            seconds, previous_seconds = latency["p50Ms"] / 1e3, previous_latency["p50Ms"] / 1e3
+            if previous_seconds >= 0.001 and seconds > previous_seconds * tolerance:
+                regressions.append({
+                    "users": scale["users"],
+                    "mode": name,
+                    "stage": "p50",
+                    "seconds": seconds,
+                    "baselineSeconds": previous_seconds,
+                    "ratio": round(seconds / previous_seconds, 2),
+                })
+    return regressions
+
+
+def check_memory_plans(results, tolerance):
+    """Builds whose run-scoped peak RSS exceeded the planner's estimate by more than ``tolerance``."""
+    misses = []
+    for scale in results["scales"]:
+        for mode, run in scale["runs"].items():
+            peak = run.get("peak") or {}
+            if peak.get("runScoped") and peak.get("ratio") is not None and peak["ratio"] > tolerance:
+                misses.append({"users": scale["users"], "mode": mode, **peak})
+    return misses
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the recommendation pipeline on synthetic data.")
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000], help="user counts to benchmark")
+    parser.add_argument("--books", type=int, default=None, help="catalog size (default: users / 10, 200..100k)")
+    parser.add_argument("--interactions-per-user", type=float, default=8.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--top-n", type=int, default=12)
+    parser.add_argument("--cf-weight", type=float, default=0.6)
+    parser.add_argument("--cb-weight", type=float, default=0.4)
+    parser.add_argument("--online-samples", type=int, default=50, help="users scored through the online path")
+    parser.add_argument(
+        "--online-round-trip-ms",
+        type=float,
+        default=2.0,
+        help="simulated Mongo round trip of the remote online case (0 skips it)"
+    )
+    parser.add_argument("--search-samples", type=int, default=200, help="title queries run against the search index")
+    parser.add_argument("--memory-budget", help='build memory budget, e.g. 512 (MB), "2GiB" or "auto"')
+    parser.add_argument("--trace-memory", action="store_true", help="record tracemalloc peaks per stage")
+    parser.add_argument(
+        "--reset-peak-rss",
+        action="store_true",
+        help="reset the RSS high-water mark before each build and check it against the plan's estimate (Linux)"
+    )
+    parser.add_argument("--import-samples", type=int, default=5, help="fresh interpreters timing the module import")
+    parser.add_argument("--output", help="write results as JSON to this path")
+    parser.add_argument("--compare", help="baseline JSON to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="allowed slowdown ratio against --compare")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="recommendation-benchmark-") as workdir:
+        # artifacts and the build lock must never touch the service's model directory
+        os.environ["RECOMMENDATION_MODEL_DIR"] = workdir
+        os.environ["RECOMMENDATION_BUILD_LOCK"] = os.path.join(workdir, ".build.lock")
+        os.environ["RECOMMENDATION_TRACE_MEMORY"] = "true" if args.trace_memory else "false"
+        # settings are read at import, so the service modules load only once the environment is in place
+        importlib.import_module("settings").LOGGER.setLevel("WARNING")
+        # the service imports the pipeline lazily; keep that one-off cost out of the first stage timings
+        importlib.import_module("pipeline")
+
+        results = {
+            "generatedAt": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+            "scales": [],
+        }
+        if args.import_samples:
+            results["import"] = measure_import_time(args.import_samples)
+            print(
+                f"   import {results['import']['seconds']:8.3f}s  "
+                f"heavy modules: {', '.join(results['import']['heavyModules']) or 'none'}"
+            )
+        for n_users in args.users:
+            scale = run_scale(n_users, args)
+            results["scales"].append(scale)
+            full = scale["runs"]["full"]
+            print(
+                f"{n_users:>9} users  full {full['seconds']:8.2f}s  "
+                f"incremental {scale['runs']['incremental']['seconds']:6.2f}s  "
+                + "  ".join(f"{name}={stage['seconds']:.2f}s" for name, stage in full["stages"].items())
+            )
+            for name in ("online", "onlineRemote"):
+                latency = scale.get(name)
+                if latency:
+                    print(
+                        f"{'':>9}        {name} p50 {latency['p50Ms']} ms  p99 {latency['p99Ms']} ms  "
+                        f"{latency['roundTripsPerRequest']} round trips per request"
+                    )
+            if full["peak"]["runScoped"]:
+                print(
+                    f"{'':>9}        peak planned {full['peak']['plannedMb']} MB  "
+                    f"measured {full['peak']['measuredMb']} MB"
+                )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            json.dump(results, handle, indent=2, default=str)
+
+    exit_code = 0
+    for miss in check_memory_plans(results, args.tolerance):
+        print(
+            f"MEMORY PLAN {miss['users']} users {miss['mode']}: "
+            f"planned {miss['plannedMb']:.1f} MB, measured {miss['measuredMb']:.1f} MB (x{miss['ratio']})"
+        )
+        exit_code = 1
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as handle:
+            regressions = compare_results(results, json.load(handle), args.tolerance)
+        for regression in regressions:
+            print(
+                f"REGRESSION {regression['users']} users {regression['mode']}/{regression['stage']}: "
+                f"{regression['baselineSeconds']:.3f}s -> {regression['seconds']:.3f}s (x{regression['ratio'] or '-'})"
+            )
+        if regressions:
+            return 1
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
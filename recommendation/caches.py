@@ -0,0 +1,206 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_MAX_ENTRIES = int(os.getenv("RECOMMENDATION_CACHE_SIZE", 10000))
+CACHE_TTL = float(os.getenv("RECOMMENDATION_CACHE_TTL", 300))
+SERVING_CACHE_SIZE = int(os.getenv("RECOMMENDATION_SERVING_CACHE_SIZE", 100000))
+SERVING_CACHE_WIDTH = int(os.getenv("RECOMMENDATION_SERVING_CACHE_WIDTH", 50))
+SERVING_CACHE_TTL = float(os.getenv("RECOMMENDATION_SERVING_CACHE_TTL", 600))
+# per-hit check of the stored document's hash; the version marker below already catches writes elsewhere
+SERVING_CACHE_VERIFY = os.getenv("RECOMMENDATION_SERVING_CACHE_VERIFY", "false").lower() in ("1", "true", "yes", "on")
+# how often each process reads the version marker that builds and event batches bump
+SERVING_VERSION_INTERVAL = float(os.getenv("RECOMMENDATION_SERVING_VERSION_INTERVAL", 5))
+PIPELINE_STATE = {}
+
+
+class RecommendationCache:
+    """Thread-safe LRU cache with per-entry TTL, keyed by user id."""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, user_id, params):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            entry_params, expires_at, value = entry
+            if entry_params != params or expires_at < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return value
+
+    def put(self, user_id, params, value):
+        with self._lock:
+            self._entries[user_id] = (params, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_ids=None):
+        with self._lock:
+            if user_ids is None:
+                self._entries.clear()
+                return
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+
+RECOMMENDATION_CACHE = RecommendationCache()
+SEARCH_PROFILE_CACHE = RecommendationCache()
+
+
+class ServingCache:
+    """Stored recommendations as fixed-width rows of catalog positions and scores, one per user."""
+
+    def __init__(self, capacity=SERVING_CACHE_SIZE, width=SERVING_CACHE_WIDTH, ttl=SERVING_CACHE_TTL):
+        self.capacity = capacity
+        self.width = width
+        self.ttl = ttl
+        self.catalog = None
+        self.labels = [None]
+        self._label_codes = {None: 0}
+        self._slots = OrderedDict()
+        self._free = []
+        # row storage is allocated by the first put, so the module-level cache does not import numpy
+        self._positions = self._scores = self._codes = self._expires = self._hashes = None
+        # per process: writers elsewhere reach it through CACHE_VERSION, and rows keep their contentHash for verify
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._slots)
+
+    def _code(self, label):
+        code = self._label_codes.get(label)
+        if code is None:
+            code = self._label_codes[label] = len(self.labels)
+            self.labels.append(label)
+        return code
+
+    def _allocate(self):
+        import numpy as np
+
+        if self._free:
+            return self._free.pop()
+        used = len(self._slots)
+        if used >= self.capacity:
+            _, slot = self._slots.popitem(last=False)
+            return slot
+        if self._expires is None:
+            self._positions = np.empty((0, self.width), dtype=np.int32)
+            self._scores = np.empty((0, self.width), dtype=np.float32)
+            self._codes = np.empty((0, 2), dtype=np.int16)
+            self._expires = np.empty(0)
+            self._hashes = np.empty(0, dtype=object)
+        if used >= len(self._expires):
+            # grow geometrically so a warming cache does not reallocate per user
+            rows = min(max(2 * len(self._expires), 1024), self.capacity) - len(self._expires)
+            self._positions = np.vstack([self._positions, np.full((rows, self.width), -1, dtype=np.int32)])
+            self._scores = np.vstack([self._scores, np.full((rows, self.width), np.nan, dtype=np.float32)])
+            self._codes = np.vstack([self._codes, np.zeros((rows, 2), dtype=np.int16)])
+            self._expires = np.concatenate([self._expires, np.zeros(rows)])
+            self._hashes = np.concatenate([self._hashes, np.full(rows, None, dtype=object)])
+        return used
+
+    def get(self, user_id):
+        with self._lock:
+            slot = self._slots.get(user_id)
+            if slot is None:
+                return None
+            if self._expires[slot] < time.monotonic():
+                self._free.append(self._slots.pop(user_id))
+                return None
+            self._slots.move_to_end(user_id)
+            positions = self._positions[slot]
+            count = int((positions >= 0).sum())
+            method, fallback_reason = self._codes[slot]
+            return (
+                positions[:count].copy(),
+                self._scores[slot, :count].astype(float),
+                self.labels[method],
+                self.labels[fallback_reason],
+                self._hashes[slot],
+            )
+
+    def put(self, user_id, positions, scores, method, fallback_reason, content_hash=None):
+        count = min(len(positions), self.width)
+        with self._lock:
+            slot = self._slots.get(user_id)
+            if slot is None:
+                slot = self._allocate()
+                self._slots[user_id] = slot
+            self._slots.move_to_end(user_id)
+            self._positions[slot] = -1
+            self._positions[slot, :count] = positions[:count]
+            self._scores[slot] = float("nan")
+            self._scores[slot, :count] = scores[:count]
+            self._codes[slot] = (self._code(method), self._code(fallback_reason))
+            self._expires[slot] = time.monotonic() + self.ttl
+            self._hashes[slot] = content_hash
+
+    def invalidate(self, user_ids=None):
+        with self._lock:
+            if user_ids is None:
+                self._free.extend(self._slots.values())
+                self._slots.clear()
+                return
+            for user_id in user_ids:
+                slot = self._slots.pop(user_id, None)
+                if slot is not None:
+                    self._free.append(slot)
+
+    def reset(self, book_ids):
+        with self._lock:
+            if self.catalog is book_ids:
+                return
+            if self.catalog != book_ids:
+                self._free.extend(self._slots.values())
+                self._slots.clear()
+            self.catalog = book_ids
+
+
+SERVING_CACHE = ServingCache()
+
+
+class CacheVersion:
+    """Clears per-process caches when the stored version marker changes, reading it at most once per interval."""
+
+    def __init__(self, caches, interval=SERVING_VERSION_INTERVAL):
+        self.caches = caches
+        self.interval = interval
+        self.version = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.version = self._checked_at = None
+
+    def check(self, load_version):
+        now = time.monotonic()
+        with self._lock:
+            if self._checked_at is not None and now - self._checked_at < self.interval:
+                return False
+            self._checked_at = now
+        version = load_version()
+        with self._lock:
+            if version == self.version:
+                return False
+            self.version = version
+        for cache in self.caches:
+            cache.invalidate()
+        return True
+
+
+CACHE_VERSION = CacheVersion((RECOMMENDATION_CACHE, SEARCH_PROFILE_CACHE, SERVING_CACHE))
@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# settings are read at import, so builds under test must be pointed away from the service's model directory first
+TEST_MODEL_DIR = Path(tempfile.mkdtemp(prefix="recommendation-tests-"))
+os.environ["RECOMMENDATION_MODEL_DIR"] = str(TEST_MODEL_DIR)
+os.environ["RECOMMENDATION_BUILD_LOCK"] = str(TEST_MODEL_DIR / ".build.lock")
+os.environ["RECOMMENDATION_WARMUP"] = "false"
+
+
+def pytest_sessionfinish(session, exitstatus):
+    # the directory must exist before collection imports the settings, so no tmp_path fixture can own it
+    shutil.rmtree(TEST_MODEL_DIR, ignore_errors=True)
+
+
+def fresh_database(n_users=120, n_books=60, seed=7):
+    """A synthetic database, with no model loaded, cached or saved from an earlier build."""
+    import benchmark
+    from caches import CACHE_VERSION, PIPELINE_STATE, RECOMMENDATION_CACHE, SEARCH_PROFILE_CACHE, SERVING_CACHE
+
+    PIPELINE_STATE.clear()
+    for cache in (RECOMMENDATION_CACHE, SEARCH_PROFILE_CACHE, SERVING_CACHE):
+        cache.invalidate()
+    CACHE_VERSION.reset()
+    for path in TEST_MODEL_DIR.iterdir():
+        if path.is_dir():
+            shutil.rmtree(path)
+        elif path.name != ".build.lock":
+            path.unlink()
+    return benchmark.FakeDatabase(benchmark.SyntheticBookStore(n_users, n_books=n_books, seed=seed))
+
+
+@pytest.fixture
+def fresh_db():
+    return fresh_database
+
+
+@pytest.fixture
+def db():
+    return fresh_database()
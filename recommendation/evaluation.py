@@ -0,0 +1,405 @@
+"""Offline evaluation of recommendation quality against held-out purchases.
+
+Interactions, orders and reviews are split at a timestamp. Everything before the
+cutoff trains the content and collaborative models through the same code paths
+the service uses; books bought after it are the ground truth. Each component
+count is fitted once and every blend weight is ranked from those scores, so a
+grid search costs one CF fit per ``--components`` value plus a blend-and-rank
+pass per weight.
+
+    python evaluation.py --synthetic 5000 --cf-weights 0 0.5 1 --components 20 50
+    python evaluation.py --holdout 0.1 --output evaluation.json
+"""
+
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+from scoring import (
+    CF_ALGORITHM,
+    ConsumedIndex,
+    build_interactions,
+    build_popularity_ranking,
+    compute_collaborative_scores,
+    compute_content_scores,
+    interaction_weights_frame,
+    prepare_books_dataframe,
+    top_positive,
+)
+from settings import CF_COMPONENTS, LOGGER, RANKING_CHUNK_SIZE
+from store import (
+    UserRegistry,
+    event_time,
+    get_database,
+    read_interaction_columns,
+    read_order_columns,
+    read_review_columns,
+    resolve_order_user,
+    stream_collection,
+)
+
+
+def _split_documents(documents, cutoff, event_time):
+    train, test = [], []
+    for document in documents:
+        # undated documents can only ever be history
+        (test if event_time(document) > cutoff else train).append(document)
+    return train, test
+
+
+def choose_cutoff(purchase_documents, holdout):
+    """Timestamp leaving the most recent ``holdout`` share of dated interactions and orders for testing."""
+    times = np.array([event_time(document) for document in purchase_documents], dtype=float)
+    times = times[~np.isnan(times)]
+    if not len(times):
+        raise ValueError("No dated interactions or orders to split on")
+    return float(np.quantile(times, 1.0 - holdout))
+
+
+def held_out_purchases(interactions, orders, user_registry):
+    """(user, book) pairs bought after the cutoff, keyed the way the training interactions are."""
+    bought = [
+        interaction for interaction in interactions
+        if (interaction.get("interactionType") or "").lower() == "order"
+    ]
+    columns = read_interaction_columns(bought)
+    pairs = set(zip(columns["userId"], columns["productId"]))
+    order_columns = read_order_columns(orders)
+    buyers = [resolve_order_user(order, user_registry) for order in order_columns["orders"]]
+    for order, product_id in zip(order_columns["orderIndex"], order_columns["productId"]):
+        if buyers[order]:
+            pairs.add((buyers[order], product_id))
+    return pairs
+
+
+class EvaluationSplit:
+    """Models trained on the history before the cutoff plus the purchases each evaluated user made after it."""
+
+    def __init__(self, book_ids, interaction_df, cb_scores, consumed_index, popularity, users, truth, counts):
+        self.book_ids = book_ids
+        self.interaction_df = interaction_df
+        self.cb_scores = cb_scores
+        self.consumed_index = consumed_index
+        self.popularity = popularity
+        self.users = users
+        self.truth = truth
+        self.counts = counts
+        self.relevant = np.bincount(truth // len(book_ids), minlength=len(users))
+
+    @classmethod
+    def build(cls, db, cutoff=None, holdout=0.2, max_users=None, seed=42):
+        started = time.perf_counter()
+        collections = {
+            name: list(stream_collection(db, name))
+            for name in ("book", "author", "genre", "user", "interaction", "review", "order")
+        }
+        if cutoff is None:
+            cutoff = choose_cutoff(collections["interaction"] + collections["order"], holdout)
+        interactions, test_interactions = _split_documents(collections["interaction"], cutoff, event_time)
+        reviews, _ = _split_documents(collections["review"], cutoff, event_time)
+        orders, test_orders = _split_documents(collections["order"], cutoff, event_time)
+
+        reviews = read_review_columns(reviews)
+        books_df = prepare_books_dataframe(
+            collections["book"],
+            collections["author"],
+            collections["genre"],
+            reviews
+        )
+        if books_df.empty:
+            raise ValueError("The catalog is empty")
+        user_registry = UserRegistry(collections["user"])
+        interaction_table = build_interactions(
+            read_interaction_columns(interactions),
+            reviews,
+            read_order_columns(orders),
+            user_registry
+        )
+        _, normalized_interactions_df = interaction_table.frames()
+        interaction_df = interaction_weights_frame(normalized_interactions_df)
+        load_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        book_ids = books_df["bookId"].tolist()
+        cb_scores, consumed_index = compute_content_scores(books_df, interaction_df)
+        if consumed_index is None:
+            consumed_index = ConsumedIndex.from_interactions(interaction_df, book_ids)
+        content_seconds = time.perf_counter() - started
+
+        positions = {book_id: position for position, book_id in enumerate(book_ids)}
+        relevant = {}
+        for user_id, book_id in held_out_purchases(test_interactions, test_orders, user_registry):
+            position = positions.get(book_id)
+            if position is not None:
+                relevant.setdefault(user_id, set()).add(position)
+        # rebuying something the user already had is not a recommendation the model could have made
+        relevant = {
+            user_id: sorted(books - set(consumed_index.books(user_id).tolist()))
+            for user_id, books in relevant.items()
+        }
+        users = sorted(user_id for user_id, books in relevant.items() if books)
+        if max_users is not None and len(users) > max_users:
+            chosen = np.random.default_rng(seed).choice(len(users), size=max_users, replace=False)
+            users = [users[index] for index in sorted(chosen)]
+        truth = np.array(
+            [row * len(book_ids) + position for row, user_id in enumerate(users) for position in relevant[user_id]],
+            dtype=np.int64
+        )
+        trained = set(interaction_df["userId"]) if not interaction_df.empty else set()
+        counts = {
+            "cutoff": datetime.fromtimestamp(cutoff, tz=timezone.utc).isoformat(),
+            "books": len(book_ids),
+            "trainInteractions": len(interactions),
+            "trainOrders": len(orders),
+            "heldOutInteractions": len(test_interactions),
+            "heldOutOrders": len(test_orders),
+            "evaluatedUsers": len(users),
+            "coldUsers": sum(1 for user_id in users if user_id not in trained),
+            "heldOutPurchases": len(truth),
+            "loadSeconds": round(load_seconds, 3),
+            "contentSeconds": round(content_seconds, 3),
+        }
+        popularity = np.array(
+            [positions[book_id] for book_id in build_popularity_ranking(books_df)],
+            dtype=np.int64
+        )
+        return cls(book_ids, interaction_df, cb_scores, consumed_index, popularity, users, truth, counts)
+
+    def score_rows(self, scores, rows):
+        """Dense block of ``scores`` for the evaluated users at ``rows``; users the model never saw score zero."""
+        block = np.zeros((len(rows), len(self.book_ids)))
+        if getattr(scores, "empty", True):
+            return block
+        found = scores.index.get_indexer([self.users[row] for row in rows])
+        present = np.flatnonzero(found >= 0)
+        if len(present):
+            block[present] = scores.block(found[present])
+        return block
+
+    def fallback(self, user_id, top_n):
+        consumed = self.consumed_index.books(user_id)
+        candidates = self.popularity[:top_n + len(consumed)]
+        chosen = candidates[~np.isin(candidates, consumed)][:top_n]
+        return np.pad(chosen, (0, top_n - len(chosen)), constant_values=-1)
+
+
+class MetricTotals:
+    """Running precision/recall/NDCG sums and catalog coverage for one configuration."""
+
+    def __init__(self, n_books, top_n):
+        self.top_n = top_n
+        self.discounts = 1.0 / np.log2(np.arange(top_n) + 2.0)
+        self.ideal = np.cumsum(self.discounts)
+        self.recommended = np.zeros(n_books, dtype=bool)
+        self.users = self.hits = self.fallbacks = 0
+        self.precision = self.recall = self.ndcg = 0.0
+        self.cpu_seconds = 0.0
+
+    def add(self, split, rows, top_idx, fallbacks):
+        listed = top_idx >= 0
+        keys = np.asarray(rows, dtype=np.int64)[:, None] * len(split.book_ids) + top_idx
+        hits = listed & np.isin(keys, split.truth)
+        relevant = split.relevant[rows]
+        found = hits.sum(axis=1)
+        self.users += len(rows)
+        self.hits += int((found > 0).sum())
+        self.fallbacks += fallbacks
+        self.precision += float((found / self.top_n).sum())
+        self.recall += float((found / relevant).sum())
+        ideal = self.ideal[np.minimum(relevant, self.top_n) - 1]
+        self.ndcg += float(((hits * self.discounts).sum(axis=1) / ideal).sum())
+        self.recommended[top_idx[listed]] = True
+
+    def summary(self):
+        users = max(self.users, 1)
+        return {
+            "precision": round(self.precision / users, 5),
+            "recall": round(self.recall / users, 5),
+            "ndcg": round(self.ndcg / users, 5),
+            "hitRate": round(self.hits / users, 5),
+            "coverage": round(float(self.recommended.mean()), 5),
+            "fallbackUsers": self.fallbacks,
+            "scoringCpuSeconds": round(self.cpu_seconds, 3),
+            "usersPerCpuSecond": round(self.users / self.cpu_seconds, 1) if self.cpu_seconds > 0 else None,
+        }
+
+
+def _rank_weight(split, rows, cf_block, cb_block, cf_weight, top_n, totals):
+    started = time.thread_time()
+    if cf_weight is None:
+        top_idx = np.full((len(rows), top_n), -1, dtype=np.int64)
+        empty = np.ones(len(rows), dtype=bool)
+    else:
+        chunk = [split.users[row] for row in rows]
+        values = split.consumed_index.mask(cf_weight * cf_block + (1.0 - cf_weight) * cb_block, chunk)
+        top_idx, top_values = top_positive(values, top_n)
+        top_idx = np.where(top_values > 0, top_idx, -1)
+        if top_idx.shape[1] < top_n:
+            top_idx = np.pad(top_idx, ((0, 0), (0, top_n - top_idx.shape[1])), constant_values=-1)
+        empty = top_idx[:, 0] < 0
+    # users with nothing positive get the service's popularity fallback
+    for row in np.flatnonzero(empty):
+        top_idx[row] = split.fallback(split.users[rows[row]], top_n)
+    totals.add(split, rows, top_idx, int(empty.sum()))
+    totals.cpu_seconds += time.thread_time() - started
+
+
+def evaluate_weights(split, cf_scores, cf_weights, top_n, executor, chunk_size=None):
+    """Metrics for every blend weight from one set of fitted scores; ``None`` ranks by popularity alone."""
+    chunk_size = chunk_size or RANKING_CHUNK_SIZE
+    totals = {cf_weight: MetricTotals(len(split.book_ids), top_n) for cf_weight in cf_weights}
+    for start in range(0, len(split.users), chunk_size):
+        rows = np.arange(start, min(start + chunk_size, len(split.users)))
+        cf_block = split.score_rows(cf_scores, rows)
+        cb_block = split.score_rows(split.cb_scores, rows)
+        futures = [
+            executor.submit(_rank_weight, split, rows, cf_block, cb_block, cf_weight, top_n, totals[cf_weight])
+            for cf_weight in cf_weights
+        ]
+        for future in futures:
+            future.result()
+    return {cf_weight: metric_totals.summary() for cf_weight, metric_totals in totals.items()}
+
+
+def _allocated_peak_mb(floor):
+    """MB allocated above ``floor`` at the traced peak since the last reset; restarts the peak for the next phase."""
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    return round((peak - floor) / 2**20, 1)
+
+
+def run_evaluation(split, args):
+    algorithm = args.algorithm or CF_ALGORITHM
+    configurations = []
+    # the process's RSS high-water mark only grows across configurations, so each one's peak is traced instead
+    tracing = not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+            baseline = evaluate_weights(split, None, [None], args.top_n, executor)[None]
+            for n_components in args.components or [CF_COMPONENTS]:
+                configurations.extend(_evaluate_components(split, args, algorithm, n_components, executor))
+    finally:
+        if tracing:
+            tracemalloc.stop()
+    return {"popularity": baseline, "configurations": configurations}
+
+
+def _evaluate_components(split, args, algorithm, n_components, executor):
+    floor = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    started = time.perf_counter()
+    cf_scores, _, user_factors_df, item_factors_df = compute_collaborative_scores(
+        split.interaction_df,
+        split.book_ids,
+        consumed_index=split.consumed_index,
+        algorithm=algorithm,
+        n_components=n_components
+    )
+    fit_seconds = time.perf_counter() - started
+    fit_peak_mb = _allocated_peak_mb(floor)
+    factor_mb = (user_factors_df.memory_usage().sum() + item_factors_df.memory_usage().sum()) / 2 ** 20
+
+    started = time.perf_counter()
+    results = evaluate_weights(split, cf_scores, args.cf_weights, args.top_n, executor)
+    scoring_seconds = time.perf_counter() - started
+    scoring_peak_mb = _allocated_peak_mb(floor)
+    return [{
+        "algorithm": algorithm,
+        "components": n_components,
+        "fittedComponents": item_factors_df.shape[1],
+        "cfWeight": cf_weight,
+        "cbWeight": round(1.0 - cf_weight, 6),
+        **metrics,
+        "fitSeconds": round(fit_seconds, 3),
+        "gridScoringSeconds": round(scoring_seconds, 3),
+        "factorMb": round(float(factor_mb), 2),
+        # allocations above what was live before this component count; its weights share one fit and one pass
+        "fitPeakMb": fit_peak_mb,
+        "scoringPeakMb": scoring_peak_mb,
+    } for cf_weight, metrics in results.items()]
+
+
+def _open_database(args):
+    if args.synthetic is None:
+        return get_database()
+    benchmark = importlib.import_module("benchmark")
+    store = benchmark.SyntheticBookStore(args.synthetic, n_books=args.books, seed=args.seed)
+    return benchmark.FakeDatabase(store)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate recommendation quality on a time split of the data.")
+    parser.add_argument("--synthetic", type=int, default=None, help="evaluate on benchmark data for this many users")
+    parser.add_argument("--books", type=int, default=None, help="synthetic catalog size")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--holdout", type=float, default=0.2, help="share of the newest purchases held out")
+    parser.add_argument("--cutoff", help="explicit ISO timestamp to split at instead of --holdout")
+    parser.add_argument("--top-n", type=int, default=12, help="K for precision@K, recall@K and NDCG@K")
+    parser.add_argument("--cf-weights", type=float, nargs="+", default=[0.0, 0.2, 0.4, 0.6, 0.8, 1.0],
+                        help="CF blend weights to try; the content weight is 1 - cf")
+    parser.add_argument("--components", type=int, nargs="+", default=None, help="CF factor counts to fit")
+    parser.add_argument("--algorithm", choices=("svd", "als"), default=None)
+    parser.add_argument("--max-users", type=int, default=None, help="sample this many evaluated users")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="threads ranking blend weights")
+    parser.add_argument("--output", help="write results as JSON to this path")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    LOGGER.setLevel("WARNING")
+    cutoff = None
+    if args.cutoff:
+        cutoff = datetime.fromisoformat(args.cutoff)
+        cutoff = (cutoff if cutoff.tzinfo else cutoff.replace(tzinfo=timezone.utc)).timestamp()
+
+    split = EvaluationSplit.build(
+        _open_database(args),
+        cutoff=cutoff,
+        holdout=args.holdout,
+        max_users=args.max_users,
+        seed=args.seed
+    )
+    print("  ".join(f"{key}={value}" for key, value in split.counts.items()))
+    if not split.users:
+        print("No held-out purchases to evaluate against")
+        return 1
+
+    results = run_evaluation(split, args)
+    popularity = results["popularity"]
+    print(
+        f"{'popularity':>22}  P@{args.top_n} {popularity['precision']:.4f}  R@{args.top_n} {popularity['recall']:.4f}  "
+        f"NDCG {popularity['ndcg']:.4f}  coverage {popularity['coverage']:.3f}"
+    )
+    for row in sorted(results["configurations"], key=lambda row: row["ndcg"], reverse=True):
+        print(
+            f"{row['algorithm']:>4} k={row['components']:<4} cf={row['cfWeight']:.2f} cb={row['cbWeight']:.2f}  "
+            f"P@{args.top_n} {row['precision']:.4f}  R@{args.top_n} {row['recall']:.4f}  NDCG {row['ndcg']:.4f}  "
+            f"coverage {row['coverage']:.3f}  fit {row['fitSeconds']:.2f}s  "
+            f"rank {row['usersPerCpuSecond'] or 0:.0f} users/cpu-s  factors {row['factorMb']:.1f}MB  "
+            f"peak {max(row['fitPeakMb'], row['scoringPeakMb']):.1f}MB"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            json.dump({
+                "generatedAt": datetime.now(timezone.utc).isoformat(),
+                "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+                "split": split.counts,
+                **results,
+            }, handle, indent=2, default=str)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,315 @@
+import os
+import queue
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+
+from caches import PIPELINE_STATE, RECOMMENDATION_CACHE, SEARCH_PROFILE_CACHE
+from jobs import build_lock
+from settings import INTERACTION_WEIGHTS, LOGGER
+from store import (
+    extract_purchase_weight,
+    fetch_user_history,
+    get_database,
+    interaction_weight,
+    normalize_user_identifier,
+    safe_float,
+    save_serving_version,
+)
+
+EVENT_QUEUE_SIZE = int(os.getenv("RECOMMENDATION_EVENT_QUEUE_SIZE", 100000))
+EVENT_BATCH_SIZE = int(os.getenv("RECOMMENDATION_EVENT_BATCH_SIZE", 5000))
+EVENT_BATCH_WINDOW = float(os.getenv("RECOMMENDATION_EVENT_BATCH_WINDOW", 0.5))
+EVENT_VECTOR_CACHE_SIZE = int(os.getenv("RECOMMENDATION_EVENT_VECTOR_CACHE_SIZE", 50000))
+EVENT_VECTOR_TTL = float(os.getenv("RECOMMENDATION_EVENT_VECTOR_TTL", 600))
+
+
+def parse_event(event):
+    """(userId, bookId, weight) signals for one posted event, weighted like the stored documents."""
+    if not isinstance(event, dict):
+        raise ValueError("event must be an object")
+    user_id = normalize_user_identifier(event.get("userId"))
+    if not user_id:
+        raise ValueError("userId is required")
+    interaction_type = (event.get("interactionType") or event.get("type") or "").lower()
+    if interaction_type not in INTERACTION_WEIGHTS and interaction_type != "review":
+        raise ValueError(f"unsupported interactionType {interaction_type!r}")
+
+    if interaction_type == "order" and event.get("products"):
+        if event.get("completed") is False:
+            return []
+        lines = [
+            (str(product["productId"]), extract_purchase_weight(product))
+            for product in event["products"]
+            if isinstance(product, dict) and product.get("productId")
+        ]
+        return [(user_id, book_id, weight) for book_id, weight in lines if weight > 0]
+
+    book_id = event.get("bookId") or event.get("productId")
+    if not book_id:
+        raise ValueError("bookId is required")
+    if interaction_type == "review":
+        # a stored review counts its rating, whatever the weight of a bare rating interaction
+        rating = safe_float(event.get("rating"), None)
+        if rating is None:
+            raise ValueError("rating is required")
+        return [(user_id, str(book_id), rating)] if rating > 0 else []
+    weight = interaction_weight({**event, "interactionType": interaction_type})
+    return [(user_id, str(book_id), float(weight))] if weight > 0 else []
+
+
+class UserVectorCache:
+    """Per-book signal sums of recently active users, seeded from Mongo and advanced by later events."""
+
+    def __init__(self, capacity=EVENT_VECTOR_CACHE_SIZE, ttl=EVENT_VECTOR_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.fitted_at = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def reset(self, fitted_at):
+        # a rebuild re-reads everything and may move the strength range, so vectors of the old model are dropped
+        with self._lock:
+            if fitted_at != self.fitted_at:
+                self._entries.clear()
+                self.fitted_at = fitted_at
+
+    def invalidate(self, user_ids=None):
+        with self._lock:
+            if user_ids is None:
+                self._entries.clear()
+                return
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def missing(self, user_ids):
+        now = time.monotonic()
+        with self._lock:
+            return [
+                user_id for user_id in user_ids
+                if user_id not in self._entries or self._entries[user_id][2] < now
+            ]
+
+    def seed(self, user_id, vector, seeded_at):
+        with self._lock:
+            self._entries[user_id] = (vector, seeded_at, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def add(self, user_id, book_id, weight, received_at):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or received_at <= entry[1]:
+                return False
+            entry[0][book_id] = entry[0].get(book_id, 0.0) + weight
+            self._entries.move_to_end(user_id)
+            return True
+
+    def frame(self, user_ids, strength_range):
+        """Interaction frame and signal counts of ``user_ids`` in the layout the scoring stages consume."""
+        import numpy as np
+        import pandas as pd
+
+        from scoring import interaction_strength
+
+        users, books, values = [], [], []
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._entries.get(user_id)
+                if entry is None:
+                    continue
+                for book_id, value in entry[0].items():
+                    users.append(user_id)
+                    books.append(book_id)
+                    values.append(value)
+        interaction_df = pd.DataFrame({
+            "userId": users,
+            "productId": books,
+            "weight": interaction_strength(np.asarray(values, dtype=float), strength_range),
+        })
+        return interaction_df, Counter(users)
+
+
+class EventIngestor:
+    """Bounded queue of interaction events, drained by one worker in micro-batches that rescore only the users hit."""
+
+    def __init__(self, max_events=EVENT_QUEUE_SIZE, batch_size=EVENT_BATCH_SIZE, window=EVENT_BATCH_WINDOW):
+        self.batch_size = batch_size
+        self.window = window
+        self.vectors = UserVectorCache()
+        self.stats = Counter()
+        self.last_batch = None
+        self._queue = queue.Queue(maxsize=max_events)
+        self._lock = threading.Lock()
+        self._worker = None
+        # users scored while a build held the lock, written by a later batch
+        self._pending = set()
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def submit(self, signals):
+        """Queue parsed signals; returns how many fit before the queue was full."""
+        received_at = time.monotonic()
+        accepted = 0
+        for signal in signals:
+            try:
+                self._queue.put_nowait((*signal, received_at))
+            except queue.Full:
+                break
+            accepted += 1
+        with self._lock:
+            self.stats["accepted"] += accepted
+            self.stats["dropped"] += len(signals) - accepted
+            if accepted and (self._worker is None or not self._worker.is_alive()):
+                self._worker = threading.Thread(target=self._run, name="recommendation-events", daemon=True)
+                self._worker.start()
+        return accepted
+
+    def join(self):
+        """Block until every queued event has been processed; writes held by a running build may still be pending."""
+        self._queue.join()
+
+    def _drain(self):
+        try:
+            # held writes are retried every window, even when no new events arrive
+            batch = [self._queue.get(timeout=self.window if self._pending else None)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._drain()
+            try:
+                self.process(batch)
+            except Exception:
+                LOGGER.exception("Failed to apply a batch of %s recommendation events", len(batch))
+                with self._lock:
+                    self.stats["failedBatches"] += 1
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def process(self, batch, db=None):
+        return self._rescore(batch, db if db is not None else get_database())
+
+    def _rescore(self, batch, db):
+        import numpy as np
+
+        from artifacts import get_model_state
+        from pipeline import upsert_recommendations
+        from scoring import build_interactions, cf_algorithm, compute_content_scores, fold_in_collaborative_scores
+
+        started_at = time.perf_counter()
+        live = get_model_state(db)
+        if live is None:
+            # the events are in Mongo already; the first build picks them up
+            with self._lock:
+                self.stats["deferred"] += len(batch)
+            return 0
+        # scoring reads this snapshot without the build lock, so a running build does not back the queue up
+        state = dict(live)
+
+        self.vectors.reset(state["fittedAt"])
+        user_registry = state["user_registry"]
+        batch = [(user_registry.resolve(user_id), *rest) for user_id, *rest in batch]
+        with self._lock:
+            # users whose write waited for a build are scored again, against whatever model is live now
+            user_ids = sorted(self._pending.union(user_id for user_id, *_ in batch))
+
+        missing = self.vectors.missing(user_ids)
+        if missing:
+            seeded_at = time.monotonic()
+            interactions, reviews, orders = fetch_user_history(db, missing, user_registry)
+            table = build_interactions(interactions, reviews, orders, user_registry).subset(missing)
+            vectors = {user_id: {} for user_id in missing}
+            rows = np.repeat(np.arange(table.raw.shape[0]), np.diff(table.raw.indptr))
+            for row, column, value in zip(rows, table.raw.indices, table.raw.data):
+                vectors[table.user_ids[row]][table.book_ids[column]] = float(value)
+            for user_id, vector in vectors.items():
+                self.vectors.seed(user_id, vector, seeded_at)
+
+        applied = sum(
+            self.vectors.add(user_id, book_id, weight, received_at)
+            for user_id, book_id, weight, received_at in batch
+        )
+        interaction_df, signal_counts = self.vectors.frame(user_ids, state["strength_range"])
+        cb_scores, consumed_index = compute_content_scores(
+            state["books_df"],
+            interaction_df,
+            book_matrix=state["book_matrix"]
+        )
+        cf_scores = fold_in_collaborative_scores(
+            interaction_df,
+            state["item_factors_df"],
+            consumed_index=consumed_index,
+            algorithm=cf_algorithm(state)
+        )
+
+        # builds swap the model and rewrite documents under this lock, so only the write waits for it
+        with build_lock(blocking=False) as acquired:
+            held = not acquired or PIPELINE_STATE.get("model") is not live
+            if held:
+                # a build is running or swapped the model since the snapshot: the write waits for the next batch
+                users_updated = 0
+            else:
+                top_n, cf_weight, cb_weight = state["params"]
+                users_updated = upsert_recommendations(
+                    db=db,
+                    top_n=top_n,
+                    cf_weight=cf_weight,
+                    cb_weight=cb_weight,
+                    books_df=state["books_df"],
+                    cf_scores=cf_scores,
+                    cb_scores=cb_scores,
+                    consumed_index=consumed_index,
+                    user_registry=user_registry,
+                    user_signal_counts=signal_counts,
+                    popularity_ids=state["popularity_ids"],
+                    user_ids=user_ids,
+                    trending=state.get("trending")
+                )
+        with self._lock:
+            self._pending = set(user_ids) if held else set()
+        if not held:
+            RECOMMENDATION_CACHE.invalidate(user_ids)
+            SEARCH_PROFILE_CACHE.invalidate(user_ids)
+            if users_updated:
+                save_serving_version(db)
+
+        with self._lock:
+            self.stats["processed"] += len(batch)
+            self.stats["applied"] += applied
+            self.stats["heldBatches" if held else "batches"] += 1
+            self.stats["usersRescored"] += users_updated
+            if batch and not held:
+                oldest = min(received_at for *_, received_at in batch)
+                self.last_batch = {
+                    "events": len(batch),
+                    "users": len(user_ids),
+                    "seededUsers": len(missing),
+                    "seconds": round(time.perf_counter() - started_at, 3),
+                    # queueing plus processing delay of the oldest event in the batch
+                    "freshnessSeconds": round(time.monotonic() - oldest, 3),
+                    "finishedAt": datetime.now(timezone.utc).isoformat(),
+                }
+        return users_updated
+
+EVENT_INGESTOR = EventIngestor()
@@ -0,0 +1,375 @@
+import importlib.util
+import os
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+from pymongo.errors import PyMongoError
+
+from caches import RECOMMENDATION_CACHE, SERVING_CACHE
+from settings import LOGGER, MODEL_DIR
+
+# advisory locks are POSIX only; elsewhere builds are serialized within the process
+fcntl_spec = importlib.util.find_spec("fcntl")
+fcntl = None
+if fcntl_spec:
+    fcntl = importlib.import_module("fcntl")
+
+resource_spec = importlib.util.find_spec("resource")
+resource = None
+if resource_spec:
+    resource = importlib.import_module("resource")
+
+RUNS_COLLECTION = "recommendation_runs"
+BUILD_LOCK_PATH = Path(os.getenv("RECOMMENDATION_BUILD_LOCK", MODEL_DIR / ".build.lock"))
+JOB_HISTORY_SIZE = int(os.getenv("RECOMMENDATION_JOB_HISTORY", 100))
+PIPELINE_LOCK = threading.Lock()
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is reported in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def current_rss_bytes():
+    try:
+        with open("/proc/self/statm", encoding="ascii") as handle:
+            return int(handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        peak = peak_rss_mb()
+        return int(peak * 2**20) if peak is not None else 0
+
+
+class StageTracker:
+    """Ordered record of the stages a build went through, safe to read from other threads."""
+
+    def __init__(self):
+        self._stages = []
+        self._lock = threading.Lock()
+
+    def begin(self, name):
+        with self._lock:
+            self._close("completed")
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            self._stages.append({
+                "name": name,
+                "status": "running",
+                "startedAt": datetime.now(timezone.utc).isoformat(),
+                "finishedAt": None,
+                "counts": {},
+                "_started": time.perf_counter(),
+                "_cpu": time.process_time(),
+                "_traced": tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None,
+            })
+
+    def record(self, **counts):
+        with self._lock:
+            if self._stages:
+                self._stages[-1]["counts"].update({key: int(value) for key, value in counts.items()})
+
+    def end(self, status="completed"):
+        with self._lock:
+            self._close(status)
+
+    def _close(self, status):
+        if self._stages and self._stages[-1]["status"] == "running":
+            stage = self._stages[-1]
+            stage["status"] = status
+            stage["finishedAt"] = datetime.now(timezone.utc).isoformat()
+            stage["durationSeconds"] = round(time.perf_counter() - stage["_started"], 3)
+            stage["cpuSeconds"] = round(time.process_time() - stage["_cpu"], 3)
+            stage["peakRssMb"] = peak_rss_mb()
+            if stage["_traced"] is not None and tracemalloc.is_tracing():
+                stage["allocatedPeakMb"] = round((tracemalloc.get_traced_memory()[1] - stage["_traced"]) / 2**20, 1)
+
+    @property
+    def current(self):
+        with self._lock:
+            if self._stages and self._stages[-1]["status"] == "running":
+                return self._stages[-1]["name"]
+            return None
+
+    def snapshot(self):
+        with self._lock:
+            return [{key: value for key, value in stage.items() if not key.startswith("_")} for stage in self._stages]
+
+
+class PipelineMetrics:
+    """Process-wide counters for the /metrics endpoint in the Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._runs = defaultdict(int)
+        self._stage_seconds = defaultdict(float)
+        self._stage_last = {}
+        self._last_run = {}
+
+    def observe(self, mode, status, stages, users_updated=0):
+        with self._lock:
+            self._runs[(mode, status)] += 1
+            for stage in stages:
+                if "durationSeconds" in stage:
+                    self._stage_seconds[stage["name"]] += stage["durationSeconds"]
+                    self._stage_last[stage["name"]] = stage["durationSeconds"]
+            self._last_run = {
+                "timestamp": time.time(),
+                "seconds": sum(stage.get("durationSeconds", 0.0) for stage in stages),
+                "users": users_updated,
+            }
+
+    def render(self, event_ingestor):
+        lines = []
+
+        def metric(name, kind, description, samples):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        with self._lock:
+            metric(
+                "recommendation_pipeline_runs_total",
+                "counter",
+                "Recommendation builds by mode and outcome.",
+                [((("mode", mode), ("status", status)), count) for (mode, status), count in sorted(self._runs.items())]
+            )
+            metric(
+                "recommendation_pipeline_stage_seconds_total",
+                "counter",
+                "Wall time spent per pipeline stage.",
+                [((("stage", name),), round(value, 3)) for name, value in sorted(self._stage_seconds.items())]
+            )
+            metric(
+                "recommendation_pipeline_stage_last_seconds",
+                "gauge",
+                "Wall time of each stage in its most recent run.",
+                [((("stage", name),), value) for name, value in sorted(self._stage_last.items())]
+            )
+            if self._last_run:
+                metric(
+                    "recommendation_pipeline_last_run_timestamp_seconds",
+                    "gauge",
+                    "Unix time the last build finished.",
+                    [((), round(self._last_run["timestamp"], 3))]
+                )
+                metric(
+                    "recommendation_pipeline_last_run_seconds",
+                    "gauge",
+                    "Wall time of the last build.",
+                    [((), round(self._last_run["seconds"], 3))]
+                )
+                metric(
+                    "recommendation_pipeline_last_run_users",
+                    "gauge",
+                    "Recommendation documents produced by the last build.",
+                    [((), self._last_run["users"])]
+                )
+        metric(
+            "recommendation_cache_entries",
+            "gauge",
+            "Entries held by the online recommendation cache.",
+            [((), len(RECOMMENDATION_CACHE))]
+        )
+        metric(
+            "recommendation_serving_cache_entries",
+            "gauge",
+            "Users held by the hydrated serving cache.",
+            [((), len(SERVING_CACHE))]
+        )
+        event_stats = event_ingestor.stats
+        metric(
+            "recommendation_events_total",
+            "counter",
+            "Ingested interaction events by outcome.",
+            [
+                ((("outcome", outcome),), event_stats[outcome])
+                for outcome in ("accepted", "dropped", "processed", "applied", "deferred")
+            ]
+        )
+        metric(
+            "recommendation_event_batches_total",
+            "counter",
+            "Event micro-batches by outcome.",
+            [
+                ((("status", "succeeded"),), event_stats["batches"]),
+                ((("status", "held"),), event_stats["heldBatches"]),
+                ((("status", "failed"),), event_stats["failedBatches"]),
+            ]
+        )
+        metric(
+            "recommendation_event_users_rescored_total",
+            "counter",
+            "Users rescored by event micro-batches.",
+            [((), event_stats["usersRescored"])]
+        )
+        metric(
+            "recommendation_event_queue_depth",
+            "gauge",
+            "Events waiting for the next micro-batch.",
+            [((), len(event_ingestor))]
+        )
+        last_batch = event_ingestor.last_batch
+        if last_batch:
+            metric(
+                "recommendation_event_freshness_seconds",
+                "gauge",
+                "Delay between receiving the oldest event of the last batch and its users being rescored.",
+                [((), last_batch["freshnessSeconds"])]
+            )
+        peak_rss = peak_rss_mb()
+        if peak_rss is not None:
+            metric(
+                "recommendation_process_peak_rss_megabytes",
+                "gauge",
+                "Peak resident set size of the service process.",
+                [((), peak_rss)]
+            )
+        return "\n".join(lines) + "\n"
+
+
+PIPELINE_METRICS = PipelineMetrics()
+
+
+def record_run(db, run):
+    try:
+        db[RUNS_COLLECTION].insert_one(dict(run))
+    except PyMongoError:
+        LOGGER.exception("Failed to record recommendation run")
+
+
+@contextmanager
+def build_lock(path=BUILD_LOCK_PATH, blocking=True):
+    """Single-writer lock: one build per process, and one per host when flock is available.
+
+    Yields whether the lock is held; with ``blocking=False`` that is False when another writer has it.
+    """
+    if not PIPELINE_LOCK.acquire(blocking):
+        yield False
+        return
+    try:
+        if fcntl is None:
+            yield True
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a") as handle:
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+    finally:
+        PIPELINE_LOCK.release()
+
+
+def _merge_build_params(queued, incoming):
+    # the follow-up run must cover every trigger folded into it, and stay within the tightest budget asked for
+    budgets = [params.get("memory_budget") for params in (queued, incoming) if params.get("memory_budget") is not None]
+    return {
+        **incoming,
+        "memory_budget": min(budgets) if budgets else None,
+        "report": queued["report"] or incoming["report"],
+        "profile": queued.get("profile", False) or incoming.get("profile", False),
+        "mode": "full" if "full" in (queued["mode"], incoming["mode"]) else "incremental",
+    }
+
+
+class BuildJobQueue:
+    """Single-worker build queue; triggers arriving while a build is queued fold into that build."""
+
+    def __init__(self, runner, history=JOB_HISTORY_SIZE):
+        self._runner = runner
+        self._jobs = OrderedDict()
+        self._history = history
+        self._queued = None
+        self._condition = threading.Condition()
+        self._worker = None
+
+    def submit(self, params):
+        with self._condition:
+            job = self._queued
+            if job is None:
+                job = {
+                    "jobId": uuid.uuid4().hex,
+                    "status": "queued",
+                    "params": dict(params),
+                    "triggers": 1,
+                    "createdAt": datetime.now(timezone.utc).isoformat(),
+                    "startedAt": None,
+                    "finishedAt": None,
+                    "result": None,
+                    "error": None,
+                    "_tracker": StageTracker(),
+                    "_done": threading.Event(),
+                }
+                self._jobs[job["jobId"]] = job
+                self._queued = job
+                self._trim()
+            else:
+                job["params"] = _merge_build_params(job["params"], params)
+                job["triggers"] += 1
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="recommendation-build", daemon=True)
+                self._worker.start()
+            self._condition.notify()
+            return job["jobId"]
+
+    def get(self, job_id):
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            view = {key: value for key, value in job.items() if not key.startswith("_")}
+            view["params"] = dict(job["params"])
+        tracker = job["_tracker"]
+        view["stage"] = tracker.current
+        view["stages"] = tracker.snapshot()
+        return view
+
+    def wait(self, job_id, timeout=None):
+        with self._condition:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            job["_done"].wait(timeout)
+        return self.get(job_id)
+
+    def _trim(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job["_done"].is_set()]
+        for job_id in finished[:max(len(self._jobs) - self._history, 0)]:
+            del self._jobs[job_id]
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._queued is None:
+                    self._condition.wait()
+                job = self._queued
+                self._queued = None
+                job["status"] = "running"
+                job["startedAt"] = datetime.now(timezone.utc).isoformat()
+                params = dict(job["params"])
+
+            try:
+                result = self._runner(**params, tracker=job["_tracker"])
+            except Exception as exc:
+                LOGGER.exception("Recommendation build %s failed", job["jobId"])
+                outcome = {"status": "failed", "error": str(exc)}
+            else:
+                outcome = {"status": "succeeded", "result": result}
+
+            with self._condition:
+                job.update(outcome)
+                job["finishedAt"] = datetime.now(timezone.utc).isoformat()
+                job["_done"].set()
@@ -0,0 +1,897 @@
+import cProfile
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+import time
+import tracemalloc
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from scipy import sparse
+
+from artifacts import book_fingerprint, get_model_state, save_model_artifacts, sync_catalog
+from caches import PIPELINE_STATE, RECOMMENDATION_CACHE, SEARCH_PROFILE_CACHE, SERVING_CACHE
+from events import EVENT_INGESTOR
+from jobs import PIPELINE_METRICS, StageTracker, build_lock, peak_rss_mb, record_run
+from planner import DEFAULT_PLAN, MEMORY_BUDGET, megabytes, parse_memory_budget, plan_execution, plan_workload
+from scoring import (
+    CF_ALGORITHM,
+    VECTORIZER_MODE,
+    TrendingIndex,
+    build_book_matrix,
+    build_interaction_matrix_from_long,
+    build_interactions,
+    build_popularity_ranking,
+    build_user_item_matrix,
+    cf_algorithm,
+    collaborative_score_matrix,
+    compute_collaborative_scores,
+    compute_content_scores,
+    content_score_matrix,
+    fold_in_collaborative_scores,
+    generate_console_report,
+    interaction_weights_frame,
+    prepare_books_dataframe,
+    rank_recommendations,
+    round_score,
+    trending_events,
+    vectorizer_kind,
+    warm_start_factors,
+)
+from search import SearchIndex
+from settings import LOGGER, MODEL_DIR, RANKING_CHUNK_SIZE, SHARD_WORKERS, WRITE_BATCH_SIZE, WRITE_WORKERS
+from similarity import SimilarityIndex, upsert_similar_books
+from store import (
+    WATERMARK_COLLECTIONS,
+    UserRegistry,
+    attempt_object_id,
+    compute_watermark,
+    fetch_book_references,
+    fetch_changed_documents,
+    fetch_collections,
+    fetch_user_history,
+    get_database,
+    has_changes,
+    load_watermark,
+    normalize_user_identifier,
+    read_interaction_columns,
+    read_order_columns,
+    resolve_order_user,
+    save_serving_version,
+    save_watermark,
+)
+
+REFIT_COLLECTIONS = ("author", "genre")
+FULL_REBUILD_INTERVAL = int(os.getenv("RECOMMENDATION_FULL_REBUILD_INTERVAL", 3600))
+INCREMENTAL_MAX_USER_RATIO = float(os.getenv("RECOMMENDATION_INCREMENTAL_MAX_USER_RATIO", 0.25))
+WRITE_SIMILAR_BOOKS = os.getenv("RECOMMENDATION_WRITE_SIMILAR_BOOKS", "false").lower() in ("1", "true", "yes", "on")
+TRACE_MEMORY = os.getenv("RECOMMENDATION_TRACE_MEMORY", "false").lower() in ("1", "true", "yes", "on")
+PROFILE_DIR = Path(os.getenv("RECOMMENDATION_PROFILE_DIR", MODEL_DIR.parent / "profiles"))
+
+
+def _candidate_users(user_registry, cf_scores, cb_scores):
+    candidate_users = set(user_registry.primary_ids())
+    candidate_users.update(cf_scores.index if not cf_scores.empty else [])
+    candidate_users.update(cb_scores.index if not cb_scores.empty else [])
+    return candidate_users
+
+
+def upsert_recommendations(
+    db,
+    top_n,
+    cf_weight,
+    cb_weight,
+    books_df,
+    cf_scores,
+    cb_scores,
+    consumed_index,
+    user_registry,
+    user_signal_counts,
+    popularity_ids,
+    user_ids=None,
+    chunk_size=RANKING_CHUNK_SIZE,
+    trending=None
+):
+    rec_collection = db.recommendation
+    now = datetime.now(timezone.utc)
+
+    candidate_users = set(user_ids) if user_ids is not None else _candidate_users(user_registry, cf_scores, cb_scores)
+    candidate_users.discard(None)
+    candidate_users.discard("")
+    LOGGER.info("Preparing recommendations for %s users", len(candidate_users))
+
+    # rank straight into the catalog's ObjectIds instead of parsing one per score row
+    book_refs = books_df["bookRef"].tolist()
+    ref_by_id = dict(zip(books_df["bookId"], book_refs))
+    ranked_users = rank_recommendations(
+        sorted(candidate_users),
+        book_refs,
+        cf_scores,
+        cb_scores,
+        consumed_index,
+        top_n,
+        cf_weight,
+        cb_weight,
+        chunk_size=chunk_size
+    )
+
+    prepared = written = 0
+    failures = []
+    pending = deque()
+    batch = []
+
+    def collect(future):
+        nonlocal written
+        error = future.exception()
+        if error is not None:
+            failures.append(error)
+        else:
+            written += future.result()
+
+    with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as executor:
+        for user_id, recommendation_method, fallback_reason, ranked in ranked_users:
+            if ranked:
+                chosen_refs = [ref for ref, _, _, _ in ranked]
+                score_rows = [{
+                    "productId": ref,
+                    "hybridScore": round_score(hybrid_score),
+                    "cfScore": round_score(cf_score),
+                    "cbScore": round_score(cb_score)
+                } for ref, hybrid_score, cf_score, cb_score in ranked]
+            else:
+                if trending is not None:
+                    consumed = consumed_index.books(user_id) if consumed_index is not None else ()
+                    chosen_ids = trending.fallback(consumed, top_n)
+                else:
+                    chosen_ids = popularity_ids[:top_n]
+                chosen_refs = [ref_by_id.get(bid) or ObjectId(bid) for bid in chosen_ids]
+                score_rows = [{
+                    "productId": ref,
+                    "hybridScore": None,
+                    "cfScore": None,
+                    "cbScore": None
+                } for ref in chosen_refs]
+
+            mongo_user_id = user_registry.user_ref(user_id) or attempt_object_id(user_id)
+            if mongo_user_id is None:
+                LOGGER.warning("Skipping user %s due to missing ObjectId reference", user_id)
+                continue
+
+            total_signals = int(user_signal_counts.get(user_id, 0))
+            doc = {
+                "userId": mongo_user_id,
+                "userRef": mongo_user_id,
+                "recommendedProductIds": chosen_refs,
+                "recommendationMethod": recommendation_method,
+                "scores": score_rows,
+                "metadata": {
+                    "totalSignals": total_signals,
+                    "generatedAt": now,
+                    "fallbackReason": fallback_reason,
+                    "contentHash": _recommendation_hash(
+                        recommendation_method,
+                        fallback_reason,
+                        total_signals,
+                        score_rows
+                    )
+                },
+                "updatedAt": now
+            }
+            batch.append(doc)
+            prepared += 1
+
+            if len(batch) >= WRITE_BATCH_SIZE:
+                # scoring of the next chunk overlaps with the writes already in flight
+                pending.append(executor.submit(_write_recommendation_batch, rec_collection, batch))
+                batch = []
+                while len(pending) > 2 * WRITE_WORKERS:
+                    collect(pending.popleft())
+
+        if batch:
+            pending.append(executor.submit(_write_recommendation_batch, rec_collection, batch))
+        while pending:
+            collect(pending.popleft())
+
+    if not prepared:
+        LOGGER.warning("No recommendation updates were generated.")
+        return 0
+    LOGGER.info(
+        "Wrote %s recommendation documents, %s unchanged",
+        written,
+        prepared - written
+    )
+    if failures:
+        raise failures[0]
+    return prepared
+
+
+def _recommendation_hash(recommendation_method, fallback_reason, total_signals, score_rows):
+    payload = [recommendation_method, fallback_reason, total_signals, [
+        [str(row["productId"]), row["hybridScore"], row["cfScore"], row["cbScore"]] for row in score_rows
+    ]]
+    return hashlib.sha1(json.dumps(payload).encode("utf-8")).hexdigest()
+
+
+def _write_recommendation_batch(collection, batch):
+    previous = {
+        existing["userId"]: existing.get("metadata", {}).get("contentHash")
+        for existing in collection.find(
+            {"userId": {"$in": [doc["userId"] for doc in batch]}},
+            {"userId": 1, "metadata.contentHash": 1}
+        )
+    }
+    changed = [doc for doc in batch if previous.get(doc["userId"]) != doc["metadata"]["contentHash"]]
+    if not changed:
+        return 0
+    updates = [UpdateOne({"userId": doc["userId"]}, {"$set": doc}, upsert=True) for doc in changed]
+    try:
+        collection.bulk_write(updates, ordered=False)
+    except BulkWriteError as error:
+        # unordered batches keep going past a failed document; report what did not land
+        LOGGER.error(
+            "Recommendation batch had %s write errors out of %s",
+            len(error.details.get("writeErrors", [])),
+            len(updates)
+        )
+        raise
+    finally:
+        # part of an unordered batch may have landed even when it raised
+        SERVING_CACHE.invalidate([str(doc["userId"]) for doc in changed])
+    return len(updates)
+
+
+_SHARD_CONTEXT = {}
+
+
+def _shard_of(user_id, shards):
+    # crc32 rather than hash() so the partition is stable across processes and runs
+    return zlib.crc32(str(user_id).encode("utf-8")) % shards
+
+
+def _init_shard_worker(shared_dir):
+    shared_dir = Path(shared_dir)
+    context = pickle.loads((shared_dir / "context.pkl").read_bytes())
+
+    def load_array(name):
+        return np.load(shared_dir / f"{name}.npy", mmap_mode="r")
+
+    def load_csr(name):
+        return sparse.csr_matrix(
+            (load_array(f"{name}_data"), load_array(f"{name}_indices"), load_array(f"{name}_indptr")),
+            shape=tuple(context["shapes"][name]),
+            copy=False
+        )
+
+    context.update({
+        "book_matrix": load_csr("book_matrix"),
+        "weights": load_csr("weights"),
+        "item_features": load_array("item_features") if context["collaborative"] else None,
+        "user_features": load_array("user_features") if context["collaborative"] else None,
+        "positions": {user_id: position for position, user_id in enumerate(context["user_ids"])},
+        "books_df": pd.DataFrame({
+            "bookId": context["book_ids"],
+            "bookRef": [ObjectId(book_id) for book_id in context["book_ids"]],
+        }),
+    })
+    _SHARD_CONTEXT.update(context)
+
+
+def _run_shard(shard, user_ids, user_registry, user_signal_counts, connect=get_database):
+    context = _SHARD_CONTEXT
+    started_at, cpu_started_at = time.perf_counter(), time.process_time()
+    positions = context["positions"]
+    rows = np.array(sorted(positions[user_id] for user_id in user_ids if user_id in positions), dtype=np.int64)
+    shard_users = [context["user_ids"][row] for row in rows]
+    book_ids = context["book_ids"]
+
+    # rows of the shared interaction matrix score exactly as they would in the single-process run
+    plan = context["plan"]
+    cb_scores, consumed_index = content_score_matrix(
+        context["weights"][rows],
+        shard_users,
+        context["book_matrix"],
+        book_ids,
+        plan=plan
+    )
+    cf_scores = pd.DataFrame()
+    if context["collaborative"] and len(rows):
+        cf_scores = collaborative_score_matrix(
+            shard_users,
+            book_ids,
+            np.asarray(context["user_features"][rows]),
+            context["item_features"],
+            consumed_index,
+            dtype=plan.float_type
+        )
+    users_updated = upsert_recommendations(
+        db=connect(),
+        top_n=context["top_n"],
+        cf_weight=context["cf_weight"],
+        cb_weight=context["cb_weight"],
+        books_df=context["books_df"],
+        cf_scores=cf_scores,
+        cb_scores=cb_scores,
+        consumed_index=consumed_index,
+        user_registry=user_registry,
+        user_signal_counts=user_signal_counts,
+        popularity_ids=context["popularity_ids"],
+        user_ids=user_ids,
+        chunk_size=plan.chunk_size,
+        trending=context["trending"]
+    )
+    return {
+        "shard": shard,
+        "pid": os.getpid(),
+        "users": len(user_ids),
+        "usersUpdated": users_updated,
+        "seconds": round(time.perf_counter() - started_at, 3),
+        "cpuSeconds": round(time.process_time() - cpu_started_at, 3),
+        "peakRssMb": peak_rss_mb(),
+    }
+
+
+def upsert_recommendations_sharded(
+    top_n,
+    cf_weight,
+    cb_weight,
+    book_ids,
+    interactions,
+    book_matrix,
+    user_features,
+    item_features,
+    candidate_users,
+    user_registry,
+    user_signal_counts,
+    popularity_ids,
+    trending=None,
+    workers=SHARD_WORKERS,
+    plan=DEFAULT_PLAN,
+    connect=get_database
+):
+    """Score and write recommendations from ``workers`` processes; ``connect`` opens each worker's database."""
+    shards = [[] for _ in range(workers)]
+    for user_id in sorted(candidate_users):
+        shards[_shard_of(user_id, workers)].append(user_id)
+
+    shared_dir = MODEL_DIR / f".shards-{uuid.uuid4().hex}"
+    shared_dir.mkdir(parents=True)
+    try:
+        arrays = {
+            "book_matrix_data": book_matrix.data,
+            "book_matrix_indices": book_matrix.indices,
+            "book_matrix_indptr": book_matrix.indptr,
+            "weights_data": interactions.matrix.data,
+            "weights_indices": interactions.matrix.indices,
+            "weights_indptr": interactions.matrix.indptr,
+        }
+        if user_features is not None:
+            arrays["user_features"] = user_features
+            arrays["item_features"] = item_features
+        for name, values in arrays.items():
+            np.save(shared_dir / f"{name}.npy", np.ascontiguousarray(values))
+        context = {
+            "book_ids": list(book_ids),
+            "user_ids": list(interactions.user_ids),
+            "shapes": {"book_matrix": book_matrix.shape, "weights": interactions.matrix.shape},
+            "collaborative": user_features is not None,
+            "top_n": top_n,
+            "cf_weight": cf_weight,
+            "cb_weight": cb_weight,
+            "popularity_ids": popularity_ids,
+            "trending": trending,
+            "plan": plan,
+        }
+        (shared_dir / "context.pkl").write_bytes(pickle.dumps(context, protocol=pickle.HIGHEST_PROTOCOL))
+
+        results, failures = [], []
+        # spawn, not fork: the parent runs Flask and job threads and holds pooled Mongo connections
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_shard_worker,
+            initargs=(str(shared_dir),)
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _run_shard,
+                    shard,
+                    users,
+                    user_registry.subset(users),
+                    {user_id: user_signal_counts[user_id] for user_id in users if user_id in user_signal_counts},
+                    connect
+                )
+                for shard, users in enumerate(shards)
+                if users
+            ]
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as error:
+                    LOGGER.error("Recommendation shard failed: %s", error)
+                    failures.append(error)
+        if failures:
+            raise failures[0]
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+
+    LOGGER.info("Wrote recommendations for %s users from %s shards", sum(r["users"] for r in results), len(results))
+    return sum(result["usersUpdated"] for result in results), results
+
+
+def run_full_pipeline(db, top_n, cf_weight, cb_weight, report=False, tracker=None, memory_budget=None):
+    tracker = tracker or StageTracker()
+    tracker.begin("fetch")
+    books, interactions, reviews, users, authors, genres, orders, watermark = fetch_collections(db)
+    tracker.record(
+        books=len(books),
+        users=len(users),
+        interactions=len(interactions["userId"]),
+        reviews=len(reviews["userId"]),
+        orderLines=len(orders["productId"])
+    )
+    tracker.begin("prepare")
+    books_df = prepare_books_dataframe(books, authors, genres, reviews)
+    user_registry = UserRegistry(users)
+    interaction_table = build_interactions(interactions, reviews, orders, user_registry)
+    raw_interactions_df, normalized_interactions_df = interaction_table.frames()
+    interaction_df = interaction_weights_frame(normalized_interactions_df)
+    user_signal_counts = interaction_table.signal_counts()
+    tracker.record(books=len(books_df), userBookPairs=interaction_table.raw.nnz)
+
+    tracker.begin("content")
+    book_matrix, tfidf = build_book_matrix(books_df) if not books_df.empty else (None, None)
+    plan = plan_execution(memory_budget, plan_workload(interaction_table, books_df["bookId"], book_matrix, top_n))
+    if book_matrix is not None and book_matrix.dtype != plan.float_type:
+        book_matrix = book_matrix.astype(plan.float_type)
+    cb_scores, consumed_index = compute_content_scores(books_df, interaction_df, book_matrix=book_matrix, plan=plan)
+    tracker.record(vocabulary=book_matrix.shape[1] if book_matrix is not None else 0, users=len(cb_scores.index))
+    tracker.begin("collaborative")
+    previous_state = PIPELINE_STATE.get("model")
+    warm_start = warm_start_factors(previous_state)
+    cf_scores, interaction_matrix, user_factors_df, item_factors_df = compute_collaborative_scores(
+        interaction_df,
+        books_df["bookId"].tolist(),
+        consumed_index=consumed_index,
+        warm_start=warm_start,
+        plan=plan
+    )
+    cf_model = {
+        "algorithm": CF_ALGORITHM,
+        "generation": 0 if warm_start is None else previous_state["cf_model"]["generation"] + 1,
+    }
+    tracker.record(users=len(cf_scores.index), components=item_factors_df.shape[1], warmStart=int(warm_start is not None))
+    tracker.begin("similarity")
+    book_ids = books_df["bookId"].tolist()
+    similarity_index = SimilarityIndex.build(
+        book_ids,
+        book_matrix,
+        item_factors_df.reindex(book_ids).to_numpy(dtype=float) if not item_factors_df.empty else None,
+        chunk_size=plan.similarity_chunk_size
+    )
+    tracker.record(books=len(book_ids))
+    tracker.begin("search")
+    search_index = SearchIndex.build(books_df)
+    tracker.record(books=len(search_index), terms=search_index.terms, postings=search_index.postings_count)
+    popularity_ids = build_popularity_ranking(books_df)
+
+    if books_df.empty or not popularity_ids:
+        raise RuntimeError("No books/popularity data available; cannot generate recommendations.")
+
+    tracker.begin("trending")
+    trending = TrendingIndex.build(books_df, popularity_ids, trending_events(interactions, orders))
+    tracker.record(books=len(book_ids), events=len(interactions["productId"]) + len(orders["productId"]))
+
+    tracker.begin("write")
+    shard_results = None
+    if plan.shard_workers > 1:
+        interactions_matrix = build_user_item_matrix(interaction_df, book_ids)
+        users_updated, shard_results = upsert_recommendations_sharded(
+            top_n=top_n,
+            cf_weight=cf_weight,
+            cb_weight=cb_weight,
+            book_ids=book_ids,
+            interactions=interactions_matrix,
+            book_matrix=book_matrix,
+            user_features=(
+                user_factors_df.reindex(interactions_matrix.user_ids).to_numpy(dtype=float)
+                if not user_factors_df.empty else None
+            ),
+            item_features=item_factors_df.to_numpy(dtype=float) if not item_factors_df.empty else None,
+            candidate_users=_candidate_users(user_registry, cf_scores, cb_scores) - {None, ""},
+            user_registry=user_registry,
+            user_signal_counts=user_signal_counts,
+            popularity_ids=popularity_ids,
+            trending=trending,
+            workers=plan.shard_workers,
+            plan=plan
+        )
+        tracker.record(users=users_updated, shards=len(shard_results))
+    else:
+        users_updated = upsert_recommendations(
+            db=db,
+            top_n=top_n,
+            cf_weight=cf_weight,
+            cb_weight=cb_weight,
+            books_df=books_df,
+            cf_scores=cf_scores,
+            cb_scores=cb_scores,
+            consumed_index=consumed_index,
+            user_registry=user_registry,
+            user_signal_counts=user_signal_counts,
+            popularity_ids=popularity_ids,
+            chunk_size=plan.chunk_size,
+            trending=trending
+        )
+        tracker.record(users=users_updated)
+
+    if report:
+        tracker.begin("report")
+        generate_console_report(
+            books_df=books_df,
+            cb_scores=cb_scores,
+            cf_scores=cf_scores,
+            raw_interaction_matrix=build_interaction_matrix_from_long(raw_interactions_df, "raw_value"),
+            normalized_interactions=normalized_interactions_df,
+            interaction_matrix=interaction_matrix,
+            user_factors_df=user_factors_df,
+            item_factors_df=item_factors_df,
+            cf_weight=cf_weight,
+            cb_weight=cb_weight
+        )
+
+    tracker.begin("persist")
+    strength_range = interaction_table.value_range
+    state = {
+        "books_df": books_df,
+        "book_ids": book_ids,
+        "book_index": pd.Index(books_df["bookId"]),
+        "book_fingerprints": [book_fingerprint(raw) for raw in books_df["raw"]],
+        "book_matrix": book_matrix,
+        "tfidf": tfidf,
+        "item_factors_df": item_factors_df,
+        "user_factors_df": user_factors_df,
+        "cf_model": cf_model,
+        "similarity_index": similarity_index,
+        "search_index": search_index,
+        "strength_range": strength_range,
+        "popularity_ids": popularity_ids,
+        "trending": trending,
+        "user_registry": user_registry,
+        "params": (top_n, cf_weight, cb_weight),
+        "fittedAt": datetime.now(timezone.utc),
+    }
+    try:
+        state["version"] = save_model_artifacts(state)
+    except OSError:
+        LOGGER.exception("Failed to persist model artifacts to %s", MODEL_DIR)
+    PIPELINE_STATE["model"] = state
+    RECOMMENDATION_CACHE.invalidate()
+    SEARCH_PROFILE_CACHE.invalidate()
+    if shard_results is not None:
+        # shard workers write from other processes, so their per-user invalidations never reach this cache
+        SERVING_CACHE.invalidate()
+    save_watermark(db, watermark)
+    # other serving processes drop their caches on their next version check
+    save_serving_version(db)
+    if WRITE_SIMILAR_BOOKS:
+        tracker.begin("similar_books")
+        tracker.record(books=upsert_similar_books(db, state))
+    tracker.end()
+
+    summary = {
+        "mode": "full",
+        "usersUpdated": users_updated,
+        "modelVersion": state.get("version"),
+        "plan": plan.as_dict(),
+    }
+    if shard_results is not None:
+        summary["shards"] = shard_results
+    return summary
+
+
+def _incremental_fallback_reason(db, state, watermark, params):
+    if not state:
+        return "NoModelState"
+    if not watermark or any(name not in watermark for name in WATERMARK_COLLECTIONS):
+        return "NoWatermark"
+    if state["params"] != params:
+        return "ParamsChanged"
+    if state["book_matrix"] is None:
+        return "NoContentModel"
+    if vectorizer_kind(state["tfidf"]) != ("hashing" if VECTORIZER_MODE == "hashing" else "tfidf"):
+        return "VectorizerChanged"
+    if not state["item_factors_df"].empty and cf_algorithm(state) != CF_ALGORITHM:
+        return "AlgorithmChanged"
+    model_age = (datetime.now(timezone.utc) - state["fittedAt"]).total_seconds()
+    if model_age > FULL_REBUILD_INTERVAL:
+        return "ModelExpired"
+    if has_changes(db, watermark, REFIT_COLLECTIONS):
+        return "CatalogChanged"
+    return None
+
+
+def _apply_book_changes(db, state, changed_books):
+    authors, genres = fetch_book_references(db, changed_books)
+    changed_df = prepare_books_dataframe(changed_books, authors, genres, None)
+    changed_by_id = {row["bookId"]: row for row in changed_df.to_dict("records")}
+    # keep the existing catalog order so unchanged rows of the book matrix stay in place
+    records = [changed_by_id.pop(row["bookId"], row) for row in state["books_df"].to_dict("records")]
+    records.extend(changed_by_id.values())
+    books_df = pd.DataFrame(records, columns=state["books_df"].columns)
+    return sync_catalog(db, state, books_df)
+
+
+def _created_since(documents, mark):
+    # edits of older documents (an order being completed, say) must not count as fresh events twice
+    since = (mark or {}).get("updatedAt")
+    if since is None:
+        return documents
+    return [
+        document for document in documents
+        if (document.get("createdAt") or document.get("updatedAt") or since) > since
+    ]
+
+
+def _collect_affected_users(changes, user_registry):
+    affected = set()
+
+    def add(identifier):
+        normalized = normalize_user_identifier(identifier)
+        if normalized:
+            affected.add(user_registry.resolve(normalized))
+
+    for user in changes.get("user", []):
+        if user.get("role") == "user":
+            add(user.get("_id"))
+    for interaction in changes.get("interaction", []):
+        add(interaction.get("userId"))
+    for review in changes.get("review", []):
+        add(review.get("userId"))
+    for order in changes.get("order", []):
+        add(resolve_order_user(order, user_registry))
+    return affected
+
+
+def run_incremental_pipeline(db, top_n, cf_weight, cb_weight, tracker=None, memory_budget=None):
+    tracker = tracker or StageTracker()
+    tracker.begin("changes")
+    state = get_model_state(db)
+    watermark = load_watermark(db)
+    fallback_reason = _incremental_fallback_reason(db, state, watermark, (top_n, cf_weight, cb_weight))
+    if fallback_reason:
+        return None, fallback_reason
+
+    changes = fetch_changed_documents(db, watermark, ("book", "user", "interaction", "review", "order"))
+    user_registry = state["user_registry"]
+    if changes["user"]:
+        user_registry = user_registry.updated(changes["user"])
+
+    affected_users = _collect_affected_users(changes, user_registry)
+    if len(affected_users) > INCREMENTAL_MAX_USER_RATIO * max(len(user_registry), 1):
+        return None, "TooManyChangedUsers"
+
+    # the run builds on a copy; the live state is only swapped once documents and watermark are written
+    state = {**state, "user_registry": user_registry}
+    if changes["book"] and not _apply_book_changes(db, state, changes["book"]):
+        return None, "CatalogChanged"
+
+    trending = state.get("trending")
+    if trending is not None:
+        # add() works in place, so the live index keeps its scores until the swap
+        trending = state["trending"] = trending.copy()
+        new_interactions = _created_since(changes["interaction"], watermark.get("interaction"))
+        new_orders = _created_since(changes["order"], watermark.get("order"))
+        for product_ids, weights, timestamps in trending_events(
+            read_interaction_columns(new_interactions),
+            read_order_columns(new_orders)
+        ):
+            trending.add(product_ids, weights, timestamps)
+
+    users_updated = 0
+    plan = None
+    if affected_users:
+        LOGGER.info("Rescoring %s affected users incrementally", len(affected_users))
+        tracker.begin("history")
+        interactions, reviews, orders = fetch_user_history(db, affected_users, user_registry)
+        interaction_table = build_interactions(
+            interactions,
+            reviews,
+            orders,
+            user_registry,
+            strength_range=state["strength_range"]
+        ).subset(affected_users)
+        tracker.record(users=len(affected_users), userBookPairs=interaction_table.raw.nnz)
+        _, normalized_interactions_df = interaction_table.frames()
+        interaction_df = interaction_weights_frame(normalized_interactions_df)
+
+        tracker.begin("score")
+        books_df = state["books_df"]
+        # the model's dtype is fixed at fit time, so only block sizes and profile handling are planned here
+        plan = plan_execution(
+            memory_budget,
+            plan_workload(interaction_table, state["book_ids"], state["book_matrix"], top_n)
+        )
+        cb_scores, consumed_index = compute_content_scores(
+            books_df,
+            interaction_df,
+            book_matrix=state["book_matrix"],
+            plan=plan
+        )
+        cf_scores = fold_in_collaborative_scores(
+            interaction_df,
+            state["item_factors_df"],
+            consumed_index=consumed_index,
+            algorithm=cf_algorithm(state)
+        )
+
+        tracker.begin("write")
+        users_updated = upsert_recommendations(
+            db=db,
+            top_n=top_n,
+            cf_weight=cf_weight,
+            cb_weight=cb_weight,
+            books_df=books_df,
+            cf_scores=cf_scores,
+            cb_scores=cb_scores,
+            consumed_index=consumed_index,
+            user_registry=user_registry,
+            user_signal_counts=interaction_table.signal_counts(),
+            popularity_ids=state["popularity_ids"],
+            user_ids=affected_users,
+            chunk_size=plan.chunk_size,
+            trending=trending
+        )
+        tracker.record(users=users_updated)
+
+    RECOMMENDATION_CACHE.invalidate(affected_users)
+    SEARCH_PROFILE_CACHE.invalidate(affected_users)
+    EVENT_INGESTOR.vectors.invalidate(affected_users)
+    for name, documents in changes.items():
+        watermark[name] = compute_watermark(documents, previous=watermark.get(name))
+    save_watermark(db, watermark)
+    if users_updated:
+        save_serving_version(db)
+    PIPELINE_STATE["model"] = state
+    tracker.end()
+
+    summary = {
+        "mode": "incremental",
+        "usersUpdated": users_updated,
+        "fallbackReason": None,
+        "plan": plan.as_dict() if plan is not None else None,
+    }
+    return summary, None
+
+
+def run_pipeline(
+    top_n,
+    cf_weight,
+    cb_weight,
+    report=False,
+    mode="full",
+    tracker=None,
+    profile=False,
+    db=None,
+    memory_budget=None
+):
+    """Run one build under the build lock and record it."""
+    memory_budget = parse_memory_budget(MEMORY_BUDGET if memory_budget is None else memory_budget)
+    db = db if db is not None else get_database()
+    tracker = tracker or StageTracker()
+    tracker.begin("waiting")
+    with build_lock():
+        started_at = datetime.now(timezone.utc)
+        profiler = cProfile.Profile() if profile else None
+        tracing = TRACE_MEMORY and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        summary = None
+        error = None
+        try:
+            if profiler is not None:
+                profiler.enable()
+            summary = _run_pipeline_modes(db, top_n, cf_weight, cb_weight, report, mode, tracker, memory_budget)
+            return summary
+        except Exception as exc:
+            tracker.end("failed")
+            error = str(exc)
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            if tracing:
+                tracemalloc.stop()
+            stages = tracker.snapshot()
+            # the process high-water mark, which an earlier, bigger build may have set; the benchmark resets it per run
+            peak_rss = peak_rss_mb()
+            memory = {
+                "budgetMb": megabytes(memory_budget),
+                "peakRssMb": peak_rss,
+                "withinBudget": None if memory_budget is None or peak_rss is None else peak_rss <= memory_budget / 2**20,
+            }
+            run = {
+                "startedAt": started_at,
+                "finishedAt": datetime.now(timezone.utc),
+                "requestedMode": mode,
+                "mode": summary["mode"] if summary else mode,
+                "status": "failed" if error else "succeeded",
+                "error": error,
+                "params": {
+                    "top_n": top_n,
+                    "cf_weight": cf_weight,
+                    "cb_weight": cb_weight,
+                    "report": report,
+                    "memoryBudgetMb": megabytes(memory_budget),
+                },
+                "usersUpdated": summary["usersUpdated"] if summary else 0,
+                "fallbackReason": summary.get("fallbackReason") if summary else None,
+                "modelVersion": summary.get("modelVersion") if summary else None,
+                "shards": summary.get("shards") if summary else None,
+                "plan": summary.get("plan") if summary else None,
+                "memory": memory,
+                "stages": stages,
+            }
+            if profiler is not None:
+                run["profilePath"] = _dump_profile(profiler, started_at)
+            PIPELINE_METRICS.observe(run["mode"], run["status"], stages, run["usersUpdated"])
+            record_run(db, run)
+            if summary is not None:
+                summary["stages"] = stages
+                summary["memory"] = memory
+                if profiler is not None:
+                    summary["profilePath"] = run["profilePath"]
+
+
+def _run_pipeline_modes(db, top_n, cf_weight, cb_weight, report, mode, tracker, memory_budget=None):
+    fallback_reason = None
+    if mode == "incremental" and not report:
+        summary, fallback_reason = run_incremental_pipeline(
+            db,
+            top_n,
+            cf_weight,
+            cb_weight,
+            tracker=tracker,
+            memory_budget=memory_budget
+        )
+        if summary is not None:
+            LOGGER.info("Incremental recommendation update completed successfully.")
+            return summary
+        tracker.end("skipped")
+        LOGGER.info("Falling back to full rebuild: %s", fallback_reason)
+
+    summary = run_full_pipeline(
+        db,
+        top_n,
+        cf_weight,
+        cb_weight,
+        report=report,
+        tracker=tracker,
+        memory_budget=memory_budget
+    )
+    summary["fallbackReason"] = fallback_reason
+    LOGGER.info("Recommendation pipeline completed successfully.")
+    return summary
+
+
+def _dump_profile(profiler, started_at):
+    try:
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        path = PROFILE_DIR / f"build-{started_at.strftime('%Y%m%dT%H%M%S%f')}.prof"
+        profiler.dump_stats(path)
+    except OSError:
+        LOGGER.exception("Failed to write build profile to %s", PROFILE_DIR)
+        return None
+    LOGGER.info("Wrote build profile to %s", path)
+    return str(path)
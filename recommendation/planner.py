@@ -0,0 +1,297 @@
+import os
+import re
+import sys
+from datetime import datetime, timezone
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from bson import ObjectId
+
+from jobs import current_rss_bytes
+from settings import (
+    CF_COMPONENTS,
+    DENSE_PROFILE_MAX_FEATURES,
+    LOGGER,
+    RANKING_CHUNK_SIZE,
+    SHARD_WORKERS,
+    SIMILAR_BOOKS_K,
+    WRITE_BATCH_SIZE,
+    WRITE_WORKERS,
+)
+
+MEMORY_BUDGET = os.getenv("RECOMMENDATION_MEMORY_BUDGET")
+MEMORY_BUDGET_AUTO_FRACTION = float(os.getenv("RECOMMENDATION_MEMORY_BUDGET_AUTO_FRACTION", 0.8))
+
+# the planner shrinks blocks down to this many rows before it gives up float64 precision
+PLAN_MIN_CHUNK_SIZE = 64
+
+# Every estimate is itemsize x shape of the arrays a stage holds; these are the sizes no dtype gives.
+# RSS of a spawned shard worker once the numerical stack is imported, before it maps the shared arrays
+SHARD_WORKER_IMPORT_BYTES = int(float(os.getenv("RECOMMENDATION_SHARD_WORKER_IMPORT_MB", 160)) * 2**20)
+# randomized SVD's extra basis vectors (sklearn's n_oversamples) and how many such bases are alive at once
+CF_OVERSAMPLES = 10
+CF_WORKING_BASES = 4
+# users x books matrices kept per interaction: raw signals, normalized strengths and the consumed-items index
+RESIDENT_INTERACTION_MATRICES = 3
+# score blocks alive while a hybrid block is ranked: cf, cb, their two weighted copies and the sum
+RANKING_SCORE_BLOCKS = 5
+
+FLOAT64_BYTES = np.dtype(np.float64).itemsize
+SPARSE_INDEX_BYTES = np.dtype(np.int32).itemsize
+INTP_BYTES = np.dtype(np.intp).itemsize
+_MEMORY_UNITS = {"": 2**20, "k": 2**10, "m": 2**20, "g": 2**30, "t": 2**40}
+
+
+def _container_memory_limit():
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            value = Path(path).read_text(encoding="utf-8").strip()
+        except OSError:
+            continue
+        # "max" (v2) or a near-2^63 sentinel (v1) mean the cgroup sets no limit
+        if value.isdigit() and int(value) < 2**60:
+            return int(value)
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def parse_memory_budget(value):
+    """Budget in bytes from megabytes, a size such as "512M", or "auto"; None means unbounded."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f"invalid memory budget {value!r}")
+    if isinstance(value, (int, float)):
+        budget = float(value) * 2**20
+    else:
+        text = str(value).strip().lower()
+        if text == "auto":
+            limit = _container_memory_limit()
+            return int(limit * MEMORY_BUDGET_AUTO_FRACTION) if limit else None
+        match = re.fullmatch(r"(\d+(?:\.\d+)?|\.\d+)\s*([kmgt]?)(?:i?b)?", text)
+        if match is None:
+            raise ValueError(f"invalid memory budget {value!r}")
+        budget = float(match.group(1)) * _MEMORY_UNITS[match.group(2)]
+    if not budget > 0:
+        raise ValueError(f"invalid memory budget {value!r}")
+    return int(budget)
+
+
+def megabytes(value):
+    return None if value is None else round(value / 2**20, 1)
+
+
+class ExecutionPlan:
+    """How a build sizes its score blocks; the defaults reproduce an unbudgeted build."""
+
+    def __init__(
+        self,
+        budget=None,
+        dtype="float64",
+        chunk_size=RANKING_CHUNK_SIZE,
+        similarity_chunk_size=RANKING_CHUNK_SIZE,
+        stream_profiles=False,
+        dense_profiles=None,
+        shard_workers=SHARD_WORKERS,
+        baseline=0,
+        estimates=None
+    ):
+        self.budget = budget
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.similarity_chunk_size = similarity_chunk_size
+        self.stream_profiles = stream_profiles
+        self.dense_profiles = dense_profiles
+        self.shard_workers = shard_workers
+        self.baseline = baseline
+        self.estimates = estimates or {}
+
+    @property
+    def float_type(self):
+        return np.float32 if self.dtype == "float32" else np.float64
+
+    @property
+    def estimated_peak(self):
+        stages = self.estimates
+        if not stages:
+            return None
+        transient = max(stages.get(name, 0) for name in ("collaborative", "ranking", "similarity"))
+        return self.baseline + stages.get("resident", 0) + stages.get("profiles", 0) + transient
+
+    def as_dict(self):
+        peak = self.estimated_peak
+        return {
+            "budgetMb": megabytes(self.budget),
+            "dtype": self.dtype,
+            "chunkSize": self.chunk_size,
+            "similarityChunkSize": self.similarity_chunk_size,
+            "contentProfiles": "streamed" if self.stream_profiles else "materialized",
+            "profileBlocks": None if self.dense_profiles is None else ("dense" if self.dense_profiles else "sparse"),
+            "shardWorkers": self.shard_workers,
+            "baselineMb": megabytes(self.baseline),
+            "estimatedMb": {name: megabytes(value) for name, value in self.estimates.items()},
+            "estimatedPeakMb": megabytes(peak),
+            "fits": self.budget is None or peak is None or peak <= self.budget,
+        }
+
+
+DEFAULT_PLAN = ExecutionPlan()
+
+
+def plan_workload(interaction_table, book_ids, book_matrix, top_n):
+    """Sizes the planner works from; the content profile size is bounded by summing each user's book rows."""
+    raw = interaction_table.raw
+    features = book_matrix.shape[1] if book_matrix is not None else 0
+    profile_nnz = 0
+    if book_matrix is not None and raw.nnz:
+        positions = pd.Index(book_ids).get_indexer(interaction_table.book_ids)
+        book_nnz = np.where(positions >= 0, np.diff(book_matrix.indptr)[positions], 0)
+        rows = np.repeat(np.arange(raw.shape[0]), np.diff(raw.indptr))
+        per_user = np.bincount(rows, weights=book_nnz[raw.indices], minlength=raw.shape[0])
+        profile_nnz = int(np.minimum(per_user, features).sum())
+    return {
+        "users": raw.shape[0],
+        "books": len(book_ids),
+        "pairs": int(raw.nnz),
+        "features": features,
+        "bookNnz": int(book_matrix.nnz) if book_matrix is not None else 0,
+        "profileNnz": profile_nnz,
+        "components": min(CF_COMPONENTS, max(len(book_ids) - 1, 0)),
+        "topN": top_n,
+    }
+
+
+def _object_bytes(value, seen):
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_object_bytes(key, seen) + _object_bytes(item, seen) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(_object_bytes(item, seen) for item in value)
+    return size
+
+
+@lru_cache(maxsize=None)
+def _document_bytes(top_n):
+    """Python size of one recommendation document with ``top_n`` scored books, as upsert_recommendations queues it."""
+    now = datetime.now(timezone.utc)
+    user_ref, book_refs = ObjectId(), [ObjectId() for _ in range(top_n)]
+    document = {
+        "userId": user_ref,
+        "userRef": user_ref,
+        "recommendedProductIds": book_refs,
+        "recommendationMethod": "hybrid",
+        "scores": [
+            {"productId": ref, "hybridScore": 0.5, "cfScore": 0.25, "cbScore": 0.75}
+            for ref in book_refs
+        ],
+        "metadata": {"totalSignals": 1, "generatedAt": now, "fallbackReason": None, "contentHash": "0" * 40},
+        "updatedAt": now,
+    }
+    return _object_bytes(document, set())
+
+
+def _csr_bytes(nnz, itemsize=FLOAT64_BYTES):
+    return nnz * (itemsize + SPARSE_INDEX_BYTES)
+
+
+def _plan_estimates(plan, workload):
+    """Peak bytes each remaining stage adds, from the counts in ``workload``."""
+    width = np.dtype(plan.dtype).itemsize
+    users, books, features = workload["users"], workload["books"], workload["features"]
+    factors = (users + books) * workload["components"] * FLOAT64_BYTES
+    profiles = 0 if plan.stream_profiles else _csr_bytes(workload["profileNnz"], width)
+    # score blocks plus the argpartition indices of the top-n selection
+    ranking_row = books * (RANKING_SCORE_BLOCKS * width + INTP_BYTES) + (features * width if plan.dense_profiles else 0)
+    # documents queued for and held by the writer threads
+    writes = min(users, (2 * WRITE_WORKERS + 1) * WRITE_BATCH_SIZE) * _document_bytes(workload["topN"])
+    ranking = plan.chunk_size * ranking_row + writes
+    if plan.shard_workers > 1:
+        # each worker maps the book matrix, the interaction weights and the factors from the shared directory
+        shared = _csr_bytes(workload["bookNnz"], width) + _csr_bytes(workload["pairs"]) + factors
+        worker = SHARD_WORKER_IMPORT_BYTES + shared + ranking + profiles // plan.shard_workers
+        ranking = plan.shard_workers * worker
+    return {
+        # interaction matrices, the fitted factors (and their frames), the neighbour lists and the book matrix
+        # with the search postings built from it
+        "resident": (
+            RESIDENT_INTERACTION_MATRICES * _csr_bytes(workload["pairs"])
+            + 2 * factors
+            + books * SIMILAR_BOOKS_K * (INTP_BYTES + FLOAT64_BYTES)
+            + 2 * _csr_bytes(workload["bookNnz"])
+        ),
+        "profiles": profiles,
+        "collaborative": CF_WORKING_BASES * (users + books) * (workload["components"] + CF_OVERSAMPLES) * FLOAT64_BYTES,
+        "ranking": ranking,
+        # sparse product, its dense copy, the negated scores and the argpartition indices
+        "similarity": plan.similarity_chunk_size * books * (_csr_bytes(1, width) + 2 * width + INTP_BYTES),
+    }
+
+
+def _fit_plan(memory_budget, workload, baseline, dtype, stream_profiles, dense_profiles):
+    """The largest blocks (and shard count) that fit ``memory_budget`` for one dtype / profile layout."""
+    def estimates(chunk_size, similarity_chunk_size, shard_workers=1):
+        plan = ExecutionPlan(
+            memory_budget,
+            dtype,
+            chunk_size,
+            similarity_chunk_size,
+            stream_profiles,
+            dense_profiles,
+            shard_workers,
+            baseline
+        )
+        return _plan_estimates(plan, workload)
+
+    # every estimate is linear in the block sizes
+    empty, unit = estimates(0, 0), estimates(1, 1)
+    room = memory_budget - baseline - empty["resident"] - empty["profiles"]
+    chunk_size = (room - empty["ranking"]) // max(unit["ranking"] - empty["ranking"], 1)
+    similarity_chunk_size = room // max(unit["similarity"], 1)
+    # blocks below PLAN_MIN_CHUNK_SIZE rows save little memory and cost a lot of time, so they never go lower
+    floor = min(PLAN_MIN_CHUNK_SIZE, RANKING_CHUNK_SIZE)
+    chunk_size = int(min(RANKING_CHUNK_SIZE, max(chunk_size, floor)))
+    similarity_chunk_size = int(min(RANKING_CHUNK_SIZE, max(similarity_chunk_size, floor)))
+    shard_workers = SHARD_WORKERS
+    while shard_workers > 1 and estimates(chunk_size, similarity_chunk_size, shard_workers)["ranking"] > room:
+        shard_workers -= 1
+    plan = ExecutionPlan(
+        memory_budget,
+        dtype,
+        chunk_size,
+        similarity_chunk_size,
+        stream_profiles,
+        dense_profiles,
+        shard_workers,
+        baseline
+    )
+    plan.estimates = _plan_estimates(plan, workload)
+    return plan
+
+
+def plan_execution(memory_budget, workload, baseline=None):
+    """Cheapest-to-accuracy settings whose estimated peak stays under ``memory_budget`` bytes."""
+    baseline = current_rss_bytes() if baseline is None else baseline
+    dense_profiles = workload["features"] <= DENSE_PROFILE_MAX_FEATURES
+    plan = ExecutionPlan(memory_budget, dense_profiles=dense_profiles, baseline=baseline)
+    plan.estimates = _plan_estimates(plan, workload)
+    if memory_budget is None or plan.estimated_peak <= memory_budget:
+        return plan
+
+    for dtype, stream_profiles in (("float64", False), ("float64", True), ("float32", True)):
+        for dense in ((True, False) if dense_profiles else (False,)):
+            plan = _fit_plan(memory_budget, workload, baseline, dtype, stream_profiles, dense)
+            if plan.estimated_peak <= memory_budget:
+                return plan
+    LOGGER.warning(
+        "Memory budget of %.0f MB is below the %.0f MB estimated for the most frugal plan",
+        memory_budget / 2**20,
+        plan.estimated_peak / 2**20
+    )
+    return plan
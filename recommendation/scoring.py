@@ -0,0 +1,1149 @@
+import hashlib
+import importlib.util
+import multiprocessing
+import os
+import threading
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+from bson import ObjectId
+from scipy import sparse
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer, TfidfVectorizer
+
+from caches import RecommendationCache
+from planner import DEFAULT_PLAN
+from settings import CF_COMPONENTS, DENSE_PROFILE_MAX_FEATURES, INTERACTION_WEIGHTS, RANKING_CHUNK_SIZE
+from store import attempt_object_id, resolve_order_user
+
+tabulate_spec = importlib.util.find_spec("tabulate")
+tabulate = None
+if tabulate_spec:
+    tabulate = importlib.import_module("tabulate").tabulate
+
+VECTORIZER_MODE = os.getenv("RECOMMENDATION_VECTORIZER", "tfidf").lower()
+HASHING_FEATURES = int(os.getenv("RECOMMENDATION_HASHING_FEATURES", 2**18))
+FEATURE_WORKERS = int(os.getenv("RECOMMENDATION_FEATURE_WORKERS", 1))
+FEATURE_CHUNK_SIZE = int(os.getenv("RECOMMENDATION_FEATURE_CHUNK_SIZE", 2000))
+TEXT_CACHE_SIZE = int(os.getenv("RECOMMENDATION_TEXT_CACHE_SIZE", 50000))
+REVIEW_TEXT_LIMIT = int(os.getenv("RECOMMENDATION_REVIEW_TEXT_LIMIT", 50))
+REVIEW_TEXT_MAX_CHARS = int(os.getenv("RECOMMENDATION_REVIEW_TEXT_MAX_CHARS", 20000))
+CF_ALGORITHM = os.getenv("RECOMMENDATION_CF_ALGORITHM", "svd").lower()
+CF_WORKERS = int(os.getenv("RECOMMENDATION_CF_WORKERS", os.cpu_count() or 1))
+CF_WARM_ITERATIONS = int(os.getenv("RECOMMENDATION_CF_WARM_ITERATIONS", 3))
+CF_COLD_REFIT_EVERY = int(os.getenv("RECOMMENDATION_CF_COLD_REFIT_EVERY", 10))
+ALS_ITERATIONS = int(os.getenv("RECOMMENDATION_ALS_ITERATIONS", 10))
+ALS_REGULARIZATION = float(os.getenv("RECOMMENDATION_ALS_REGULARIZATION", 0.1))
+ALS_ALPHA = float(os.getenv("RECOMMENDATION_ALS_ALPHA", 10.0))
+ALS_CG_STEPS = int(os.getenv("RECOMMENDATION_ALS_CG_STEPS", 3))
+
+# stored interactions per ALS solve block handed to a worker thread
+ALS_BLOCK_NNZ = 65536
+TRENDING_HALF_LIFE_DAYS = float(os.getenv("RECOMMENDATION_TRENDING_HALF_LIFE_DAYS", 7))
+POPULAR_LIST_SIZE = int(os.getenv("RECOMMENDATION_POPULAR_LIST_SIZE", 100))
+POPULAR_CACHE_SIZE = int(os.getenv("RECOMMENDATION_POPULAR_CACHE_SIZE", 1000))
+POPULAR_CACHE_TTL = float(os.getenv("RECOMMENDATION_POPULAR_CACHE_TTL", 60))
+
+
+def prepare_books_dataframe(books, authors, genres, reviews):
+    if not books:
+        return pd.DataFrame()
+
+    author_map = {str(a["_id"]): a for a in authors}
+    genre_map = {str(g["_id"]): g for g in genres}
+    # only the most recent reviews feed the text blob, so it stops growing with review volume
+    reviews_map = defaultdict(lambda: deque(maxlen=REVIEW_TEXT_LIMIT))
+    if reviews and REVIEW_TEXT_LIMIT > 0:
+        # oldest first, undated reviews before dated ones, so each deque ends on the newest
+        order = np.argsort(np.nan_to_num(reviews["timestamp"], nan=-np.inf), kind="stable")
+        for index in order:
+            product_id, text = reviews["productId"][index], reviews["text"][index]
+            if product_id and text:
+                reviews_map[product_id].append(text)
+
+    prepared = []
+    for book in books:
+        book_id = str(book["_id"])
+        author_id = book.get("authorId")
+        genre_id = book.get("genreId")
+        author = author_map.get(str(author_id)) if author_id else {}
+        genre = genre_map.get(str(genre_id)) if genre_id else {}
+
+        text_parts = [
+            book.get("title", ""),
+            book.get("description", ""),
+            author.get("name", ""),
+            author.get("bio", ""),
+            genre.get("name", ""),
+            book.get("publisher", ""),
+            book.get("language", ""),
+        ]
+        attributes = book.get("attributes")
+        if isinstance(attributes, list):
+            text_parts.extend([str(attr) for attr in attributes])
+        review_texts = reviews_map.get(book_id)
+        if review_texts:
+            text_parts.append(" ".join(review_texts)[:REVIEW_TEXT_MAX_CHARS])
+
+        text_blob = " ".join(filter(None, text_parts))
+        prepared.append({
+            "bookId": book_id,
+            "bookRef": book["_id"] if isinstance(book["_id"], ObjectId) else attempt_object_id(book_id),
+            "title": book.get("title", ""),
+            "raw": book,
+            "authorId": str(author_id) if author_id else None,
+            "genreId": str(genre_id) if genre_id else None,
+            "authorName": author.get("name"),
+            "genreName": genre.get("name"),
+            "text": text_blob,
+            "soldQuantity": book.get("soldQuantity", 0) or 0,
+            "reviewsCount": book.get("reviewsCount", 0) or 0,
+            "averageRating": book.get("averageRating", 0) or 0,
+        })
+
+    return pd.DataFrame(prepared)
+
+
+class InteractionTable:
+    """Summed (user, book) signals keyed by interned integer codes, users and books in sorted order."""
+
+    def __init__(self, user_ids, book_ids, raw, strength):
+        self.user_ids = user_ids
+        self.book_ids = book_ids
+        self.raw = raw
+        self.strength = strength
+
+    @property
+    def empty(self):
+        return self.raw.nnz == 0
+
+    @property
+    def value_range(self):
+        if self.empty:
+            return None
+        return float(self.raw.data.min()), float(self.raw.data.max())
+
+    def signal_counts(self):
+        counts = np.diff(self.raw.indptr)
+        return {user_id: int(count) for user_id, count in zip(self.user_ids, counts) if count}
+
+    def subset(self, user_ids):
+        rows = np.flatnonzero(np.isin(self.user_ids, list(user_ids)))
+        return InteractionTable(self.user_ids[rows], self.book_ids, self.raw[rows], self.strength[rows])
+
+    def frames(self):
+        """(raw, normalized) long DataFrames in the layout the scoring stages consume."""
+        if self.empty:
+            empty = pd.DataFrame(columns=["userId", "productId", "raw_value", "interaction_strength"])
+            return empty, empty
+        rows = np.repeat(np.arange(self.raw.shape[0]), np.diff(self.raw.indptr))
+        df = pd.DataFrame({
+            "userId": self.user_ids[rows],
+            "productId": self.book_ids[self.raw.indices],
+            "raw_value": self.raw.data,
+        })
+        normalized = df.copy()
+        normalized["interaction_strength"] = self.strength.data
+        return df, normalized
+
+
+def _intern(ids, lookup):
+    return np.fromiter((lookup.setdefault(value, len(lookup)) for value in ids), dtype=np.int32, count=len(ids))
+
+
+def _sorted_codes(lookup):
+    ids = np.array(list(lookup), dtype=object)
+    order = np.argsort(ids, kind="stable")
+    ranks = np.empty(len(ids), dtype=np.int32)
+    ranks[order] = np.arange(len(ids), dtype=np.int32)
+    return ids[order], ranks
+
+
+def build_interactions(interactions, reviews, orders, user_registry, strength_range=None):
+    user_lookup, book_lookup = {}, {}
+    user_codes, book_codes, weights = [], [], []
+
+    def add(users, books, values):
+        user_codes.append(_intern(users, user_lookup))
+        book_codes.append(_intern(books, book_lookup))
+        weights.append(np.asarray(values, dtype=float))
+
+    add(interactions["userId"], interactions["productId"], interactions["weight"])
+
+    ratings = reviews["rating"]
+    valid = [
+        index for index, (user_id, product_id) in enumerate(zip(reviews["userId"], reviews["productId"]))
+        if user_id and product_id and not np.isnan(ratings[index])
+    ]
+    add([reviews["userId"][i] for i in valid], [reviews["productId"][i] for i in valid], ratings[valid])
+
+    resolved_users = [resolve_order_user(order, user_registry) for order in orders["orders"]]
+    lines = [index for index, order in enumerate(orders["orderIndex"]) if resolved_users[order]]
+    add(
+        [resolved_users[orders["orderIndex"][i]] for i in lines],
+        [orders["productId"][i] for i in lines],
+        orders["weight"][lines]
+    )
+
+    user_ids, user_ranks = _sorted_codes(user_lookup)
+    book_ids, book_ranks = _sorted_codes(book_lookup)
+    # duplicate (user, book) pairs are summed by the COO -> CSR conversion
+    raw = sparse.coo_matrix(
+        (np.concatenate(weights), (user_ranks[np.concatenate(user_codes)], book_ranks[np.concatenate(book_codes)])),
+        shape=(len(user_ids), len(book_ids))
+    ).tocsr()
+    raw.sort_indices()
+
+    strength = raw.copy()
+    strength.data = interaction_strength(raw.data, strength_range)
+    return InteractionTable(user_ids, book_ids, raw, strength)
+
+
+def interaction_strength(values, strength_range=None):
+    """Summed raw signals mapped onto the 1-5 interaction strength scale."""
+    if not len(values):
+        return values
+    if strength_range is None:
+        strength_range = (values.min(), values.max())
+    low, high = strength_range
+    if np.allclose(high, low):
+        return np.where(values > 0, 5.0, 0.0)
+    # incremental runs pass the range of the last full run so rescored users stay comparable
+    return np.clip(1.0 + 4.0 * (values - low) / (high - low), 1.0, 5.0)
+
+
+def build_interaction_frame(interactions, reviews, orders, user_registry, strength_range=None):
+    return build_interactions(
+        interactions,
+        reviews,
+        orders,
+        user_registry,
+        strength_range=strength_range
+    ).frames()
+
+
+def _minmax_rows(values):
+    row_min = values.min(axis=1, keepdims=True)
+    row_max = values.max(axis=1, keepdims=True)
+    # rows without any spread carry no ranking signal and are zeroed, like np.allclose(max, min) per row
+    constant = np.isclose(row_max, row_min)
+    scaled = (values - row_min) / np.where(constant, 1.0, row_max - row_min)
+    scaled[constant.ravel()] = 0.0
+    return scaled
+
+
+def normalize_rows(df):
+    if df is None or df.empty:
+        return df
+    values = _minmax_rows(df.to_numpy(dtype=float))
+    return pd.DataFrame(values, index=df.index, columns=df.columns)
+
+
+class UserItemMatrix:
+    """Sparse users x books matrix with the ids its rows and columns are aligned to."""
+
+    def __init__(self, matrix, user_ids, book_ids):
+        self.matrix = matrix
+        self.user_ids = user_ids
+        self.book_ids = book_ids
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    @property
+    def empty(self):
+        return 0 in self.matrix.shape
+
+    def preview(self, max_rows, max_cols):
+        # only the corner that gets printed is densified
+        return pd.DataFrame(
+            self.matrix[:max_rows, :max_cols].toarray(),
+            index=self.user_ids[:max_rows],
+            columns=self.book_ids[:max_cols]
+        )
+
+
+def build_user_item_matrix(interaction_df, book_ids=None, value_column="weight"):
+    if book_ids is None:
+        # same column order pivot_table would give
+        book_ids = np.sort(interaction_df["productId"].unique())
+    # callers on the request path pass a long-lived pd.Index so its hash table is reused
+    book_index = book_ids if isinstance(book_ids, pd.Index) else pd.Index(book_ids)
+    user_codes, user_ids = pd.factorize(interaction_df["userId"], sort=True)
+    book_codes = book_index.get_indexer(interaction_df["productId"])
+    known = book_codes >= 0
+    values = interaction_df[value_column].to_numpy(dtype=float)
+    # duplicate (user, book) pairs are summed by the COO -> CSR conversion
+    matrix = sparse.coo_matrix(
+        (values[known], (user_codes[known], book_codes[known])),
+        shape=(len(user_ids), len(book_index))
+    ).tocsr()
+    return UserItemMatrix(matrix, list(user_ids), book_index)
+
+
+def build_tfidf_vectorizer(vocabulary=None):
+    return TfidfVectorizer(
+        max_features=5000,
+        ngram_range=(1, 2),
+        stop_words="english",
+        vocabulary=vocabulary
+    )
+
+
+def _hash_texts(hasher, texts):
+    return hasher.transform(texts).tocsr()
+
+
+TEXT_FEATURE_CACHE = OrderedDict()
+TEXT_FEATURE_CACHE_LOCK = threading.Lock()
+
+
+class HashingTfidf:
+    """Hashed term counts with a fitted idf, a drop-in for TfidfVectorizer on large catalogs."""
+
+    def __init__(self, n_features=HASHING_FEATURES, idf=None):
+        self.n_features = n_features
+        self.hasher = HashingVectorizer(
+            n_features=n_features,
+            ngram_range=(1, 2),
+            stop_words="english",
+            alternate_sign=False,
+            norm=None
+        )
+        self.transformer = TfidfTransformer()
+        if idf is not None:
+            self.transformer.idf_ = np.asarray(idf)
+
+    @property
+    def idf_(self):
+        return self.transformer.idf_
+
+    def counts(self, texts):
+        texts = list(texts)
+        keys = [(self.n_features, hashlib.sha1(text.encode("utf-8")).hexdigest()) for text in texts]
+        with TEXT_FEATURE_CACHE_LOCK:
+            rows = [TEXT_FEATURE_CACHE.get(key) for key in keys]
+        misses = [index for index, row in enumerate(rows) if row is None]
+
+        if misses:
+            chunks = [
+                [texts[index] for index in misses[start:start + FEATURE_CHUNK_SIZE]]
+                for start in range(0, len(misses), FEATURE_CHUNK_SIZE)
+            ]
+            if FEATURE_WORKERS > 1 and len(chunks) > 1:
+                # spawn, not fork: the parent runs Flask and job threads and holds pooled Mongo connections
+                with ProcessPoolExecutor(
+                    max_workers=FEATURE_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn")
+                ) as executor:
+                    hashed = list(executor.map(_hash_texts, [self.hasher] * len(chunks), chunks))
+            else:
+                hashed = [_hash_texts(self.hasher, chunk) for chunk in chunks]
+            hashed = sparse.vstack(hashed).tocsr()
+            with TEXT_FEATURE_CACHE_LOCK:
+                for position, index in enumerate(misses):
+                    start, end = hashed.indptr[position], hashed.indptr[position + 1]
+                    rows[index] = (hashed.indices[start:end].copy(), hashed.data[start:end].copy())
+                    TEXT_FEATURE_CACHE[keys[index]] = rows[index]
+                while len(TEXT_FEATURE_CACHE) > TEXT_CACHE_SIZE:
+                    TEXT_FEATURE_CACHE.popitem(last=False)
+
+        lengths = np.array([len(indices) for indices, _ in rows], dtype=np.int64)
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        indices = np.concatenate([indices for indices, _ in rows]) if rows else np.empty(0, dtype=np.int32)
+        data = np.concatenate([data for _, data in rows]) if rows else np.empty(0)
+        return sparse.csr_matrix((data, indices, indptr), shape=(len(rows), self.n_features))
+
+    def fit_transform(self, texts):
+        return self.transformer.fit_transform(self.counts(texts))
+
+    def transform(self, texts):
+        return self.transformer.transform(self.counts(texts))
+
+
+def build_text_vectorizer():
+    if VECTORIZER_MODE == "hashing":
+        return HashingTfidf()
+    return build_tfidf_vectorizer()
+
+
+def vectorizer_kind(tfidf):
+    return "hashing" if isinstance(tfidf, HashingTfidf) else "tfidf"
+
+
+def build_book_matrix(books_df, tfidf=None):
+    if tfidf is None:
+        tfidf = build_text_vectorizer()
+        book_matrix = tfidf.fit_transform(books_df["text"])
+    else:
+        book_matrix = tfidf.transform(books_df["text"])
+    return book_matrix.tocsr(), tfidf
+
+
+class ScoreMatrix:
+    """Users x books score matrix whose rows are only materialized block by block."""
+
+    def __init__(self, user_ids, book_ids, score_block):
+        self.index = pd.Index(user_ids)
+        self.columns = book_ids if isinstance(book_ids, pd.Index) else pd.Index(book_ids)
+        self._positions = {user_id: position for position, user_id in enumerate(user_ids)}
+        self._score_block = score_block
+
+    @property
+    def empty(self):
+        return len(self.index) == 0 or len(self.columns) == 0
+
+    def positions(self, user_ids):
+        return np.array([self._positions[user_id] for user_id in user_ids], dtype=np.int64)
+
+    def block(self, rows):
+        return self._score_block(np.asarray(rows, dtype=np.int64))
+
+    def row(self, user_id):
+        values = self.block(self.positions([user_id]))[0]
+        return pd.Series(values, index=self.columns, name=user_id)
+
+
+class ConsumedIndex:
+    """Sparse users x books pattern of the items each user already interacted with."""
+
+    def __init__(self, matrix, user_ids):
+        # users without interactions map to a trailing empty row
+        self.matrix = sparse.vstack([matrix, sparse.csr_matrix((1, matrix.shape[1]))]).tocsr()
+        self._positions = {user_id: position for position, user_id in enumerate(user_ids)}
+
+    @classmethod
+    def from_interactions(cls, interaction_df, book_ids):
+        interactions = build_user_item_matrix(interaction_df, book_ids)
+        return cls(interactions.matrix, interactions.user_ids)
+
+    def books(self, user_id):
+        position = self._positions.get(user_id, self.matrix.shape[0] - 1)
+        return self.matrix.indices[self.matrix.indptr[position]:self.matrix.indptr[position + 1]]
+
+    def rows(self, user_ids):
+        empty_row = self.matrix.shape[0] - 1
+        positions = [self._positions.get(user_id, empty_row) for user_id in user_ids]
+        return self.matrix[positions]
+
+    def mask(self, values, user_ids):
+        consumed = self.rows(user_ids)
+        rows = np.repeat(np.arange(consumed.shape[0]), np.diff(consumed.indptr))
+        values[rows, consumed.indices] = 0.0
+        return values
+
+
+def compute_content_scores(books_df, interaction_df, book_matrix=None, book_ids=None, plan=DEFAULT_PLAN):
+    if books_df.empty or interaction_df.empty:
+        return pd.DataFrame(), None
+
+    if book_matrix is None:
+        book_matrix, _ = build_book_matrix(books_df)
+    if book_ids is None:
+        book_ids = books_df["bookId"].tolist()
+
+    interactions = build_user_item_matrix(interaction_df, book_ids)
+    return content_score_matrix(interactions.matrix, interactions.user_ids, book_matrix, book_ids, plan=plan)
+
+
+def _row_norms(matrix):
+    return np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+
+
+def _scale_rows(matrix, factors):
+    # in place, instead of a diags product that copies the whole matrix
+    matrix.data *= np.repeat(factors, np.diff(matrix.indptr)).astype(matrix.data.dtype, copy=False)
+    return matrix
+
+
+def content_score_matrix(weights, user_ids, book_matrix, book_ids, plan=DEFAULT_PLAN):
+    consumed_index = ConsumedIndex(weights, user_ids)
+    if weights.dtype != book_matrix.dtype:
+        weights = weights.astype(book_matrix.dtype)
+    chunk_size = max(plan.chunk_size, 1)
+    if plan.stream_profiles:
+        # only the norms are kept; each block's profiles are recomputed when it is scored
+        profiles = None
+        norms = np.concatenate([np.empty(0)] + [
+            _row_norms((weights[start:start + chunk_size] @ book_matrix).tocsr())
+            for start in range(0, weights.shape[0], chunk_size)
+        ])
+    else:
+        profiles = (weights @ book_matrix).tocsr()
+        norms = np.concatenate([np.empty(0)] + [
+            _row_norms(profiles[start:start + chunk_size])
+            for start in range(0, profiles.shape[0], chunk_size)
+        ])
+    scored = np.flatnonzero(norms > 0)
+    if not len(scored):
+        return pd.DataFrame(), consumed_index
+
+    if profiles is not None:
+        inverse = np.zeros(len(norms))
+        inverse[scored] = 1.0 / norms[scored]
+        _scale_rows(profiles, inverse)
+    scored_users = [user_ids[i] for i in scored]
+
+    dense_profiles = plan.dense_profiles
+    if dense_profiles is None:
+        dense_profiles = book_matrix.shape[1] <= DENSE_PROFILE_MAX_FEATURES
+
+    def profile_block(rows):
+        users = scored[rows]
+        if profiles is not None:
+            return profiles[users]
+        return _scale_rows((weights[users] @ book_matrix).tocsr(), 1.0 / norms[users])
+
+    def score_block(rows):
+        block = profile_block(rows)
+        if dense_profiles:
+            # a dense profile block turns this into a CSR x dense product, much cheaper than sparse x sparse
+            scores = np.ascontiguousarray((book_matrix @ block.T.toarray()).T)
+        else:
+            scores = (block @ book_matrix.T).toarray()
+        return consumed_index.mask(_minmax_rows(scores), [scored_users[i] for i in rows])
+
+    cb_scores = ScoreMatrix(scored_users, book_ids, score_block)
+    return cb_scores, consumed_index
+
+
+def collaborative_score_matrix(user_ids, book_ids, user_features, item_features, consumed_index, dtype=None):
+    if dtype is not None:
+        user_features = np.asarray(user_features, dtype=dtype)
+        item_features = np.asarray(item_features, dtype=dtype)
+
+    def score_block(rows):
+        cf_block = np.dot(user_features[rows], item_features.T)
+        # zero out items the user has already consumed, normalize so that remaining items get a full 0–1 spread of CF scores
+        consumed_index.mask(cf_block, [user_ids[i] for i in rows])
+        return _minmax_rows(cf_block)
+
+    return ScoreMatrix(user_ids, book_ids, score_block)
+
+
+def _row_blocks(indptr, max_nnz):
+    # contiguous row ranges holding at most max_nnz stored values; a heavier row gets a block of its own
+    start, n_rows = 0, len(indptr) - 1
+    while start < n_rows:
+        stop = int(np.searchsorted(indptr, indptr[start] + max_nnz, side="right")) - 1
+        stop = min(max(stop, start + 1), n_rows)
+        yield start, stop
+        start = stop
+
+
+def _als_half_step(matrix, fixed, current=None, steps=None, executor=None):
+    """Conjugate-gradient steps of the implicit ALS normal equations for every row of ``matrix``."""
+    n_factors = fixed.shape[1]
+    steps = steps or ALS_CG_STEPS
+    gram = fixed.T @ fixed + ALS_REGULARIZATION * np.eye(n_factors)
+    solved = np.zeros((matrix.shape[0], n_factors)) if current is None else np.array(current, dtype=float)
+
+    def solve(bounds):
+        start, stop = bounds
+        block = matrix[start:stop]
+        rows = np.repeat(np.arange(stop - start), np.diff(block.indptr))
+        factors = fixed[block.indices]
+        # confidence c = 1 + alpha * r on observed pairs, preference 1; unobserved pairs only enter through the gram
+        confidence = ALS_ALPHA * block.data
+
+        def product(values):
+            dots = np.einsum("nk,nk->n", factors, values[rows])
+            scaled = sparse.csr_matrix((confidence * dots, block.indices, block.indptr), shape=block.shape)
+            return values @ gram + scaled @ fixed
+
+        target = sparse.csr_matrix((1.0 + confidence, block.indices, block.indptr), shape=block.shape) @ fixed
+        x = solved[start:stop]
+        residual = target - product(x)
+        direction = residual.copy()
+        norm = np.einsum("nk,nk->n", residual, residual)
+        for _ in range(steps):
+            if not norm.max(initial=0.0) > 1e-20:
+                break
+            applied = product(direction)
+            curvature = np.einsum("nk,nk->n", direction, applied)
+            step = np.divide(norm, curvature, out=np.zeros_like(norm), where=curvature > 0)
+            x += step[:, None] * direction
+            residual -= step[:, None] * applied
+            updated = np.einsum("nk,nk->n", residual, residual)
+            direction = residual + np.divide(updated, norm, out=np.zeros_like(norm), where=norm > 0)[:, None] * direction
+            norm = updated
+        solved[start:stop] = x
+
+    blocks = _row_blocks(matrix.indptr, ALS_BLOCK_NNZ)
+    # numpy releases the GIL inside the dense products, so row blocks scale across threads
+    for _ in (executor.map(solve, blocks) if executor is not None else map(solve, blocks)):
+        pass
+    return solved
+
+
+def _fit_als(matrix, n_components, initial, executor):
+    if initial is None:
+        items = np.random.default_rng(42).normal(scale=0.01, size=(matrix.shape[1], n_components))
+        iterations = ALS_ITERATIONS
+    else:
+        items, iterations = initial, CF_WARM_ITERATIONS
+    by_item = matrix.T.tocsr()
+    users = None
+    for _ in range(iterations):
+        users = _als_half_step(matrix, items, users, executor=executor)
+        items = _als_half_step(by_item, users, items, executor=executor)
+    return _als_half_step(matrix, items, users, executor=executor), items
+
+
+def _fit_svd(matrix, n_components, initial):
+    if initial is None:
+        svd = TruncatedSVD(n_components=n_components, random_state=42)
+        return svd.fit_transform(matrix), svd.components_.T
+
+    # subspace iteration seeded with the previous item factors converges in a few passes instead of a cold randomized fit
+    basis = initial
+    for _ in range(CF_WARM_ITERATIONS):
+        basis, _ = np.linalg.qr(np.asarray(matrix.T @ (matrix @ basis)))
+    left, singular, right_t = np.linalg.svd(np.asarray(matrix @ basis), full_matrices=False)
+    user_features = left * singular
+    item_features = basis @ right_t.T
+    # TruncatedSVD's sign convention, so factors of consecutive builds stay comparable
+    signs = np.sign(item_features[np.abs(item_features).argmax(axis=0), np.arange(n_components)])
+    signs[signs == 0] = 1.0
+    return user_features * signs, item_features * signs
+
+
+def _initial_item_factors(warm_start, book_ids, n_components):
+    if warm_start is None or warm_start.empty:
+        return None
+    rng = np.random.default_rng(42)
+    initial = warm_start.reindex(book_ids).to_numpy(dtype=float)[:, :n_components]
+    # books new to the catalog (and any extra components) start from small noise, which also keeps the basis full rank
+    initial = np.nan_to_num(initial, nan=0.0)
+    if initial.shape[1] < n_components:
+        initial = np.hstack([initial, np.zeros((initial.shape[0], n_components - initial.shape[1]))])
+    return initial + rng.normal(scale=1e-3, size=initial.shape)
+
+
+def compute_collaborative_scores(
+    interaction_df,
+    book_ids,
+    consumed_index=None,
+    warm_start=None,
+    algorithm=CF_ALGORITHM,
+    n_components=CF_COMPONENTS,
+    plan=DEFAULT_PLAN
+):
+    if interaction_df.empty:
+        return pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+
+    interaction_matrix = build_user_item_matrix(interaction_df, book_ids)
+
+    if interaction_matrix.shape[0] < 2 or interaction_matrix.shape[1] < 2:
+        return pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+
+    n_components = min(
+        n_components,
+        interaction_matrix.shape[0] - 1,
+        interaction_matrix.shape[1] - 1
+    )
+    if n_components < 1:
+        return pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+
+    weights, user_ids = interaction_matrix.matrix, interaction_matrix.user_ids
+    initial = _initial_item_factors(warm_start, book_ids, n_components)
+    if algorithm == "als":
+        with ThreadPoolExecutor(max_workers=max(1, CF_WORKERS)) as executor:
+            user_features, item_features = _fit_als(weights, n_components, initial, executor)
+    else:
+        user_features, item_features = _fit_svd(weights, n_components, initial)
+
+    cf_scores = collaborative_score_matrix(
+        user_ids,
+        book_ids,
+        user_features,
+        item_features,
+        consumed_index or ConsumedIndex(weights, user_ids),
+        dtype=plan.float_type
+    )
+
+    factor_columns = [f"factor_{i}" for i in range(user_features.shape[1])]
+    user_factors_df = pd.DataFrame(user_features, index=pd.Index(user_ids, name="userId"), columns=factor_columns)
+    item_factors_df = pd.DataFrame(item_features, index=pd.Index(book_ids, name="productId"), columns=factor_columns)
+
+    return cf_scores, interaction_matrix, user_factors_df, item_factors_df
+
+
+def fold_in_collaborative_scores(interaction_df, item_factors_df, consumed_index=None, algorithm="svd"):
+    if interaction_df.empty or item_factors_df is None or item_factors_df.empty:
+        return pd.DataFrame()
+
+    book_ids = item_factors_df.index
+    interactions = build_user_item_matrix(interaction_df, book_ids)
+    weights, user_ids = interactions.matrix, interactions.user_ids
+    item_features = item_factors_df.to_numpy(dtype=float)
+    if algorithm == "als":
+        # one ALS user step against the fixed item factors; CG from zero is exact after k steps
+        user_features = _als_half_step(weights, item_features, steps=item_features.shape[1])
+    else:
+        # project users onto the fitted item factors (what TruncatedSVD.transform does) instead of refitting;
+        # only the factor rows of books these users touched take part in the projection
+        touched = np.unique(weights.indices)
+        user_features = np.asarray(weights[:, touched] @ item_features[touched])
+    return collaborative_score_matrix(
+        user_ids,
+        book_ids,
+        user_features,
+        item_features,
+        consumed_index or ConsumedIndex.from_interactions(interaction_df, book_ids)
+    )
+
+
+def cf_algorithm(state):
+    return (state.get("cf_model") or {}).get("algorithm", "svd")
+
+
+def warm_start_factors(state):
+    """Item factors the next full refit may start from, or None when a cold refit is due."""
+    if not state or state["item_factors_df"].empty:
+        return None
+    cf_model = state.get("cf_model") or {}
+    if cf_model.get("algorithm") != CF_ALGORITHM or cf_model.get("generation", 0) + 1 >= CF_COLD_REFIT_EVERY:
+        return None
+    return state["item_factors_df"]
+
+
+def _popularity_scores(books_df):
+    return (
+        books_df["soldQuantity"].astype(float) * 1.5
+        + books_df["reviewsCount"].astype(float)
+        + books_df["averageRating"].astype(float) * 2.0
+    )
+
+
+def build_popularity_ranking(books_df):
+    if books_df.empty:
+        return []
+    # sort the scores alone rather than a copy of the whole catalog frame
+    order = _popularity_scores(books_df).reset_index(drop=True).sort_values(ascending=False).index
+    return books_df["bookId"].iloc[order].tolist()
+
+
+def trending_events(interactions, orders):
+    """(productId, weight, timestamp) columns of the events that feed the trending scores."""
+    order_weight = INTERACTION_WEIGHTS["order"]
+    # a purchase counts like an order event whatever the basket value, so big tickets don't swamp views
+    yield interactions["productId"], np.minimum(interactions["weight"], order_weight), interactions["timestamp"]
+    yield orders["productId"], np.full(len(orders["productId"]), order_weight), orders["timestamp"]
+
+
+class TrendingIndex:
+    """Time-decayed popularity of each book, overall and per genre / author."""
+
+    KINDS = ("trending", "popular")
+    SEGMENTS = ("genre", "author")
+
+    def __init__(self, book_ids, scores, as_of, genre_ids, author_ids, static_scores=None, popularity_ids=None):
+        self.book_ids = list(book_ids)
+        self.scores = np.array(scores, dtype=float)
+        self.as_of = as_of
+        self.segments = {
+            "genre": np.asarray(list(genre_ids), dtype=object),
+            "author": np.asarray(list(author_ids), dtype=object),
+        }
+        self.static_scores = np.zeros(len(self.book_ids)) if static_scores is None else np.asarray(static_scores, dtype=float)
+        self._book_index = pd.Index(self.book_ids)
+        # books missing from the static ranking sort after it, in catalog order
+        self.static_rank = np.full(len(self.book_ids), len(self.book_ids), dtype=np.int64)
+        if popularity_ids:
+            positions = self._book_index.get_indexer(popularity_ids)
+            known = positions >= 0
+            self.static_rank[positions[known]] = np.arange(len(popularity_ids))[known]
+        self._decay_rate = np.log(2.0) / (TRENDING_HALF_LIFE_DAYS * 86400.0)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._rankings = RecommendationCache(max_entries=POPULAR_CACHE_SIZE, ttl=POPULAR_CACHE_TTL)
+
+    def __getstate__(self):
+        # locks and the ranking cache stay behind when the index is shipped to shard workers
+        state = {key: value for key, value in self.__dict__.items() if key not in ("_lock", "_rankings")}
+        with self._lock:
+            state["scores"] = self.scores.copy()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._rankings = RecommendationCache(max_entries=POPULAR_CACHE_SIZE, ttl=POPULAR_CACHE_TTL)
+
+    @classmethod
+    def build(cls, books_df, popularity_ids, events=(), now=None):
+        index = cls(
+            books_df["bookId"],
+            np.zeros(len(books_df)),
+            now or datetime.now(timezone.utc),
+            books_df["genreId"],
+            books_df["authorId"],
+            static_scores=_popularity_scores(books_df),
+            popularity_ids=popularity_ids
+        )
+        for product_ids, weights, timestamps in events:
+            index.add(product_ids, weights, timestamps, now=index.as_of)
+        return index
+
+    def realign(self, books_df, popularity_ids):
+        """Same scores on a new catalog order; books new to the catalog start without trending signal."""
+        with self._lock:
+            scores = pd.Series(self.scores, index=self._book_index).reindex(books_df["bookId"], fill_value=0.0)
+            as_of = self.as_of
+        return TrendingIndex(
+            books_df["bookId"],
+            scores.to_numpy(),
+            as_of,
+            books_df["genreId"],
+            books_df["authorId"],
+            static_scores=_popularity_scores(books_df),
+            popularity_ids=popularity_ids
+        )
+
+    def copy(self):
+        """An independent index with the same scores and catalog."""
+        index = TrendingIndex.__new__(TrendingIndex)
+        index.__setstate__(self.__getstate__())
+        return index
+
+    def add(self, product_ids, weights, timestamps, now=None):
+        positions = self._book_index.get_indexer(list(product_ids))
+        known = positions >= 0
+        with self._lock:
+            now = now or datetime.now(timezone.utc)
+            if now > self.as_of:
+                self.scores *= np.exp(-self._decay_rate * (now - self.as_of).total_seconds())
+                self.as_of = now
+            reference = self.as_of.timestamp()
+            # undated events count as happening now; events stamped after as_of are not boosted
+            ages = np.clip(reference - np.nan_to_num(np.asarray(timestamps, dtype=float)[known], nan=reference), 0.0, None)
+            np.add.at(self.scores, positions[known], np.asarray(weights, dtype=float)[known] * np.exp(-self._decay_rate * ages))
+            self._generation += 1
+        return int(known.sum())
+
+    def current_scores(self, now=None):
+        with self._lock:
+            elapsed = max(((now or datetime.now(timezone.utc)) - self.as_of).total_seconds(), 0.0)
+            return self.scores * np.exp(-self._decay_rate * elapsed)
+
+    def ranked(self, kind="trending", segment=None, limit=POPULAR_LIST_SIZE):
+        """Catalog positions of the top books, best first; ``segment`` is ("genre" | "author", id) or None."""
+        key = (kind, segment)
+        generation = self._generation
+        positions = self._rankings.get(key, generation)
+        if positions is None:
+            if segment is None:
+                candidates = np.arange(len(self.book_ids))
+            else:
+                candidates = np.flatnonzero(self.segments[segment[0]] == segment[1])
+            if kind == "trending":
+                with self._lock:
+                    scores = self.scores[candidates]
+                # books without recent events keep their static popularity order
+                order = np.lexsort((self.static_rank[candidates], -scores))
+            else:
+                order = np.argsort(self.static_rank[candidates], kind="stable")
+            positions = candidates[order[:POPULAR_LIST_SIZE]]
+            self._rankings.put(key, generation, positions)
+        return positions[:limit]
+
+    def fallback(self, consumed, top_n):
+        """Cold-start list: trending in the genre the user engaged with most, topped up with trending overall."""
+        consumed = set(np.asarray(consumed).tolist())
+        rankings = []
+        genres = [genre for genre in self.segments["genre"][sorted(consumed)] if genre]
+        if genres:
+            rankings.append(self.ranked("trending", ("genre", Counter(genres).most_common(1)[0][0])))
+        rankings.append(self.ranked("trending"))
+        chosen = []
+        for positions in rankings:
+            for position in positions.tolist():
+                if position in consumed:
+                    continue
+                consumed.add(position)
+                chosen.append(self.book_ids[position])
+                if len(chosen) == top_n:
+                    return chosen
+        return chosen
+
+
+def round_score(value):
+    if value is None or np.isnan(value):
+        return None
+    return float(round(float(value), 6))
+
+
+def scale_to_5(value):
+    if value is None or np.isnan(value):
+        return None
+    return float(round(1.0 + 4.0 * float(value), 6))
+
+
+def _truncate(text, limit=200):
+    if not text:
+        return ""
+    text = str(text).strip()
+    return text if len(text) <= limit else f"{text[:limit-3]}..."
+
+
+def _print_header(title):
+    print(f"\n========== {title} ==========")
+
+
+def _print_table(df, title, max_rows=None, max_cols=None, include_index=False, floatfmt=".4f"):
+    if df is None or df.empty:
+        return
+    table_df = df.copy()
+    if max_rows is not None:
+        table_df = table_df.head(max_rows)
+    if max_cols is not None and max_cols < len(table_df.columns):
+        keep_cols = list(table_df.columns[:max_cols])
+        table_df = table_df[keep_cols]
+    if include_index:
+        table_df = table_df.reset_index()
+    _print_header(title)
+    if tabulate:
+        print(tabulate(table_df, headers="keys", tablefmt="github", showindex=False, floatfmt=floatfmt))
+    else:
+        print(table_df.to_string(index=False))
+
+
+def print_product_feature_profiles(books_df, limit=5):
+    if books_df.empty:
+        return
+    _print_header("HỒ SƠ ĐẶC TRƯNG SẢN PHẨM")
+    for idx, row in books_df.head(limit).iterrows():
+        print(f"Sản phẩm {idx + 1}:")
+        print(f"ID: {row['bookId']}")
+        print(f"Chuỗi đặc trưng: {_truncate(row.get('text', ''), 220)}\n")
+
+
+def print_content_based_examples(cb_scores, books_df, limit=5):
+    if cb_scores.empty:
+        return
+    user_id = cb_scores.index[0]
+    row = cb_scores.row(user_id)
+    ranked = row[row > 0].sort_values(ascending=False).head(limit)
+    if ranked.empty:
+        return
+    book_lookup = books_df.set_index("bookId")["title"].to_dict()
+    _print_header(f"GỢI Ý CHO USER: {user_id}")
+    print("Gợi ý sản phẩm:")
+    for bid, score in ranked.items():
+        title = book_lookup.get(bid, bid)
+        print(f"{bid} | {title} | Cosine Similarity: {round(score, 3)}")
+
+
+def print_interaction_matrix(interaction_matrix, title, max_rows=5, max_cols=8):
+    if interaction_matrix.empty:
+        return
+    preview = interaction_matrix.preview(max_rows, max_cols)
+
+    preview.index = [f"User{i+1}" for i in range(len(preview.index))]
+    preview.columns = [f"Book{i+1}" for i in range(len(preview.columns))]
+
+    preview = preview.reset_index()
+    _print_table(preview, title, include_index=False, floatfmt=".2f")
+
+
+def print_normalized_interactions(normalized_df, limit=10):
+    if normalized_df.empty:
+        return
+    preview = normalized_df[["userId", "productId", "interaction_strength"]].copy()
+    preview = preview.sort_values("interaction_strength", ascending=False).head(limit)
+    _print_table(preview, "BẢNG ĐIỂM TƯƠNG TÁC ĐÃ CHUẨN HÓA")
+
+
+def print_user_factors(user_factors_df, max_rows=5):
+    if user_factors_df.empty:
+        return
+    _print_table(
+        user_factors_df,
+        "USER FACTORS",
+        max_rows=max_rows,
+        include_index=True
+    )
+
+
+def print_item_factors(item_factors_df, max_rows=5):
+    if item_factors_df.empty:
+        return
+    _print_table(
+        item_factors_df,
+        "ITEM FACTORS",
+        max_rows=max_rows,
+        include_index=True
+    )
+
+
+def print_cf_predictions(cf_scores, books_df, limit=7):
+    if cf_scores.empty:
+        return
+    user_id = cf_scores.index[0]
+    row = cf_scores.row(user_id)
+    ranked = row[row > 0].sort_values(ascending=False).head(limit)
+    if ranked.empty:
+        return
+    book_lookup = books_df.set_index("bookId")["title"].to_dict()
+    prediction_rows = []
+    for bid, score in ranked.items():
+        prediction_rows.append({
+            "userId": user_id,
+            "productId": bid,
+            "title": book_lookup.get(bid, bid),
+            "predicted_score": scale_to_5(score)
+        })
+    df = pd.DataFrame(prediction_rows)
+    _print_table(df, "DỰ ĐOÁN VÀ ĐỀ XUẤT SẢN PHẨM CHO USER")
+
+
+def print_hybrid_scores_table(hybrid_df):
+    if hybrid_df.empty:
+        return
+    _print_table(hybrid_df, "BẢNG ĐIỂM GỢI Ý HYBRID")
+
+
+def build_hybrid_debug_table(user_id, cf_scores, cb_scores, cf_weight, cb_weight, limit=10):
+    if user_id is None:
+        return pd.DataFrame()
+    cf_row = cf_scores.row(user_id) if not cf_scores.empty and user_id in cf_scores.index else None
+    cb_row = cb_scores.row(user_id) if not cb_scores.empty and user_id in cb_scores.index else None
+    if cf_row is None and cb_row is None:
+        return pd.DataFrame()
+    combined = pd.Series(dtype=float)
+    if cf_row is not None:
+        combined = cf_weight * cf_row
+    if cb_row is not None:
+        combined = combined.add(cb_weight * cb_row, fill_value=0.0)
+    combined = combined[combined > 0].sort_values(ascending=False).head(limit)
+    rows = []
+    for product_id, hybrid_value in combined.items():
+        rows.append({
+            "product_id": product_id,
+            "CF_Score": round(float(cf_row.get(product_id, 0.0)) if cf_row is not None else 0.0, 6),
+            "CB_Score": round(float(cb_row.get(product_id, 0.0)) if cb_row is not None else 0.0, 6),
+            "Hybrid_Score": round(float(hybrid_value), 6),
+        })
+    return pd.DataFrame(rows)
+
+
+def build_interaction_matrix_from_long(df, value_column):
+    if df is None or df.empty or value_column not in df:
+        return pd.DataFrame()
+    return build_user_item_matrix(df, value_column=value_column)
+
+
+def generate_console_report(
+    books_df,
+    cb_scores,
+    cf_scores,
+    raw_interaction_matrix,
+    normalized_interactions,
+    interaction_matrix,
+    user_factors_df,
+    item_factors_df,
+    cf_weight,
+    cb_weight
+):
+    print_product_feature_profiles(books_df)
+    print_content_based_examples(cb_scores, books_df)
+    print_interaction_matrix(raw_interaction_matrix, "MA TRẬN TƯƠNG TÁC USER-ITEM", max_rows=5, max_cols=8)
+    print_normalized_interactions(normalized_interactions)
+    print_user_factors(user_factors_df)
+    print_item_factors(item_factors_df)
+    print_cf_predictions(cf_scores, books_df)
+    report_user_id = None
+    if not cf_scores.empty:
+        report_user_id = cf_scores.index[0]
+    elif not cb_scores.empty:
+        report_user_id = cb_scores.index[0]
+    hybrid_df = build_hybrid_debug_table(report_user_id, cf_scores, cb_scores, cf_weight, cb_weight)
+    print_hybrid_scores_table(hybrid_df)
+
+
+def top_positive(values, top_n):
+    top_n = max(top_n, 0)
+    if values.shape[1] > top_n:
+        candidates = np.argpartition(-values, top_n - 1, axis=1)[:, :top_n]
+    else:
+        candidates = np.tile(np.arange(values.shape[1]), (values.shape[0], 1))
+    candidate_values = np.take_along_axis(values, candidates, axis=1)
+    # highest score first, ties broken by catalog order
+    order = np.lexsort((candidates, -candidate_values), axis=1)
+    return (
+        np.take_along_axis(candidates, order, axis=1),
+        np.take_along_axis(candidate_values, order, axis=1),
+    )
+
+
+def rank_recommendations(
+    user_ids,
+    book_ids,
+    cf_scores,
+    cb_scores,
+    consumed_index,
+    top_n,
+    cf_weight,
+    cb_weight,
+    chunk_size=RANKING_CHUNK_SIZE
+):
+    cf_users = set(cf_scores.index) if not cf_scores.empty else set()
+    cb_users = set(cb_scores.index) if not cb_scores.empty else set()
+
+    groups = {"hybrid": [], "collaborative": [], "content_based": []}
+    for user_id in user_ids:
+        if user_id in cf_users and user_id in cb_users:
+            groups["hybrid"].append(user_id)
+        elif user_id in cf_users:
+            groups["collaborative"].append(user_id)
+        elif user_id in cb_users:
+            groups["content_based"].append(user_id)
+        else:
+            yield user_id, "popularity", "InsufficientSignals", []
+
+    fallback_reasons = {
+        "hybrid": "NoPositiveHybridScores",
+        "collaborative": "NoCollaborativeScores",
+        "content_based": "NoContentScores",
+    }
+    for method, method_users in groups.items():
+        for start in range(0, len(method_users), chunk_size):
+            chunk = method_users[start:start + chunk_size]
+            cf_block = cb_block = None
+            if method in ("hybrid", "collaborative"):
+                cf_block = cf_scores.block(cf_scores.positions(chunk))
+            if method in ("hybrid", "content_based"):
+                cb_block = cb_scores.block(cb_scores.positions(chunk))
+
+            if method == "hybrid":
+                ranked_values = consumed_index.mask(cf_weight * cf_block + cb_weight * cb_block, chunk)
+            else:
+                ranked_values = cf_block if cf_block is not None else cb_block
+
+            top_idx, top_values = top_positive(ranked_values, top_n)
+            for row, user_id in enumerate(chunk):
+                keep = top_values[row] > 0
+                ranked = [
+                    (
+                        book_ids[idx],
+                        value,
+                        cf_block[row, idx] if cf_block is not None else None,
+                        cb_block[row, idx] if cb_block is not None else None,
+                    )
+                    for idx, value in zip(top_idx[row][keep], top_values[row][keep])
+                ]
+                if ranked:
+                    yield user_id, method, None, ranked
+                else:
+                    yield user_id, "popularity", fallback_reasons[method], []
+
+
+def interaction_weights_frame(normalized_interactions_df):
+    if not normalized_interactions_df.empty:
+        return normalized_interactions_df.rename(columns={"interaction_strength": "weight"})
+    return pd.DataFrame(columns=["userId", "productId", "weight"])
@@ -0,0 +1,294 @@
+import os
+from bisect import bisect_left
+from collections import Counter
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer
+
+from caches import CACHE_VERSION, SEARCH_PROFILE_CACHE
+from scoring import build_interactions
+from store import fetch_user_history, load_serving_version
+
+SEARCH_BM25_K1 = float(os.getenv("RECOMMENDATION_SEARCH_BM25_K1", 1.2))
+SEARCH_BM25_B = float(os.getenv("RECOMMENDATION_SEARCH_BM25_B", 0.75))
+SEARCH_TITLE_BOOST = float(os.getenv("RECOMMENDATION_SEARCH_TITLE_BOOST", 2.0))
+SEARCH_PREFIX_EXPANSIONS = int(os.getenv("RECOMMENDATION_SEARCH_PREFIX_EXPANSIONS", 50))
+SEARCH_DELTA_MAX_RATIO = float(os.getenv("RECOMMENDATION_SEARCH_DELTA_MAX_RATIO", 0.1))
+SEARCH_MAX_RESULTS = int(os.getenv("RECOMMENDATION_SEARCH_MAX_RESULTS", 100))
+SEARCH_RERANK_DEPTH = int(os.getenv("RECOMMENDATION_SEARCH_RERANK_DEPTH", 200))
+SEARCH_PERSONALIZATION_WEIGHT = float(os.getenv("RECOMMENDATION_SEARCH_PERSONALIZATION_WEIGHT", 0.5))
+
+
+def build_search_vectorizer():
+    # accents are folded so queries typed without diacritics still match
+    return CountVectorizer(strip_accents="unicode", lowercase=True, dtype=np.float32)
+
+
+class SearchSegment:
+    """Postings of a batch of books: term-sorted CSC layout with int32 row positions and float32 term frequencies."""
+
+    def __init__(self, book_ids, terms, offsets, docs, freqs, lengths):
+        self.book_ids = list(book_ids)
+        self.terms = list(terms)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.docs = np.asarray(docs, dtype=np.int32)
+        self.freqs = np.asarray(freqs, dtype=np.float32)
+        self.lengths = np.asarray(lengths, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.book_ids)
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], np.zeros(1), [], [], [])
+
+    @classmethod
+    def from_counts(cls, book_ids, terms, counts):
+        counts = counts.tocsc()
+        counts.sort_indices()
+        return cls(book_ids, terms, counts.indptr, counts.indices, counts.data, np.asarray(counts.sum(axis=1)).ravel())
+
+    @classmethod
+    def build(cls, books_df):
+        if books_df.empty:
+            return cls.empty()
+        vectorizer = build_search_vectorizer()
+        try:
+            counts = vectorizer.fit_transform(books_df["text"])
+        except ValueError:
+            # nothing but empty texts
+            return cls.empty()
+        if SEARCH_TITLE_BOOST:
+            # title terms count extra, so a title match outranks one buried in a review
+            counts = counts + SEARCH_TITLE_BOOST * vectorizer.transform([title or "" for title in books_df["title"]])
+        return cls.from_counts(books_df["bookId"], vectorizer.get_feature_names_out(), counts)
+
+    @classmethod
+    def merge(cls, parts):
+        """One segment from (segment, rows) pairs, re-laying out the postings without re-tokenizing any text."""
+        parts = [(segment, rows) for segment, rows in parts if len(rows)]
+        if not parts:
+            return cls.empty()
+        terms = sorted(set().union(*(segment.terms for segment, _ in parts)))
+        columns = {term: column for column, term in enumerate(terms)}
+        blocks, book_ids = [], []
+        for segment, rows in parts:
+            remap = np.fromiter((columns[term] for term in segment.terms), dtype=np.int64, count=len(segment.terms))
+            block = segment.matrix().tocsr()[rows]
+            blocks.append(sparse.csr_matrix((block.data, remap[block.indices], block.indptr), shape=(len(rows), len(terms))))
+            book_ids.extend(segment.book_ids[row] for row in rows.tolist())
+        counts = sparse.vstack(blocks).tocsc()
+        # terms only the dropped rows used go with them
+        used = np.flatnonzero(np.diff(counts.indptr))
+        return cls.from_counts(book_ids, [terms[column] for column in used], counts[:, used])
+
+    def matrix(self):
+        return sparse.csc_matrix((self.freqs, self.docs, self.offsets), shape=(len(self.book_ids), len(self.terms)))
+
+    def term_id(self, term):
+        position = bisect_left(self.terms, term)
+        return position if position < len(self.terms) and self.terms[position] == term else -1
+
+    def term_range(self, prefix):
+        return bisect_left(self.terms, prefix), bisect_left(self.terms, prefix + chr(0x10FFFF))
+
+    def document_frequency(self, term_id):
+        return int(self.offsets[term_id + 1] - self.offsets[term_id])
+
+    def postings(self, term_id):
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return self.docs[start:end], self.freqs[start:end]
+
+
+class SearchIndex:
+    """BM25 over a main segment from the last full build plus a small delta of edited books."""
+
+    def __init__(self, segments, live=None, k1=SEARCH_BM25_K1, b=SEARCH_BM25_B):
+        self.segments = list(segments)
+        self.live = list(live) if live is not None else [np.ones(len(segment), dtype=bool) for segment in self.segments]
+        self.k1 = k1
+        self.analyze = build_search_vectorizer().build_analyzer()
+        self.positions = {}
+        for number, (segment, live_rows) in enumerate(zip(self.segments, self.live)):
+            for row in np.flatnonzero(live_rows).tolist():
+                self.positions[segment.book_ids[row]] = (number, row)
+        lengths = [segment.lengths[live_rows] for segment, live_rows in zip(self.segments, self.live)]
+        average_length = float(np.concatenate(lengths).mean()) if self.positions else 1.0
+        # the length part of each row's BM25 denominator only changes with the segments
+        self._norms = [
+            (k1 * (1.0 - b + b * segment.lengths / max(average_length, 1e-9))).astype(np.float32)
+            for segment in self.segments
+        ]
+
+    def __len__(self):
+        return len(self.positions)
+
+    @property
+    def terms(self):
+        return sum(len(segment.terms) for segment in self.segments)
+
+    @property
+    def postings_count(self):
+        return sum(len(segment.docs) for segment in self.segments)
+
+    @classmethod
+    def build(cls, books_df):
+        return cls([SearchSegment.build(books_df)])
+
+    def refresh(self, book_ids, changed_df=None):
+        """Index over ``book_ids`` with the books in ``changed_df`` re-indexed from its text."""
+        current = set(book_ids)
+        changed = set(changed_df["bookId"]) if changed_df is not None and not changed_df.empty else set()
+        live = [live_rows.copy() for live_rows in self.live]
+        for book_id, (number, row) in self.positions.items():
+            if book_id not in current or book_id in changed:
+                live[number][row] = False
+
+        main, main_live = self.segments[0], live[0]
+        parts = [(segment, np.flatnonzero(live_rows)) for segment, live_rows in zip(self.segments[1:], live[1:])]
+        if changed:
+            parts.append((SearchSegment.build(changed_df), np.arange(len(changed_df))))
+        delta_rows = sum(len(rows) for _, rows in parts)
+        if delta_rows > SEARCH_DELTA_MAX_RATIO * max(int(main_live.sum()), 1):
+            return SearchIndex([SearchSegment.merge([(main, np.flatnonzero(main_live))] + parts)])
+        if not delta_rows:
+            return SearchIndex([main], [main_live])
+        delta = SearchSegment.merge(parts)
+        return SearchIndex([main, delta], [main_live, np.ones(len(delta), dtype=bool)])
+
+    def compacted(self):
+        if len(self.segments) == 1 and self.live[0].all():
+            return self.segments[0]
+        return SearchSegment.merge([
+            (segment, np.flatnonzero(live_rows)) for segment, live_rows in zip(self.segments, self.live)
+        ])
+
+    def expand(self, prefix):
+        """Indexed terms starting with ``prefix``: the prefix itself, then the most widely used completions."""
+        frequencies = Counter()
+        for segment in self.segments:
+            start, end = segment.term_range(prefix)
+            candidates = np.arange(start, end)
+            if len(candidates) > SEARCH_PREFIX_EXPANSIONS:
+                frequencies_in_range = np.diff(segment.offsets[start:end + 1])
+                candidates = candidates[np.argpartition(-frequencies_in_range, SEARCH_PREFIX_EXPANSIONS - 1)]
+                candidates = candidates[:SEARCH_PREFIX_EXPANSIONS]
+            for term_id in candidates.tolist():
+                frequencies[segment.terms[term_id]] += segment.document_frequency(term_id)
+        frequencies.pop(prefix, None)
+        return [prefix] + [term for term, _ in frequencies.most_common(SEARCH_PREFIX_EXPANSIONS - 1)]
+
+    def search(self, query, limit, prefix=True):
+        """Best ``limit`` (bookId, BM25 score) matches of ``query`` and how many books matched."""
+        tokens = list(dict.fromkeys(self.analyze(query)))
+        if not tokens or not self.positions or limit <= 0:
+            return [], 0
+        groups = [[token] for token in tokens]
+        if prefix:
+            groups[-1] = self.expand(tokens[-1])
+
+        scores = [np.zeros(len(segment), dtype=np.float32) for segment in self.segments]
+        for group in groups:
+            expanded = len(group) > 1
+            targets = [np.zeros(len(segment), dtype=np.float32) for segment in self.segments] if expanded else scores
+            for term in group:
+                term_ids = [segment.term_id(term) for segment in self.segments]
+                frequency = sum(
+                    segment.document_frequency(term_id)
+                    for segment, term_id in zip(self.segments, term_ids)
+                    if term_id >= 0
+                )
+                if not frequency:
+                    continue
+                # masked rows can push a term used by every live book past the live count
+                frequency = min(frequency, len(self.positions))
+                idf = np.float32(np.log1p((len(self.positions) - frequency + 0.5) / (frequency + 0.5)))
+                for segment, norms, target, term_id in zip(self.segments, self._norms, targets, term_ids):
+                    if term_id < 0:
+                        continue
+                    # rows are unique within a posting list, so fancy-indexed updates are safe
+                    docs, freqs = segment.postings(term_id)
+                    contribution = idf * freqs * (self.k1 + 1.0) / (freqs + norms[docs])
+                    target[docs] = np.maximum(target[docs], contribution) if expanded else target[docs] + contribution
+            if expanded:
+                for total, target in zip(scores, targets):
+                    total += target
+
+        matches = []
+        for number, (total, live_rows) in enumerate(zip(scores, self.live)):
+            rows = np.flatnonzero((total > 0) & live_rows)
+            matches.append((np.full(len(rows), number), rows, total[rows]))
+        numbers, rows, values = (np.concatenate(columns) for columns in zip(*matches))
+        if len(values) > limit:
+            top = np.argpartition(-values, limit - 1)[:limit]
+            numbers, rows, values = numbers[top], rows[top], values[top]
+        # ties resolve to segment then catalog order
+        order = np.lexsort((rows, numbers, -values))
+        return [
+            (self.segments[numbers[i]].book_ids[rows[i]], float(values[i]))
+            for i in order.tolist()
+        ], int(sum(len(match[1]) for match in matches))
+
+
+def search_profile(db, state, user_id):
+    """L2-normalized text profile of a user's history, as content-based scoring builds it; None without history."""
+    fitted_at = state.get("fittedAt")
+    CACHE_VERSION.check(lambda: load_serving_version(db))
+    cached = SEARCH_PROFILE_CACHE.get(user_id, fitted_at)
+    if cached is not None:
+        return cached[0]
+    profile = None
+    book_matrix = state.get("book_matrix")
+    if book_matrix is not None:
+        user_registry = state["user_registry"]
+        interactions, reviews, orders = fetch_user_history(db, [user_id], user_registry)
+        table = build_interactions(
+            interactions,
+            reviews,
+            orders,
+            user_registry,
+            strength_range=state["strength_range"]
+        ).subset([user_id])
+        positions = state["book_index"].get_indexer(table.book_ids[table.strength.indices])
+        known = positions >= 0
+        if known.any():
+            weights = sparse.csr_matrix(table.strength.data[known][np.newaxis, :])
+            profile = (weights @ book_matrix[positions[known]]).tocsr()
+            norm = np.sqrt(profile.multiply(profile).sum())
+            profile = profile / norm if norm > 0 else None
+    # the miss is cached too, so anonymous-looking users don't cost a history lookup per keystroke
+    SEARCH_PROFILE_CACHE.put(user_id, fitted_at, (profile,))
+    return profile
+
+
+def search_books(db, state, query, top_n, offset=0, user_id=None, prefix=True):
+    """Ranked (bookId, score, textScore, profileScore) matches of ``query`` and the match count."""
+    search_index = state.get("search_index")
+    if search_index is None:
+        return [], 0
+    profile = None
+    if user_id and SEARCH_PERSONALIZATION_WEIGHT > 0:
+        profile = search_profile(db, state, user_id)
+    depth = offset + top_n if profile is None else max(offset + top_n, SEARCH_RERANK_DEPTH)
+    hits, matched = search_index.search(query, depth, prefix=prefix)
+    if not hits:
+        return [], matched
+
+    book_ids = [book_id for book_id, _ in hits]
+    text_scores = np.array([score for _, score in hits])
+    if profile is None:
+        return [
+            (book_id, score, score, None)
+            for book_id, score in hits[offset:offset + top_n]
+        ], matched
+    affinity = np.zeros(len(hits))
+    positions = state["book_index"].get_indexer(book_ids)
+    known = positions >= 0
+    affinity[known] = (state["book_matrix"][positions[known]] @ profile.T).toarray().ravel()
+    scores = text_scores * (1.0 + SEARCH_PERSONALIZATION_WEIGHT * affinity)
+    order = np.lexsort((np.arange(len(hits)), -scores))[offset:offset + top_n]
+    return [
+        (book_ids[i], float(scores[i]), float(text_scores[i]), float(affinity[i]))
+        for i in order.tolist()
+    ], matched
@@ -0,0 +1,159 @@
+import numpy as np
+
+from caches import CACHE_VERSION, SERVING_CACHE, SERVING_CACHE_VERIFY
+from scoring import (
+    build_interactions,
+    cf_algorithm,
+    compute_content_scores,
+    fold_in_collaborative_scores,
+    interaction_weights_frame,
+    rank_recommendations,
+    round_score,
+)
+from store import attempt_object_id, fetch_user_history, load_serving_version, safe_float
+
+
+def load_serving_entry(db, state, user_id, verify=SERVING_CACHE_VERIFY):
+    """Cached (positions, scores, method, fallbackReason) for a user, reading the stored document on a miss."""
+    CACHE_VERSION.check(lambda: load_serving_version(db))
+    SERVING_CACHE.reset(state["book_ids"])
+    user_ref = state["user_registry"].user_ref(user_id) or attempt_object_id(user_id)
+    cached = SERVING_CACHE.get(user_id)
+    if cached is not None:
+        entry, content_hash = cached[:4], cached[4]
+        # a hash probe is one indexed lookup; it also catches writes made since the last version check
+        if not verify or (user_ref is not None and _stored_hash(db, user_ref) == content_hash):
+            return entry, True
+
+    if user_ref is None:
+        return None, False
+    document = db.recommendation.find_one(
+        {"userId": user_ref},
+        {
+            "recommendedProductIds": 1,
+            "scores": 1,
+            "recommendationMethod": 1,
+            "metadata.fallbackReason": 1,
+            "metadata.contentHash": 1,
+        }
+    )
+    if document is None:
+        SERVING_CACHE.invalidate([user_id])
+        return None, False
+
+    product_ids = [str(product_id) for product_id in document.get("recommendedProductIds", [])]
+    hybrid_scores = {str(row.get("productId")): row.get("hybridScore") for row in document.get("scores", [])}
+    positions = state["book_index"].get_indexer(product_ids)
+    scores = np.array([
+        np.nan if hybrid_scores.get(product_id) is None else hybrid_scores[product_id]
+        for product_id in product_ids
+    ], dtype=float)
+    # books removed from the catalog since the document was written are skipped
+    known = positions >= 0
+    metadata = document.get("metadata", {})
+    entry = (
+        positions[known],
+        scores[known],
+        document.get("recommendationMethod"),
+        metadata.get("fallbackReason"),
+    )
+    SERVING_CACHE.put(user_id, *entry, content_hash=metadata.get("contentHash"))
+    return entry, False
+
+
+def _stored_hash(db, user_ref):
+    document = db.recommendation.find_one({"userId": user_ref}, {"metadata.contentHash": 1})
+    return document.get("metadata", {}).get("contentHash") if document is not None else None
+
+
+def _book_summary(book):
+    raw = book["raw"]
+    return {
+        "_id": book["bookId"],
+        "title": book["title"],
+        "author": book["authorName"] or "",
+        "genres": book["genreName"] or "",
+        "coverImage": raw.get("coverImage") or "",
+        "oldPrice": safe_float(raw.get("oldPrice"), None),
+        "newPrice": safe_float(raw.get("newPrice"), None),
+        "averageRating": safe_float(book["averageRating"]),
+        "reviewsCount": int(safe_float(book["reviewsCount"])),
+        "soldQuantity": int(safe_float(book["soldQuantity"])),
+        "stock": int(safe_float(raw.get("stock"))),
+        "featured": bool(raw.get("featured", False)),
+    }
+
+
+def book_summaries(state):
+    # built once per catalog; sync_catalog drops them together with the books frame they come from
+    summaries = state.get("book_summaries")
+    if summaries is None:
+        summaries = state["book_summaries"] = [_book_summary(book) for book in state["books_df"].to_dict("records")]
+    return summaries
+
+
+def recommend_for_user(db, state, user_id, top_n, cf_weight, cb_weight):
+    user_registry = state["user_registry"]
+    user_id = user_registry.resolve(user_id)
+    interactions, reviews, orders = fetch_user_history(db, [user_id], user_registry)
+    interaction_table = build_interactions(
+        interactions,
+        reviews,
+        orders,
+        user_registry,
+        strength_range=state["strength_range"]
+    ).subset([user_id])
+    _, normalized_interactions_df = interaction_table.frames()
+    interaction_df = interaction_weights_frame(normalized_interactions_df)
+
+    cb_scores, consumed_index = compute_content_scores(
+        state["books_df"],
+        interaction_df,
+        book_matrix=state["book_matrix"],
+        book_ids=state["book_index"]
+    )
+    cf_scores = fold_in_collaborative_scores(
+        interaction_df,
+        state["item_factors_df"],
+        consumed_index=consumed_index,
+        algorithm=cf_algorithm(state)
+    )
+    _, recommendation_method, fallback_reason, ranked = next(rank_recommendations(
+        [user_id],
+        state["book_ids"],
+        cf_scores,
+        cb_scores,
+        consumed_index,
+        top_n,
+        cf_weight,
+        cb_weight
+    ))
+    if ranked:
+        items = [{
+            "productId": bid,
+            "hybridScore": round_score(hybrid_score),
+            "cfScore": round_score(cf_score),
+            "cbScore": round_score(cb_score)
+        } for bid, hybrid_score, cf_score, cb_score in ranked]
+    else:
+        trending = state.get("trending")
+        if trending is not None:
+            consumed = consumed_index.books(user_id) if consumed_index is not None else ()
+            fallback_ids = trending.fallback(consumed, top_n)
+        else:
+            fallback_ids = state["popularity_ids"][:top_n]
+        items = [{
+            "productId": bid,
+            "hybridScore": None,
+            "cfScore": None,
+            "cbScore": None
+        } for bid in fallback_ids]
+
+    return {
+        "userId": user_id,
+        "recommendationMethod": recommendation_method,
+        "fallbackReason": fallback_reason,
+        "totalSignals": int(interaction_table.raw.nnz),
+        "modelVersion": state.get("version"),
+        "items": items,
+    }
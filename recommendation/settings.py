@@ -0,0 +1,33 @@
+import logging
+import os
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+load_dotenv()
+BACKEND_ENV_PATH = Path(__file__).resolve().parents[1] / "backend" / ".env"
+if BACKEND_ENV_PATH.exists():
+    load_dotenv(BACKEND_ENV_PATH)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s"
+)
+LOGGER = logging.getLogger("recommendation")
+
+INTERACTION_WEIGHTS = {
+    "view": 1.0,
+    "wishlist": 2.0,
+    "rating": 4.0,
+    "order": 5.0,
+}
+RANKING_CHUNK_SIZE = int(os.getenv("RECOMMENDATION_CHUNK_SIZE", 512))
+MODEL_DIR = Path(os.getenv("RECOMMENDATION_MODEL_DIR", Path(__file__).resolve().parent / "models"))
+SIMILAR_BOOKS_K = int(os.getenv("RECOMMENDATION_SIMILAR_BOOKS_K", 20))
+WRITE_BATCH_SIZE = int(os.getenv("RECOMMENDATION_WRITE_BATCH_SIZE", 1000))
+WRITE_WORKERS = int(os.getenv("RECOMMENDATION_WRITE_WORKERS", 4))
+SHARD_WORKERS = int(os.getenv("RECOMMENDATION_SHARD_WORKERS", 1))
+
+# above this many features (hashed spaces) a dense profile block costs more than a sparse product
+DENSE_PROFILE_MAX_FEATURES = 20000
+CF_COMPONENTS = int(os.getenv("RECOMMENDATION_CF_COMPONENTS", 50))
@@ -0,0 +1,258 @@
+from datetime import datetime, timezone
+
+import numpy as np
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from scoring import round_score
+from settings import RANKING_CHUNK_SIZE, SIMILAR_BOOKS_K, WRITE_BATCH_SIZE
+
+SIMILAR_BOOKS_COLLECTION = "similar_book"
+
+
+def _unit_rows(features):
+    features = np.asarray(features, dtype=np.result_type(features, np.float32))
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    return np.divide(features, norms, out=np.zeros_like(features), where=norms > 0)
+
+
+# cosines below this are floating-point noise between orthogonal vectors
+_SIMILARITY_FLOOR = 1e-9
+
+
+def _neighbor_block(scores, rows, k):
+    """Top-k positive columns per row of ``scores``, ignoring each row's own book."""
+    scores[np.arange(len(rows)), rows] = -np.inf
+    k = min(k, scores.shape[1])
+    indices = np.full((len(rows), k), -1, dtype=np.int32)
+    values = np.zeros((len(rows), k), dtype=np.float32)
+    if k == 0:
+        return indices, values
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    # ties resolve to catalog order, as in the per-user rankings
+    order = np.lexsort((top, -top_scores), axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+    positive = top_scores > _SIMILARITY_FLOOR
+    indices[positive] = top[positive]
+    values[positive] = top_scores[positive]
+    return indices, values
+
+
+def _neighbor_lists(score_rows, n_books, rows, k, chunk_size):
+    width = min(k, n_books)
+    indices = np.full((len(rows), width), -1, dtype=np.int32)
+    values = np.zeros((len(rows), width), dtype=np.float32)
+    for start in range(0, len(rows), chunk_size):
+        block = rows[start:start + chunk_size]
+        indices[start:start + len(block)], values[start:start + len(block)] = _neighbor_block(
+            score_rows(block),
+            block,
+            k
+        )
+    return indices, values
+
+
+def _merge_candidates(indices, values, rows, candidates, scores):
+    """Merge ``candidates`` (scored per row by ``scores``) into the lists of ``rows`` they would enter."""
+    width = indices.shape[1]
+    if not width or not len(rows):
+        return
+    # an empty slot admits any positive score, a full list only one above its k-th
+    bar = np.where(indices[rows, -1] >= 0, values[rows, -1], _SIMILARITY_FLOOR)
+    entering = (scores > bar[:, None]).any(axis=1)
+    rows, scores = rows[entering], scores[entering]
+    if not len(rows):
+        return
+    merged = np.hstack([indices[rows], np.broadcast_to(candidates.astype(np.int32), scores.shape)])
+    merged_scores = np.hstack([np.where(indices[rows] >= 0, values[rows], -np.inf), scores])
+    # ties resolve to catalog order, as in _neighbor_block
+    order = np.lexsort((np.where(merged >= 0, merged, np.iinfo(np.int32).max), -merged_scores), axis=1)[:, :width]
+    top = np.take_along_axis(merged, order, axis=1)
+    top_scores = np.take_along_axis(merged_scores, order, axis=1)
+    positive = top_scores > _SIMILARITY_FLOOR
+    indices[rows] = np.where(positive, top, -1)
+    values[rows] = np.where(positive, top_scores, 0.0)
+
+
+class SimilarityIndex:
+    """Top-K neighbour positions (-1 for empty) and cosine scores per book."""
+
+    KINDS = ("content", "collaborative")
+
+    def __init__(self, book_ids, neighbors):
+        self.book_ids = list(book_ids)
+        self.neighbors = neighbors
+        self._positions = {book_id: position for position, book_id in enumerate(self.book_ids)}
+
+    @staticmethod
+    def _sources(book_matrix, item_features):
+        sources = {}
+        if book_matrix is not None and book_matrix.shape[0]:
+            # TF-IDF rows are L2-normalized, so the dot product is the cosine
+            sources["content"] = lambda rows: (book_matrix[rows] @ book_matrix.T).toarray()
+        if item_features is not None and len(item_features):
+            unit = _unit_rows(item_features)
+            sources["collaborative"] = lambda rows: unit[rows] @ unit.T
+        return sources
+
+    @classmethod
+    def build(cls, book_ids, book_matrix, item_features, k=SIMILAR_BOOKS_K, chunk_size=RANKING_CHUNK_SIZE):
+        return cls(book_ids, cls._compute(len(book_ids), book_matrix, item_features, np.arange(len(book_ids)), k, chunk_size))
+
+    @classmethod
+    def _compute(cls, n_books, book_matrix, item_features, rows, k, chunk_size):
+        return {
+            kind: _neighbor_lists(score_rows, n_books, rows, k, chunk_size)
+            for kind, score_rows in cls._sources(book_matrix, item_features).items()
+        }
+
+    def refresh(
+        self,
+        book_ids,
+        book_matrix,
+        item_features,
+        stale_ids,
+        k=SIMILAR_BOOKS_K,
+        chunk_size=RANKING_CHUNK_SIZE
+    ):
+        """Carry lists over to a new catalog order, rescoring ``stale_ids`` exactly against every book.
+
+        The rescored books are merged into the carried lists they now beat. A list that held a removed or
+        stale book may have lost its k-th neighbour to that change, so it is recomputed in full.
+        """
+        book_ids = list(book_ids)
+        n_books = len(book_ids)
+        positions = {book_id: position for position, book_id in enumerate(book_ids)}
+        remap = np.array([positions.get(book_id, -1) for book_id in self.book_ids] + [-1], dtype=np.int32)
+        stale = np.array(sorted(positions[book_id] for book_id in stale_ids if book_id in positions), dtype=np.int64)
+        is_stale = np.zeros(n_books + 1, dtype=bool)
+        is_stale[stale] = True
+        kept_old = np.array(
+            [self._positions[book_id] for book_id in book_ids if book_id in self._positions],
+            dtype=np.int64
+        )
+        kept_new = np.array([positions[book_id] for book_id in book_ids if book_id in self._positions], dtype=np.int64)
+
+        neighbors = {}
+        for kind, score_rows in self._sources(book_matrix, item_features).items():
+            if kind not in self.neighbors or not len(kept_old):
+                neighbors[kind] = _neighbor_lists(score_rows, n_books, np.arange(n_books), k, chunk_size)
+                continue
+            width = min(k, n_books)
+            indices = np.full((n_books, width), -1, dtype=np.int32)
+            values = np.zeros((n_books, width), dtype=np.float32)
+            old_indices, old_values = self.neighbors[kind]
+            carried = min(width, old_indices.shape[1])
+            held = old_indices[kept_old, :carried] >= 0
+            mapped = np.where(held, remap[old_indices[kept_old, :carried]], -1)
+            indices[kept_new, :carried] = mapped
+            values[kept_new, :carried] = np.where(mapped >= 0, old_values[kept_old, :carried], 0.0)
+            # the kept list is only exact if every neighbour it held is still there, unchanged
+            lost = (held & ((mapped < 0) | is_stale[mapped])).any(axis=1)
+            if carried < width:
+                # a catalog that grew past a short list's width may add neighbours beyond it
+                lost |= held.all(axis=1)
+            recompute = np.zeros(n_books, dtype=bool)
+            recompute[kept_new[lost]] = True
+            recompute[stale] = True
+            merge_rows = np.flatnonzero(~recompute)
+
+            for start in range(0, len(stale), chunk_size):
+                block = stale[start:start + chunk_size]
+                scores = score_rows(block)
+                # cosine is symmetric: column r of the stale rows scores them as candidates for book r
+                _merge_candidates(indices, values, merge_rows, block, scores[:, merge_rows].T)
+                indices[block], values[block] = _neighbor_block(scores, block, k)
+            rows = np.flatnonzero(recompute & ~is_stale[:n_books])
+            if len(rows):
+                indices[rows], values[rows] = _neighbor_lists(score_rows, n_books, rows, k, chunk_size)
+            neighbors[kind] = (indices, values)
+        return SimilarityIndex(book_ids, neighbors)
+
+    def position(self, book_id):
+        return self._positions.get(book_id)
+
+    def candidates(self, position, kind):
+        if kind not in self.neighbors:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        indices, values = self.neighbors[kind]
+        valid = indices[position] >= 0
+        return indices[position][valid], values[position][valid]
+
+
+def similar_books(state, book_id, top_n, kind="hybrid", cf_weight=None, cb_weight=None):
+    """Ranked (bookId, score, contentScore, cfScore) neighbours of ``book_id``, or None if it is unknown."""
+    index = state.get("similarity_index")
+    position = index.position(book_id) if index is not None else None
+    if position is None:
+        return None
+    if kind in SimilarityIndex.KINDS:
+        candidates, scores = index.candidates(position, kind)
+        return [
+            (
+                index.book_ids[candidate],
+                float(score),
+                float(score) if kind == "content" else None,
+                float(score) if kind == "collaborative" else None,
+            )
+            for candidate, score in zip(candidates[:top_n], scores[:top_n])
+        ]
+
+    default_cf, default_cb = state["params"][1], state["params"][2]
+    cf_weight = default_cf if cf_weight is None else cf_weight
+    cb_weight = default_cb if cb_weight is None else cb_weight
+    candidates = np.union1d(index.candidates(position, "content")[0], index.candidates(position, "collaborative")[0])
+    if not len(candidates):
+        return []
+    # exact scores for the merged shortlist, so a book found by one list is not scored 0 by the other
+    content = np.zeros(len(candidates))
+    if state.get("book_matrix") is not None:
+        book_matrix = state["book_matrix"]
+        content = (book_matrix[candidates] @ book_matrix[position].T).toarray().ravel()
+    factor = np.zeros(len(candidates))
+    item_factors_df = state.get("item_factors_df")
+    if item_factors_df is not None and not item_factors_df.empty:
+        unit = _unit_rows(item_factors_df.to_numpy()[np.append(candidates, position)])
+        factor = unit[:-1] @ unit[-1]
+    hybrid = cf_weight * factor + cb_weight * content
+    order = np.lexsort((candidates, -hybrid))
+    return [
+        (index.book_ids[candidates[i]], float(hybrid[i]), float(content[i]), float(factor[i]))
+        for i in order
+        if hybrid[i] > _SIMILARITY_FLOOR
+    ][:top_n]
+
+
+def upsert_similar_books(db, state, top_n=SIMILAR_BOOKS_K, batch_size=WRITE_BATCH_SIZE):
+    """Write hybrid neighbour lists to the similar_book collection for the Node backend."""
+    collection = db[SIMILAR_BOOKS_COLLECTION]
+    now = datetime.now(timezone.utc)
+    written = 0
+    batch = []
+    for book_id in state["book_ids"]:
+        neighbors = similar_books(state, book_id, top_n) or []
+        batch.append(UpdateOne(
+            {"bookId": ObjectId(book_id)},
+            {"$set": {
+                "bookId": ObjectId(book_id),
+                "similar": [{
+                    "productId": ObjectId(neighbor_id),
+                    "score": round_score(score),
+                    "contentScore": round_score(content_score),
+                    "cfScore": round_score(cf_score),
+                } for neighbor_id, score, content_score, cf_score in neighbors],
+                "modelVersion": state.get("version"),
+                "updatedAt": now,
+            }},
+            upsert=True
+        ))
+        if len(batch) >= batch_size:
+            collection.bulk_write(batch, ordered=False)
+            written += len(batch)
+            batch = []
+    if batch:
+        collection.bulk_write(batch, ordered=False)
+        written += len(batch)
+    return written
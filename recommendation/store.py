@@ -0,0 +1,501 @@
+import math
+import os
+import threading
+from array import array
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from pymongo import MongoClient
+
+from settings import INTERACTION_WEIGHTS, LOGGER
+
+STATE_COLLECTION = "recommendation_state"
+WATERMARK_COLLECTIONS = ("book", "author", "genre", "user", "interaction", "review", "order")
+BOOK_CONTENT_FIELDS = ("title", "description", "authorId", "genreId", "publisher", "language", "attributes")
+BOOK_STAT_FIELDS = ("soldQuantity", "reviewsCount", "averageRating")
+BOOK_SUMMARY_FIELDS = ("coverImage", "oldPrice", "newPrice", "stock", "featured")
+WATERMARK_FIELDS = ("updatedAt", "createdAt")
+FETCH_BATCH_SIZE = int(os.getenv("RECOMMENDATION_FETCH_BATCH_SIZE", 5000))
+_TIMESTAMPS = {"updatedAt": 1, "createdAt": 1}
+_PURCHASE_FIELDS = ("quantity", "qty", "count", "price", "metadata.quantity", "metadata.price")
+
+# only the fields the pipeline reads; descriptions of orders, addresses, avatars etc. never leave Mongo
+COLLECTION_PROJECTIONS = {
+    "book": {**{field: 1 for field in BOOK_CONTENT_FIELDS + BOOK_STAT_FIELDS + BOOK_SUMMARY_FIELDS}, **_TIMESTAMPS},
+    "author": {"name": 1, "bio": 1, **_TIMESTAMPS},
+    "genre": {"name": 1, **_TIMESTAMPS},
+    "user": {"role": 1, "firebaseId": 1, "email": 1, **_TIMESTAMPS},
+    "interaction": {
+        "userId": 1,
+        "bookId": 1,
+        "interactionType": 1,
+        **{field: 1 for field in _PURCHASE_FIELDS},
+        **_TIMESTAMPS,
+    },
+    "review": {"userId": 1, "productId": 1, "rating": 1, "content": 1, "review": 1, **_TIMESTAMPS},
+    "order": {
+        "userId": 1,
+        "firebaseId": 1,
+        "customerId": 1,
+        "email": 1,
+        "completed": 1,
+        "products.productId": 1,
+        **{f"products.{field}": 1 for field in _PURCHASE_FIELDS},
+        **_TIMESTAMPS,
+    },
+}
+# tags each document of the unioned history cursor with the collection it came from
+HISTORY_SOURCE_FIELD = "historySource"
+MONGO_CLIENTS = {}
+MONGO_CLIENT_LOCK = threading.Lock()
+
+
+def normalize_user_identifier(value):
+    if value is None:
+        return None
+    if isinstance(value, ObjectId):
+        return str(value)
+    value = str(value).strip()
+    return value or None
+
+
+def attempt_object_id(value):
+    try:
+        return ObjectId(value)
+    except Exception:
+        return None
+
+
+def get_database():
+    uri = os.getenv("DB_URL") or os.getenv("MONGO_URI")
+    if not uri:
+        raise RuntimeError("DB_URL or MONGO_URI must be set in environment")
+
+    # MongoClient is thread-safe and pools connections, so reuse one per URI
+    with MONGO_CLIENT_LOCK:
+        client = MONGO_CLIENTS.get(uri)
+        if client is None:
+            client = MONGO_CLIENTS[uri] = MongoClient(uri)
+    db_name = os.getenv("MONGO_DB_NAME")
+    if db_name:
+        return client[db_name]
+
+    try:
+        return client.get_default_database()
+    except Exception as exc:
+        raise RuntimeError("MONGO_DB_NAME is required when URI has no default database") from exc
+
+
+def _advance_watermark(mark, document):
+    timestamp = _document_timestamp(document)
+    if timestamp is not None and (mark["updatedAt"] is None or timestamp > mark["updatedAt"]):
+        mark["updatedAt"] = timestamp
+    document_id = document.get("_id")
+    if isinstance(document_id, ObjectId) and (mark["_id"] is None or document_id > mark["_id"]):
+        mark["_id"] = document_id
+
+
+def _track_watermark(documents, mark):
+    for document in documents:
+        _advance_watermark(mark, document)
+        yield document
+
+
+def stream_collection(db, name, query=None, watermark=None):
+    cursor = db[name].find(query or {}, COLLECTION_PROJECTIONS[name], batch_size=FETCH_BATCH_SIZE)
+    if watermark is None:
+        return cursor
+    return _track_watermark(cursor, watermark.setdefault(name, {"updatedAt": None, "_id": None}))
+
+
+def event_time(document):
+    value = document.get("createdAt") or document.get("updatedAt")
+    if not isinstance(value, datetime):
+        return math.nan
+    # Mongo hands back naive UTC datetimes
+    return (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).timestamp()
+
+
+def interaction_weight(interaction):
+    interaction_type = (interaction.get("interactionType") or "").lower()
+    if interaction_type == "order":
+        weight = extract_purchase_weight(interaction)
+        if weight <= 0:
+            weight = INTERACTION_WEIGHTS.get("order", 5.0)
+        return weight
+    return INTERACTION_WEIGHTS.get(interaction_type, 0)
+
+
+def read_interaction_columns(interactions):
+    import numpy as np
+
+    user_ids, book_ids, weights, timestamps = [], [], array("d"), array("d")
+    for interaction in interactions:
+        user_id = normalize_user_identifier(interaction.get("userId"))
+        book_id = interaction.get("bookId")
+        if not user_id or not book_id:
+            continue
+        weight = interaction_weight(interaction)
+        if weight <= 0:
+            continue
+        user_ids.append(user_id)
+        book_ids.append(str(book_id))
+        weights.append(float(weight))
+        timestamps.append(event_time(interaction))
+    return {
+        "userId": user_ids,
+        "productId": book_ids,
+        "weight": np.asarray(weights, dtype=float),
+        "timestamp": np.asarray(timestamps, dtype=float),
+    }
+
+
+def read_review_columns(reviews):
+    import numpy as np
+
+    user_ids, product_ids, ratings, texts, timestamps = [], [], array("d"), [], array("d")
+    for review in reviews:
+        product_id = review.get("productId")
+        rating = review.get("rating")
+        text = review.get("content") or review.get("review") or ""
+        user_ids.append(normalize_user_identifier(review.get("userId")))
+        product_ids.append(str(product_id) if product_id else None)
+        ratings.append(float(rating) if rating is not None else np.nan)
+        texts.append(str(text) if text else None)
+        timestamps.append(event_time(review))
+    return {
+        "userId": user_ids,
+        "productId": product_ids,
+        "rating": np.asarray(ratings, dtype=float),
+        "text": texts,
+        "timestamp": np.asarray(timestamps, dtype=float),
+    }
+
+
+def read_order_columns(orders):
+    import numpy as np
+
+    order_refs, order_index, product_ids, weights, timestamps = [], array("l"), [], array("d"), array("d")
+    for order in orders:
+        if order is None or not order.get("products"):
+            continue
+        if order.get("completed") is False:
+            continue
+        ordered_at = event_time(order)
+        for product in order.get("products", []):
+            book_id = product.get("productId")
+            if not book_id:
+                continue
+            weight = extract_purchase_weight(product)
+            if weight <= 0:
+                continue
+            order_index.append(len(order_refs))
+            product_ids.append(str(book_id))
+            weights.append(float(weight))
+            timestamps.append(ordered_at)
+        order_refs.append({field: order.get(field) for field in ("userId", "firebaseId", "customerId", "email")})
+    return {
+        "orders": order_refs,
+        "orderIndex": np.asarray(order_index, dtype=np.int64),
+        "productId": product_ids,
+        "weight": np.asarray(weights, dtype=float),
+        "timestamp": np.asarray(timestamps, dtype=float),
+    }
+
+
+def fetch_collections(db):
+    LOGGER.info("Fetching collections from MongoDB...")
+    watermark = {}
+    books = list(stream_collection(db, "book", watermark=watermark))
+    users = list(stream_collection(db, "user", watermark=watermark))
+    authors = list(stream_collection(db, "author", watermark=watermark))
+    genres = list(stream_collection(db, "genre", watermark=watermark))
+    interactions = read_interaction_columns(stream_collection(db, "interaction", watermark=watermark))
+    reviews = read_review_columns(stream_collection(db, "review", watermark=watermark))
+    orders = read_order_columns(stream_collection(db, "order", watermark=watermark))
+    LOGGER.info(
+        "Fetched %s books, %s interactions, %s reviews, %s users",
+        len(books),
+        len(interactions["userId"]),
+        len(reviews["userId"]),
+        len(users)
+    )
+    LOGGER.info("Fetched %s orders (%s order lines)", len(orders["orders"]), len(orders["productId"]))
+    return books, interactions, reviews, users, authors, genres, orders, watermark
+
+
+def _document_timestamp(document):
+    for field in WATERMARK_FIELDS:
+        value = document.get(field)
+        if isinstance(value, datetime):
+            return value
+    return None
+
+
+def compute_watermark(documents, previous=None):
+    mark = {"updatedAt": None, "_id": None, **(previous or {})}
+    for document in documents or []:
+        _advance_watermark(mark, document)
+    return mark
+
+
+def build_watermark_filter(mark):
+    clauses = []
+    if not mark:
+        return {}
+    if mark.get("_id") is not None:
+        clauses.append({"_id": {"$gt": mark["_id"]}})
+    if mark.get("updatedAt") is not None:
+        clauses.extend({field: {"$gt": mark["updatedAt"]}} for field in WATERMARK_FIELDS)
+    else:
+        # nothing was timestamped at the last run, so any timestamped document is newer
+        clauses.extend({field: {"$exists": True}} for field in WATERMARK_FIELDS)
+    return {"$or": clauses}
+
+
+def load_watermark(db):
+    state = db[STATE_COLLECTION].find_one({"_id": "watermark"})
+    if not state:
+        return None
+    return state.get("collections") or None
+
+
+def save_watermark(db, watermark):
+    db[STATE_COLLECTION].update_one(
+        {"_id": "watermark"},
+        {"$set": {"collections": watermark, "updatedAt": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+
+def save_serving_version(db):
+    """Bump the marker that tells every serving process its cached recommendations may be stale."""
+    db[STATE_COLLECTION].update_one(
+        {"_id": "serving"},
+        {"$set": {"version": ObjectId(), "updatedAt": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+
+def load_serving_version(db):
+    state = db[STATE_COLLECTION].find_one({"_id": "serving"}, {"version": 1})
+    return state.get("version") if state else None
+
+
+def fetch_changed_documents(db, watermark, collections):
+    changes = {}
+    for name in collections:
+        changes[name] = list(stream_collection(db, name, build_watermark_filter(watermark.get(name))))
+    LOGGER.info(
+        "Fetched changes since last run: %s",
+        ", ".join(f"{len(docs)} {name}" for name, docs in changes.items())
+    )
+    return changes
+
+
+def has_changes(db, watermark, collections):
+    for name in collections:
+        if db[name].find_one(build_watermark_filter(watermark.get(name)), {"_id": 1}) is not None:
+            return True
+    return False
+
+
+def _user_id_variants(user_ids):
+    variants = []
+    for user_id in user_ids:
+        variants.append(user_id)
+        object_id = attempt_object_id(user_id)
+        if object_id is not None:
+            variants.append(object_id)
+    return variants
+
+
+def fetch_user_history(db, user_ids, user_registry):
+    id_variants = _user_id_variants(user_ids)
+    firebase_ids = []
+    emails = []
+    for user_id in user_ids:
+        profile = user_registry.get(user_id)
+        if profile is None:
+            continue
+        if profile.firebaseId:
+            firebase_ids.append(profile.firebaseId)
+        if profile.email:
+            emails.append(profile.email)
+
+    order_clauses = [
+        {"userId": {"$in": id_variants}},
+        {"customerId": {"$in": id_variants}},
+    ]
+    if firebase_ids:
+        order_clauses.append({"firebaseId": {"$in": firebase_ids}})
+    if emails:
+        order_clauses.append({"email": {"$in": emails}})
+    # one round trip on the online path: reviews and orders are unioned into the interaction cursor
+    history = {"interaction": [], "review": [], "order": []}
+    cursor = db["interaction"].aggregate([
+        *_history_stages("interaction", {"userId": {"$in": id_variants}}),
+        {"$unionWith": {"coll": "review", "pipeline": _history_stages("review", {"userId": {"$in": id_variants}})}},
+        {"$unionWith": {"coll": "order", "pipeline": _history_stages("order", {"$or": order_clauses})}},
+    ], batchSize=FETCH_BATCH_SIZE)
+    for document in cursor:
+        history[document.pop(HISTORY_SOURCE_FIELD)].append(document)
+    return (
+        read_interaction_columns(history["interaction"]),
+        read_review_columns(history["review"]),
+        read_order_columns(history["order"]),
+    )
+
+
+def _history_stages(name, query):
+    return [
+        {"$match": query},
+        {"$project": {**COLLECTION_PROJECTIONS[name], HISTORY_SOURCE_FIELD: {"$literal": name}}},
+    ]
+
+
+class UserProfile:
+    """The few fields the pipeline reads from a user document, shared by every identifier of that user."""
+
+    __slots__ = ("code", "primaryId", "firebaseId", "email")
+
+    def __init__(self, code, primary_id, firebase_id=None, email=None):
+        self.code = code
+        self.primaryId = primary_id
+        self.firebaseId = firebase_id
+        self.email = email
+
+
+class UserRegistry:
+    """Dense int32 codes for users, reachable by ObjectId, firebaseId or email; ObjectIds packed 12 bytes per code."""
+
+    def __init__(self, users=()):
+        self.codes = {}
+        self.email_codes = {}
+        self.profiles = []
+        self.refs = bytearray()
+        self.update(users)
+
+    def __len__(self):
+        return len(self.profiles)
+
+    def __contains__(self, identifier):
+        return identifier in self.codes
+
+    def update(self, users):
+        # first identifier wins within a batch, later batches override earlier ones
+        codes, email_codes = {}, {}
+        for user in users:
+            if user.get("role") != "user":
+                continue
+            user_ref = user.get("_id")
+            if not user_ref:
+                continue
+            user_ref = user_ref if isinstance(user_ref, ObjectId) else attempt_object_id(user_ref)
+            if user_ref is None:
+                continue
+            primary_id = str(user_ref)
+            code = self.codes.get(primary_id)
+            if code is None:
+                code = len(self.profiles)
+                self.profiles.append(None)
+                self.refs += user_ref.binary
+            email = (user.get("email") or "").strip().lower() or None
+            self.profiles[code] = UserProfile(code, primary_id, user.get("firebaseId") or None, email)
+            for identifier in (primary_id, user.get("firebaseId")):
+                normalized = normalize_user_identifier(identifier)
+                if normalized:
+                    codes.setdefault(normalized, code)
+            if email:
+                email_codes.setdefault(email, code)
+        self.codes.update(codes)
+        self.email_codes.update(email_codes)
+        return self
+
+    def updated(self, users):
+        registry = UserRegistry()
+        registry.codes = dict(self.codes)
+        registry.email_codes = dict(self.email_codes)
+        registry.profiles = list(self.profiles)
+        registry.refs = bytearray(self.refs)
+        return registry.update(users)
+
+    def subset(self, user_ids):
+        """Registry of just ``user_ids``, small enough to ship to a shard worker."""
+        registry = UserRegistry()
+        for user_id in user_ids:
+            profile = self.get(user_id)
+            if profile is None or profile.primaryId in registry.codes:
+                continue
+            code = len(registry.profiles)
+            registry.profiles.append(UserProfile(code, profile.primaryId, profile.firebaseId, profile.email))
+            registry.refs += self.refs[12 * profile.code:12 * profile.code + 12]
+            registry.codes[profile.primaryId] = code
+        return registry
+
+    def get(self, identifier):
+        code = self.codes.get(identifier)
+        return self.profiles[code] if code is not None else None
+
+    def resolve(self, identifier):
+        """Primary id for any known identifier, or the identifier itself."""
+        code = self.codes.get(identifier)
+        return self.profiles[code].primaryId if code is not None else identifier
+
+    def by_email(self, email):
+        code = self.email_codes.get(email)
+        return self.profiles[code].primaryId if code is not None else None
+
+    def user_ref(self, identifier):
+        code = self.codes.get(identifier)
+        if code is None:
+            return None
+        return ObjectId(bytes(self.refs[12 * code:12 * code + 12]))
+
+    def primary_ids(self):
+        return [profile.primaryId for profile in self.profiles]
+
+
+def safe_float(value, default=0.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def extract_purchase_weight(source):
+    metadata = source.get("metadata", {}) if isinstance(source.get("metadata"), dict) else {}
+    quantity = (
+        source.get("quantity")
+        or source.get("qty")
+        or source.get("count")
+        or metadata.get("quantity")
+        or 1.0
+    )
+    price = source.get("price") or metadata.get("price") or 0.0
+    qty_val = max(safe_float(quantity, 1.0), 0.0)
+    price_val = max(safe_float(price, 0.0), 0.0)
+    return qty_val * price_val
+
+
+def resolve_order_user(order, user_registry):
+    candidates = [
+        normalize_user_identifier(order.get("userId")),
+        normalize_user_identifier(order.get("firebaseId")),
+        normalize_user_identifier(order.get("customerId")),
+    ]
+    for candidate in candidates:
+        if candidate and candidate in user_registry:
+            return user_registry.resolve(candidate)
+    email = (order.get("email") or "").strip().lower()
+    if email:
+        return user_registry.by_email(email)
+    return None
+
+
+def fetch_book_references(db, books):
+    author_ids = list({book.get("authorId") for book in books if book.get("authorId")})
+    genre_ids = list({book.get("genreId") for book in books if book.get("genreId")})
+    authors = list(stream_collection(db, "author", {"_id": {"$in": author_ids}}))
+    genres = list(stream_collection(db, "genre", {"_id": {"$in": genre_ids}}))
+    return authors, genres
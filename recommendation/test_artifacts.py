@@ -0,0 +1,90 @@
+import threading
+import time
+
+import numpy as np
+
+import artifacts
+import pipeline
+from artifacts import get_model_state, load_model_artifacts
+from caches import PIPELINE_STATE
+from serving import recommend_for_user
+from settings import MODEL_DIR
+
+
+def _recommend(db, state, user_id):
+    return recommend_for_user(db, state, user_id, top_n=12, cf_weight=0.6, cb_weight=0.4)
+
+
+def test_restart_warm_starts_from_the_saved_artifacts(db):
+    pipeline.run_pipeline(top_n=12, cf_weight=0.6, cb_weight=0.4, db=db)
+    built = get_model_state(db)
+    user_id = str(db.user.find_one({"firebaseId": "firebase-4"})["_id"])
+    expected = _recommend(db, built, user_id)
+
+    # a restarted service has nothing in memory
+    PIPELINE_STATE.clear()
+    loaded = get_model_state(db)
+    assert loaded is not built and loaded["version"] == built["version"]
+    assert (loaded["book_matrix"] != built["book_matrix"]).nnz == 0
+    assert np.allclose(loaded["item_factors_df"].to_numpy(), built["item_factors_df"].to_numpy())
+    assert _recommend(db, loaded, user_id) == expected
+
+
+def test_artifacts_failing_their_checksum_are_ignored(db):
+    pipeline.run_pipeline(top_n=12, cf_weight=0.6, cb_weight=0.4, db=db)
+    version_dir = MODEL_DIR / (MODEL_DIR / "CURRENT").read_text(encoding="utf-8").strip()
+    assert load_model_artifacts() is not None
+
+    path = next(version_dir.glob("*.npy"))
+    data = bytearray(path.read_bytes())
+    data[-1] ^= 0xFF
+    path.write_bytes(bytes(data))
+    assert load_model_artifacts() is None
+    assert load_model_artifacts(verify=False) is not None
+
+
+def _count_loads(monkeypatch, delay=0.0):
+    loads = []
+    load = artifacts.load_model_state
+
+    def counted_load(db):
+        loads.append(db)
+        time.sleep(delay)
+        return load(db)
+
+    monkeypatch.setattr(artifacts, "load_model_state", counted_load)
+    return loads
+
+
+def test_concurrent_requests_load_the_model_once(db, monkeypatch):
+    pipeline.run_pipeline(top_n=12, cf_weight=0.6, cb_weight=0.4, db=db)
+    PIPELINE_STATE.clear()
+    loads = _count_loads(monkeypatch, delay=0.05)
+    states = []
+    threads = [threading.Thread(target=lambda: states.append(get_model_state(db))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(loads) == 1
+    assert len(states) == 4 and all(state is states[0] for state in states)
+
+
+def test_a_rejected_load_is_remembered_until_it_may_be_retried(db, monkeypatch):
+    pipeline.run_pipeline(top_n=12, cf_weight=0.6, cb_weight=0.4, db=db)
+    PIPELINE_STATE.clear()
+    # any catalog drift now requires a refit
+    monkeypatch.setattr(artifacts, "CATALOG_CHANGE_THRESHOLD", -1.0)
+    loads = _count_loads(monkeypatch)
+    assert get_model_state(db) is None
+    assert get_model_state(db) is None
+    assert len(loads) == 1
+
+    PIPELINE_STATE["retry_at"] = 0.0
+    assert get_model_state(db) is None
+    assert len(loads) == 2
+
+    # a build stores a model, which is served without another load
+    pipeline.run_pipeline(top_n=12, cf_weight=0.6, cb_weight=0.4, db=db)
+    assert get_model_state(db) is PIPELINE_STATE["model"]
+    assert len(loads) == 2
@@ -0,0 +1,108 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from bson import ObjectId
+
+import benchmark
+from evaluation import EvaluationSplit, MetricTotals, _split_documents, choose_cutoff, evaluate_weights
+from store import event_time
+
+CUTOFF = datetime(2024, 6, 1, tzinfo=timezone.utc)
+BEFORE, AFTER = CUTOFF - timedelta(days=3), CUTOFF + timedelta(days=3)
+
+
+def test_documents_split_strictly_after_the_cutoff():
+    documents = [
+        {"_id": "before", "createdAt": BEFORE},
+        {"_id": "at", "createdAt": CUTOFF},
+        {"_id": "after", "createdAt": AFTER},
+        # naive datetimes are UTC, and updatedAt stands in for a missing createdAt
+        {"_id": "naive", "updatedAt": AFTER.replace(tzinfo=None)},
+        {"_id": "undated"},
+    ]
+
+    train, test = _split_documents(documents, CUTOFF.timestamp(), event_time)
+
+    assert [document["_id"] for document in train] == ["before", "at", "undated"]
+    assert [document["_id"] for document in test] == ["after", "naive"]
+    # dates 1..5: the newest 20% starts at the 0.8 quantile, 1 + 0.8 * 4; undated documents are skipped
+    dated = [{"createdAt": CUTOFF + timedelta(seconds=second)} for second in range(1, 6)]
+    assert choose_cutoff(dated + [{}], 0.2) == pytest.approx(CUTOFF.timestamp() + 4.2)
+
+
+def test_precision_recall_and_ndcg_by_hand():
+    # user 0 bought books 1 and 4 after the cutoff, user 1 bought book 2
+    split = SimpleNamespace(book_ids=list(range(6)), truth=np.array([1, 4, 6 + 2]), relevant=np.array([2, 1]))
+    totals = MetricTotals(n_books=6, top_n=3)
+
+    totals.add(split, [0, 1], np.array([[4, 0, 1], [3, 5, -1]]), fallbacks=1)
+
+    # user 0 hits at ranks 1 and 3: DCG 1 + 1/log2(4) over the ideal 1 + 1/log2(3); user 1 misses
+    ndcg = (1 + 1 / np.log2(4)) / (1 + 1 / np.log2(3))
+    assert totals.summary() == {
+        "precision": round((2 / 3 + 0) / 2, 5),
+        "recall": round((2 / 2 + 0) / 2, 5),
+        "ndcg": round(ndcg / 2, 5),
+        "hitRate": 0.5,
+        # books 0, 1, 3, 4 and 5 were shown; the empty slot is not a book
+        "coverage": round(5 / 6, 5),
+        "fallbackUsers": 1,
+        "scoringCpuSeconds": 0.0,
+        "usersPerCpuSecond": None,
+    }
+
+
+def _catalog_database():
+    users = [ObjectId(f"65a00000000000000000000{index}") for index in range(1, 4)]
+    books = [ObjectId(f"65b00000000000000000000{index}") for index in range(1, 5)]
+    db = benchmark.FakeDatabase()
+    db.add_collection("user", [{"_id": user, "role": "user"} for user in users])
+    db.add_collection("book", [
+        {"_id": book, "title": f"book {index} title", "soldQuantity": sold}
+        for index, (book, sold) in enumerate(zip(books, (5, 20, 30, 10)), start=1)
+    ])
+    for name in ("author", "genre", "review", "order"):
+        db.add_collection(name, [])
+
+    def interaction(user, book, interaction_type, when=None):
+        return {"userId": user, "bookId": book, "interactionType": interaction_type, "createdAt": when}
+
+    u1, u2, u3 = users
+    b1, b2, b3, b4 = books
+    db.add_collection("interaction", [
+        interaction(u1, b1, "view", BEFORE),
+        interaction(u3, b4, "wishlist", BEFORE),
+        interaction(u3, b3, "view"),
+        interaction(u1, b2, "order", AFTER),
+        # rebuying a book from the training history is not something to recommend
+        interaction(u1, b1, "order", AFTER),
+        # u2 has no history before the cutoff
+        interaction(u2, b3, "order", AFTER),
+        interaction(u3, b2, "view", AFTER),
+    ])
+    return db, users, books
+
+
+def test_held_out_purchases_and_cold_users_by_hand():
+    db, (u1, u2, _), (_, b2, b3, _) = _catalog_database()
+
+    split = EvaluationSplit.build(db, cutoff=CUTOFF.timestamp())
+
+    counts = split.counts
+    assert (counts["trainInteractions"], counts["heldOutInteractions"]) == (3, 4)
+    assert (counts["evaluatedUsers"], counts["coldUsers"], counts["heldOutPurchases"]) == (2, 1, 2)
+    assert split.users == [str(u1), str(u2)]
+    positions = {book_id: position for position, book_id in enumerate(split.book_ids)}
+    assert split.truth.tolist() == [0 * 4 + positions[str(b2)], 1 * 4 + positions[str(b3)]]
+
+    # by popularity, both users are shown b3 then b2 (u1 already had b1)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        metrics = evaluate_weights(split, None, [None], 2, executor)[None]
+    # u1 finds b2 at rank 2, u2 finds b3 at rank 1
+    assert metrics["precision"] == 0.5
+    assert metrics["recall"] == 1.0
+    assert metrics["ndcg"] == round((1 / np.log2(3) + 1) / 2, 5)
+    assert (metrics["hitRate"], metrics["coverage"], metrics["fallbackUsers"]) == (1.0, 0.5, 2)
@@ -0,0 +1,48 @@
+import pytest
+
+import events
+import pipeline
+from events import EventIngestor, parse_event
+from jobs import build_lock
+
+
+def test_review_events_carry_their_rating_like_stored_reviews():
+    assert parse_event({"userId": "u1", "productId": "b1", "rating": 3, "interactionType": "review"}) == [
+        ("u1", "b1", 3.0)
+    ]
+    assert parse_event({"userId": "u1", "bookId": "b1", "interactionType": "rating"}) == [("u1", "b1", 4.0)]
+    with pytest.raises(ValueError):
+        parse_event({"userId": "u1", "productId": "b1", "interactionType": "review"})
+
+
+def test_batches_hold_their_writes_while_a_build_runs(db, monkeypatch):
+    pipeline.run_pipeline(top_n=12, cf_weight=0.6, cb_weight=0.4, db=db)
+    user_ref = db.user.find_one({"firebaseId": "firebase-5"})["_id"]
+    before = dict(next(db.recommendation.find({"userId": {"$in": [user_ref]}})))
+    # a recommended book is one the user has not interacted with yet
+    book_ref = before["recommendedProductIds"][0]
+    ingestor = EventIngestor()
+    batch = [(str(user_ref), str(book_ref), 5.0, float("inf"))]
+
+    # the batch is scored and returns instead of waiting, so the worker keeps draining the queue
+    with build_lock():
+        assert ingestor.process(batch, db) == 0
+    assert ingestor.stats["heldBatches"] == 1
+    assert next(db.recommendation.find({"userId": {"$in": [user_ref]}}))["updatedAt"] == before["updatedAt"]
+
+    # a build that swaps the model between scoring and writing holds the write again
+    def swapping_lock(**kwargs):
+        pipeline.PIPELINE_STATE["model"] = dict(pipeline.PIPELINE_STATE["model"])
+        return build_lock(**kwargs)
+
+    monkeypatch.setattr(events, "build_lock", swapping_lock)
+    assert ingestor.process([], db) == 0
+    assert ingestor.stats["heldBatches"] == 2
+    monkeypatch.undo()
+
+    # the next batch, even an empty one, writes the held user against the live model
+    assert ingestor.process([], db) == 1
+    after = next(db.recommendation.find({"userId": {"$in": [user_ref]}}))
+    assert after["metadata"]["totalSignals"] == before["metadata"]["totalSignals"] + 1
+    assert book_ref not in after["recommendedProductIds"]
+    assert ingestor.process([], db) == 0
@@ -0,0 +1,108 @@
+import threading
+
+import pytest
+
+from jobs import BuildJobQueue, _merge_build_params
+
+
+class _Runner:
+    """A build runner that holds every build until it is released."""
+
+    def __init__(self):
+        self.calls = []
+        self.started = threading.Condition()
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, tracker=None, **params):
+        with self.started:
+            self.calls.append(params)
+            self.started.notify_all()
+        assert self.release.wait(5)
+        if params.get("fail"):
+            raise RuntimeError("build failed")
+        return {"usersUpdated": len(self.calls)}
+
+    def wait_started(self, builds):
+        with self.started:
+            assert self.started.wait_for(lambda: len(self.calls) >= builds, timeout=5)
+
+
+def _params(**overrides):
+    return {"top_n": 12, "report": False, "profile": False, "mode": "incremental", "memory_budget": None, **overrides}
+
+
+def test_triggers_fold_into_the_queued_build_but_not_the_running_one():
+    runner = _Runner()
+    runner.release.clear()
+    queue = BuildJobQueue(runner)
+
+    running = queue.submit(_params(mode="full"))
+    runner.wait_started(1)
+    queued = queue.submit(_params(memory_budget=800 * 2**20))
+    assert queue.submit(_params(top_n=20, report=True, memory_budget=600 * 2**20)) == queued
+    assert queue.submit(_params(mode="full", profile=True)) == queued
+    assert queued != running
+    assert (queue.get(running)["status"], queue.get(running)["triggers"]) == ("running", 1)
+    assert (queue.get(queued)["status"], queue.get(queued)["triggers"]) == ("queued", 3)
+
+    runner.release.set()
+    assert queue.wait(queued, timeout=5)["status"] == "succeeded"
+    assert queue.get(running)["status"] == "succeeded"
+    # one follow-up build covers everything folded into it
+    assert runner.calls[1:] == [_params(top_n=12, report=True, profile=True, mode="full", memory_budget=600 * 2**20)]
+
+
+@pytest.mark.parametrize("queued, incoming, expected", [
+    (None, None, None),
+    (None, 512, 512),
+    (512, None, 512),
+    (800, 600, 600),
+    (600, 800, 600),
+])
+def test_merged_builds_keep_the_tightest_memory_budget(queued, incoming, expected):
+    merged = _merge_build_params(_params(memory_budget=queued), _params(memory_budget=incoming))
+    assert merged["memory_budget"] == expected
+
+
+@pytest.mark.parametrize("queued, incoming, expected", [
+    ("incremental", "incremental", "incremental"),
+    ("incremental", "full", "full"),
+    ("full", "incremental", "full"),
+])
+def test_a_full_build_beats_an_incremental_one(queued, incoming, expected):
+    assert _merge_build_params(_params(mode=queued), _params(mode=incoming))["mode"] == expected
+
+
+def test_merged_builds_take_the_latest_blend_and_any_report_or_profile():
+    merged = _merge_build_params(_params(report=True, top_n=5), _params(profile=True, top_n=8))
+    assert (merged["top_n"], merged["report"], merged["profile"]) == (8, True, True)
+
+
+def test_a_failed_build_is_reported_and_the_queue_keeps_running():
+    runner = _Runner()
+    queue = BuildJobQueue(runner)
+
+    failed = queue.wait(queue.submit(_params(fail=True)), timeout=5)
+    assert (failed["status"], failed["error"], failed["result"]) == ("failed", "build failed", None)
+    assert failed["finishedAt"] is not None
+
+    succeeded = queue.wait(queue.submit(_params()), timeout=5)
+    assert (succeeded["status"], succeeded["result"]) == ("succeeded", {"usersUpdated": 2})
+
+
+def test_history_drops_the_oldest_finished_jobs_only():
+    runner = _Runner()
+    queue = BuildJobQueue(runner, history=1)
+    finished = [queue.wait(queue.submit(_params()), timeout=5)["jobId"] for _ in range(3)]
+    assert [queue.get(job_id) is not None for job_id in finished] == [False, False, True]
+
+    runner.release.clear()
+    running = queue.submit(_params())
+    runner.wait_started(4)
+    queued = queue.submit(_params())
+    # unfinished jobs are kept even past the history size
+    assert queue.get(finished[-1]) is None
+    assert queue.get(running)["status"] == "running" and queue.get(queued)["status"] == "queued"
+    runner.release.set()
+    assert queue.wait(queued, timeout=5)["status"] == "succeeded"
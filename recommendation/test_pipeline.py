@@ -0,0 +1,184 @@
+import os
+import pickle
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+from bson import ObjectId
+
+import benchmark
+import pipeline
+from settings import INTERACTION_WEIGHTS
+
+SHARD_OUTPUT = "RECOMMENDATION_TEST_SHARD_OUTPUT"
+
+
+class _ShardCollection(benchmark.FakeCollection):
+    def bulk_write(self, requests, ordered=True):
+        super().bulk_write(requests, ordered)
+        # each shard's database leaves a snapshot of everything it has written so far
+        with open(os.path.join(os.environ[SHARD_OUTPUT], f"{os.getpid()}.pkl"), "ab") as handle:
+            pickle.dump(list(self.find()), handle)
+
+
+class _ShardDatabase(benchmark.FakeDatabase):
+    def __getitem__(self, name):
+        return self._collections.setdefault(name, _ShardCollection(unique_user=True))
+
+
+def _read_shard_output(directory):
+    documents = {}
+    for name in os.listdir(directory):
+        with open(os.path.join(directory, name), "rb") as handle:
+            while True:
+                try:
+                    snapshot = pickle.load(handle)
+                except EOFError:
+                    break
+                documents.update((document["userId"], document) for document in snapshot)
+    return documents
+
+
+def _ranked(documents):
+    return {
+        str(user_id): (
+            [str(score["productId"]) for score in document["scores"]],
+            [score["hybridScore"] for score in document["scores"]],
+            document["recommendationMethod"],
+        )
+        for user_id, document in documents.items()
+    }
+
+
+def _with_shards(plan):
+    plan.shard_workers = 2
+    return plan
+
+
+def _build(db, **kwargs):
+    return pipeline.run_pipeline(top_n=12, cf_weight=0.6, cb_weight=0.4, db=db, **kwargs)
+
+
+def test_sharded_build_writes_what_a_single_process_build_does(db, fresh_db, monkeypatch, tmp_path):
+    summary = _build(db)
+    expected = _ranked({document["userId"]: document for document in db.recommendation.find()})
+    assert summary["usersUpdated"] == len(expected) > 0
+
+    monkeypatch.setenv(SHARD_OUTPUT, str(tmp_path))
+    planned = pipeline.plan_execution
+    monkeypatch.setattr(pipeline, "plan_execution", lambda *args, **kwargs: _with_shards(planned(*args, **kwargs)))
+    write_sharded = pipeline.upsert_recommendations_sharded
+    monkeypatch.setattr(
+        pipeline,
+        "upsert_recommendations_sharded",
+        lambda **kwargs: write_sharded(**kwargs, connect=_ShardDatabase)
+    )
+    summary = _build(fresh_db())
+    assert [shard["shard"] for shard in summary["shards"]] == [0, 1]
+
+    actual = _ranked(_read_shard_output(tmp_path))
+    assert actual.keys() == expected.keys()
+    for user_id, (book_ids, scores, method) in expected.items():
+        assert actual[user_id][0] == book_ids
+        assert actual[user_id][2] == method
+        assert np.allclose(actual[user_id][1], scores, equal_nan=True)
+
+
+def test_users_partition_into_stable_balanced_shards():
+    user_refs = [ObjectId() for _ in range(4000)]
+
+    shards = [pipeline._shard_of(str(user_ref), 4) for user_ref in user_refs]
+
+    # an ObjectId and its string land together, so a worker never splits one user's document
+    assert shards == [pipeline._shard_of(user_ref, 4) for user_ref in user_refs]
+    assert set(shards) == {0, 1, 2, 3}
+    assert all(abs(shards.count(shard) - 1000) < 150 for shard in range(4))
+    # spawned workers and later runs hash strings with other seeds and must still agree
+    script = f"import pipeline; print([pipeline._shard_of(u, 4) for u in {[str(r) for r in user_refs[:50]]!r}])"
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env={**os.environ, "PYTHONHASHSEED": "12345"},
+        capture_output=True,
+        text=True,
+        check=True
+    ).stdout
+    assert output.strip() == str(shards[:50])
+
+
+def test_incremental_build_rescores_only_the_users_with_new_signals(db):
+    _build(db)
+    user_ref = db.user.find_one({"firebaseId": "firebase-9"})["_id"]
+    before = {document["userId"]: dict(document) for document in db.recommendation.find()}
+    book_ref = before[user_ref]["recommendedProductIds"][0]
+    db.interaction.insert_one({
+        "userId": user_ref,
+        "bookId": book_ref,
+        "interactionType": "wishlist",
+        "createdAt": datetime.now(timezone.utc),
+    })
+
+    summary = _build(db, mode="incremental")
+    assert (summary["mode"], summary["usersUpdated"]) == ("incremental", 1)
+    after = {document["userId"]: document for document in db.recommendation.find()}
+    assert after[user_ref]["metadata"]["totalSignals"] == before[user_ref]["metadata"]["totalSignals"] + 1
+    assert book_ref not in after[user_ref]["recommendedProductIds"]
+    unchanged = [ref for ref in before if ref != user_ref]
+    assert all(after[ref]["updatedAt"] == before[ref]["updatedAt"] for ref in unchanged)
+
+
+def test_failed_incremental_build_leaves_the_live_model_untouched(db, monkeypatch):
+    _build(db)
+    state = pipeline.PIPELINE_STATE["model"]
+    trending_scores = state["trending"].scores.copy()
+    user_ref = db.user.find_one({"firebaseId": "firebase-9"})["_id"]
+    book_ref = db.book.find_one()["_id"]
+    db.interaction.insert_one({
+        "userId": user_ref,
+        "bookId": book_ref,
+        "interactionType": "wishlist",
+        "createdAt": datetime.now(timezone.utc),
+    })
+    write = pipeline.upsert_recommendations
+
+    def failing_write(**kwargs):
+        raise RuntimeError("write failed")
+
+    monkeypatch.setattr(pipeline, "upsert_recommendations", failing_write)
+    with pytest.raises(RuntimeError):
+        _build(db, mode="incremental")
+    assert pipeline.PIPELINE_STATE["model"] is state
+    assert np.array_equal(state["trending"].scores, trending_scores)
+
+    # the retry sees the same event again and must count it once
+    monkeypatch.setattr(pipeline, "upsert_recommendations", write)
+    summary = _build(db, mode="incremental")
+    assert (summary["mode"], summary["usersUpdated"]) == ("incremental", 1)
+    retried = pipeline.PIPELINE_STATE["model"]["trending"]
+    position = retried.book_ids.index(str(book_ref))
+    gained = retried.scores[position] - trending_scores[state["trending"].book_ids.index(str(book_ref))]
+    assert np.isclose(gained, INTERACTION_WEIGHTS["wishlist"], rtol=1e-3)
+
+
+def test_writes_go_out_in_bounded_batches_and_skip_unchanged_documents(db, monkeypatch):
+    monkeypatch.setattr(pipeline, "WRITE_BATCH_SIZE", 7)
+    batches = []
+    write = benchmark.FakeCollection.bulk_write
+
+    def recorded_write(self, requests, ordered=True):
+        batches.append((len(requests), ordered))
+        return write(self, requests, ordered)
+
+    monkeypatch.setattr(benchmark.FakeCollection, "bulk_write", recorded_write)
+    summary = _build(db)
+    assert sum(size for size, _ in batches) == summary["usersUpdated"] > 7
+    assert all(size <= 7 and not ordered for size, ordered in batches)
+
+    # documents whose contentHash matches the stored one are not written again
+    stored = [dict(document) for document in db.recommendation.find()][:5]
+    assert pipeline._write_recommendation_batch(db.recommendation, stored) == 0
+    stored[2] = {**stored[2], "metadata": {**stored[2]["metadata"], "contentHash": "changed"}}
+    assert pipeline._write_recommendation_batch(db.recommendation, stored) == 1
+    assert batches[-1] == (1, False)
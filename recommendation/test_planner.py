@@ -0,0 +1,70 @@
+import numpy as np
+
+import pipeline
+from jobs import current_rss_bytes
+from planner import PLAN_MIN_CHUNK_SIZE, ExecutionPlan, _plan_estimates, plan_execution
+from settings import RANKING_CHUNK_SIZE
+
+WORKLOAD = {
+    "users": 200000,
+    "books": 50000,
+    "pairs": 2000000,
+    "features": 4096,
+    "bookNnz": 1500000,
+    "profileNnz": 40000000,
+    "components": 50,
+    "topN": 12,
+}
+
+
+def test_unbounded_plan_keeps_the_defaults():
+    plan = plan_execution(None, WORKLOAD, baseline=0)
+    assert (plan.dtype, plan.chunk_size, plan.stream_profiles) == ("float64", RANKING_CHUNK_SIZE, False)
+    assert plan.as_dict()["fits"]
+
+
+def test_budget_shrinks_the_plan_until_it_fits():
+    unbounded = plan_execution(None, WORKLOAD, baseline=0)
+    budget = unbounded.estimated_peak // 2
+    plan = plan_execution(budget, WORKLOAD, baseline=0)
+    assert plan.estimated_peak <= budget
+    assert plan.stream_profiles and plan.estimates["profiles"] == 0
+    assert PLAN_MIN_CHUNK_SIZE <= plan.chunk_size <= RANKING_CHUNK_SIZE
+
+
+def test_estimates_follow_the_score_dtype():
+    wide = _plan_estimates(ExecutionPlan(dtype="float64"), WORKLOAD)
+    narrow = _plan_estimates(ExecutionPlan(dtype="float32"), WORKLOAD)
+    # float values plus int32 column indices per stored profile entry
+    assert wide["profiles"] == WORKLOAD["profileNnz"] * (8 + 4)
+    assert narrow["profiles"] == WORKLOAD["profileNnz"] * (4 + 4)
+    assert narrow["ranking"] < wide["ranking"] and narrow["similarity"] < wide["similarity"]
+    assert narrow["resident"] == wide["resident"]
+
+
+def _scores(db):
+    return {
+        str(document["userId"]): [score["hybridScore"] for score in document["scores"]]
+        for document in db.recommendation.find()
+    }
+
+
+def test_frugal_plan_ranks_like_the_default(db, fresh_db):
+    pipeline.run_pipeline(top_n=12, cf_weight=0.6, cb_weight=0.4, db=db)
+    expected = _scores(db)
+
+    frugal_db = fresh_db()
+    # a budget just above what the process already holds leaves room for nothing but the most frugal plan
+    summary = pipeline.run_pipeline(
+        top_n=12,
+        cf_weight=0.6,
+        cb_weight=0.4,
+        db=frugal_db,
+        memory_budget=current_rss_bytes() / 2**20 + 1
+    )
+    assert summary["plan"]["dtype"] == "float32"
+    assert summary["plan"]["contentProfiles"] == "streamed"
+    actual = _scores(frugal_db)
+    assert actual.keys() == expected.keys()
+    for user_id, scores in expected.items():
+        assert np.allclose(actual[user_id], scores, atol=1e-5, equal_nan=True)
@@ -0,0 +1,81 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import benchmark
+import pipeline
+import recommendation
+
+
+def test_import_loads_no_numerical_stack():
+    assert benchmark.measure_import_time(1)["heavyModules"] == []
+
+
+@pytest.mark.parametrize("setting, scheduled", [("true", True), ("false", False)])
+def test_importing_the_app_schedules_the_warm_up(setting, scheduled):
+    # the thread is recorded, not started, so the probe needs no database
+    script = (
+        "import threading; started = []; threading.Thread.start = lambda thread: started.append(thread.name); "
+        "import recommendation; print('recommendation-warmup' in started)"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env={**os.environ, "RECOMMENDATION_WARMUP": setting},
+        capture_output=True,
+        text=True,
+        check=True
+    ).stdout
+    assert output.strip().splitlines()[-1] == str(scheduled)
+
+
+@pytest.fixture
+def client(db, monkeypatch):
+    monkeypatch.setattr(recommendation, "get_database", lambda: db)
+    pipeline.run_pipeline(top_n=12, cf_weight=0.6, cb_weight=0.4, db=db)
+    return recommendation.app.test_client()
+
+
+def test_user_aliases_share_one_cache_entry(client, db):
+    primary_id = str(db.user.find_one({"firebaseId": "firebase-3"})["_id"])
+
+    by_alias = client.get("/api/recommendations/firebase-3").get_json()
+    by_primary_id = client.get(f"/api/recommendations/{primary_id}").get_json()
+    assert (by_alias["cached"], by_primary_id["cached"]) == (False, True)
+    assert by_alias["userId"] == primary_id
+    assert by_alias["items"] == by_primary_id["items"]
+
+    assert client.delete("/api/recommendations/firebase-3/cache").status_code == 200
+    assert client.get(f"/api/recommendations/{primary_id}").get_json()["cached"] is False
+
+
+def test_online_scores_match_the_batch_build(client, db):
+    for document in db.recommendation.find():
+        response = client.get(f"/api/recommendations/{document['userId']}").get_json()
+        stored = [
+            {**score, "productId": str(score["productId"])}
+            for score in document["scores"]
+        ]
+        assert response["items"] == stored
+
+    # other weights rescore on demand: the blend follows them and the list stays ranked by it
+    primary_id = str(db.user.find_one({"firebaseId": "firebase-3"})["_id"])
+    items = client.get(f"/api/recommendations/{primary_id}?top_n=5&cf_weight=0.1&cb_weight=0.9").get_json()["items"]
+    assert len(items) == 5
+    for item in items:
+        assert item["hybridScore"] == pytest.approx(0.1 * item["cfScore"] + 0.9 * item["cbScore"], abs=2e-6)
+    assert [item["hybridScore"] for item in items] == sorted((item["hybridScore"] for item in items), reverse=True)
+
+
+@pytest.mark.parametrize("path", [
+    "/api/recommendations/firebase-3?top_n=0",
+    "/api/recommendations/firebase-3/hydrated?top_n=-1",
+    "/api/recommendations/popular?top_n=0",
+    "/api/search?q=book&top_n=0",
+])
+def test_top_n_below_one_is_rejected(client, path):
+    response = client.get(path)
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "top_n must be a positive integer"
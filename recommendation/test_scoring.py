@@ -0,0 +1,416 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.preprocessing import minmax_scale, normalize
+
+import scoring
+from planner import ExecutionPlan
+from scoring import (
+    ConsumedIndex,
+    HashingTfidf,
+    ScoreMatrix,
+    TrendingIndex,
+    build_interaction_frame,
+    build_user_item_matrix,
+    compute_collaborative_scores,
+    compute_content_scores,
+    fold_in_collaborative_scores,
+    normalize_rows,
+    prepare_books_dataframe,
+    rank_recommendations,
+    top_positive,
+    warm_start_factors,
+)
+from store import UserRegistry, read_interaction_columns, read_order_columns, read_review_columns
+
+
+def _normalize_rows_loop(df):
+    # the per-row implementation normalize_rows replaced
+    normalized = df.copy()
+    for idx in normalized.index:
+        values = normalized.loc[idx].to_numpy(dtype=float)
+        if np.allclose(values.max(), values.min()):
+            normalized.loc[idx] = 0.0
+        else:
+            normalized.loc[idx] = minmax_scale(values, feature_range=(0, 1))
+    return normalized
+
+
+def _mask_loop(df, interaction_df):
+    masked = df.copy()
+    for user_id in masked.index:
+        consumed = interaction_df[interaction_df["userId"] == user_id]["productId"].tolist()
+        if consumed:
+            masked.loc[user_id, consumed] = 0.0
+    return masked
+
+
+def _scores(rng, n_users, n_books):
+    return pd.DataFrame(
+        rng.normal(size=(n_users, n_books)),
+        index=[f"u{user}" for user in range(n_users)],
+        columns=[f"b{book}" for book in range(n_books)]
+    )
+
+
+@pytest.mark.parametrize("n_users, n_books", [(1, 1), (7, 1), (1, 9), (25, 40)])
+def test_normalize_rows_matches_the_per_row_loop(n_users, n_books):
+    rng = np.random.default_rng(n_users * 100 + n_books)
+    df = _scores(rng, n_users, n_books)
+    df.iloc[::3] = 2.5
+    df.iloc[1::5] = 0.0
+
+    normalized = normalize_rows(df)
+
+    assert normalized.index.equals(df.index) and normalized.columns.equals(df.columns)
+    assert np.allclose(normalized.to_numpy(), _normalize_rows_loop(df).to_numpy())
+
+
+def test_normalize_rows_passes_empty_frames_through():
+    assert normalize_rows(None) is None
+    assert normalize_rows(pd.DataFrame()).empty
+
+
+@pytest.mark.parametrize("n_books", [1, 12])
+def test_consumed_mask_matches_the_per_user_loop(n_books):
+    rng = np.random.default_rng(n_books)
+    df = _scores(rng, 10, n_books)
+    book_ids = list(df.columns)
+    pairs = [(user_id, book_id) for user_id in df.index[:6] for book_id in book_ids if rng.random() < 0.3]
+    # u6 consumed everything, u7 to u9 nothing, and "gone" has interactions but no scores
+    pairs += [("u6", book_id) for book_id in book_ids] + [("gone", book_ids[-1])]
+    interaction_df = pd.DataFrame(pairs, columns=["userId", "productId"]).assign(weight=1.0)
+
+    index = ConsumedIndex.from_interactions(interaction_df, book_ids)
+    masked = index.mask(df.to_numpy(copy=True), list(df.index))
+
+    assert np.allclose(masked, _mask_loop(df, interaction_df).to_numpy())
+    assert not masked[list(df.index).index("u6")].any()
+
+
+def _content_scores_loop(book_matrix, book_ids, interaction_df):
+    # the per-user profile loop the sparse engine replaced
+    positions = {book_id: position for position, book_id in enumerate(book_ids)}
+    scores = {}
+    for user_id, group in interaction_df.groupby("userId"):
+        weights = np.zeros(len(book_ids))
+        for book_id, weight in zip(group["productId"], group["weight"]):
+            if book_id in positions:
+                weights[positions[book_id]] += weight
+        profile = book_matrix.T @ weights
+        if np.linalg.norm(profile) > 0:
+            scores[user_id] = book_matrix @ (profile / np.linalg.norm(profile))
+    scores = _normalize_rows_loop(pd.DataFrame.from_dict(scores, orient="index", columns=book_ids))
+    return _mask_loop(scores, interaction_df)
+
+
+@pytest.mark.parametrize("plan", [
+    ExecutionPlan(),
+    ExecutionPlan(chunk_size=3, stream_profiles=True, dense_profiles=False),
+    ExecutionPlan(chunk_size=4, dense_profiles=True),
+])
+def test_content_scores_match_the_per_user_loop(plan):
+    rng = np.random.default_rng(3)
+    book_ids = [f"b{book}" for book in range(30)]
+    # the last book has no features
+    book_matrix = normalize(sparse.vstack([
+        sparse.random(29, 50, density=0.1, random_state=3),
+        sparse.csr_matrix((1, 50)),
+    ]).tocsr())
+    pairs = {(f"u{user}", book_ids[book]) for user, book in zip(rng.integers(0, 12, 60), rng.integers(0, 30, 60))}
+    # u98 only touched a book outside the catalog, u99 one without any features
+    pairs |= {("u98", "gone"), ("u99", book_ids[-1])}
+    interaction_df = pd.DataFrame(sorted(pairs), columns=["userId", "productId"]).assign(
+        weight=rng.uniform(0.1, 1.0, len(pairs))
+    )
+
+    cb_scores, _ = compute_content_scores(
+        pd.DataFrame({"bookId": book_ids}),
+        interaction_df,
+        book_matrix=book_matrix,
+        book_ids=book_ids,
+        plan=plan
+    )
+    expected = _content_scores_loop(book_matrix.toarray(), book_ids, interaction_df)
+
+    assert sorted(cb_scores.index) == sorted(expected.index)
+    assert "u98" not in cb_scores.index and "u99" not in cb_scores.index
+    actual = cb_scores.block(cb_scores.positions(list(expected.index)))
+    assert np.allclose(actual, expected.to_numpy())
+
+
+def _score_matrix(values):
+    return ScoreMatrix(list(values.index), list(values.columns), lambda rows: values.to_numpy()[rows].copy())
+
+
+def _ranked_by_full_sort(values, top_n):
+    order = sorted(range(len(values)), key=lambda idx: (-values[idx], idx))
+    return [idx for idx in order if values[idx] > 0][:top_n]
+
+
+@pytest.mark.parametrize("top_n, chunk_size", [(5, 4), (40, 3)])
+def test_top_k_ranking_matches_a_full_sort(top_n, chunk_size):
+    rng = np.random.default_rng(top_n)
+    # u9 has no collaborative scores, u10 and u11 no content scores and u12 neither
+    cf = _scores(rng, 12, 30).clip(lower=0).drop(index=["u9"])
+    cb = _scores(rng, 12, 30).clip(lower=0).drop(index=["u10", "u11"])
+    # u0's only positive score is on a book it already consumed
+    cf.loc["u0"] = cb.loc["u0"] = 0.0
+    cf.loc["u0", "b3"] = cb.loc["u0", "b3"] = 1.0
+    consumed = {"u0": ["b3"], "u1": ["b0", "b7"], "u2": ["b29"]}
+    interaction_df = pd.DataFrame(
+        [(user_id, book_id) for user_id, books in consumed.items() for book_id in books],
+        columns=["userId", "productId"]
+    ).assign(weight=1.0)
+    consumed_index = ConsumedIndex.from_interactions(interaction_df, list(cf.columns))
+    users = [f"u{user}" for user in range(13)]
+
+    ranked = {
+        user_id: (method, reason, [book for book, *_ in rows])
+        for user_id, method, reason, rows in rank_recommendations(
+            users,
+            list(cf.columns),
+            _score_matrix(cf),
+            _score_matrix(cb),
+            consumed_index,
+            top_n,
+            0.6,
+            0.4,
+            chunk_size=chunk_size
+        )
+    }
+
+    assert ranked.keys() == set(users)
+    assert ranked["u0"] == ("popularity", "NoPositiveHybridScores", [])
+    assert ranked["u12"] == ("popularity", "InsufficientSignals", [])
+    for user_id in users[1:12]:
+        if user_id in cf.index and user_id in cb.index:
+            method, values = "hybrid", 0.6 * cf.loc[user_id] + 0.4 * cb.loc[user_id]
+            values[consumed.get(user_id, [])] = 0.0
+        elif user_id in cf.index:
+            method, values = "collaborative", cf.loc[user_id]
+        else:
+            method, values = "content_based", cb.loc[user_id]
+        expected = [cf.columns[idx] for idx in _ranked_by_full_sort(values.to_numpy(), top_n)]
+        assert ranked[user_id] == (method, None, expected)
+
+
+@pytest.mark.parametrize("top_n", [0, -3])
+def test_top_k_ranking_of_nothing_is_empty(top_n):
+    positions, values = top_positive(np.random.default_rng(2).uniform(size=(4, 3)), top_n)
+    assert positions.shape == values.shape == (4, 0)
+
+
+def test_interaction_frame_sums_every_source_per_user_and_book():
+    registry = UserRegistry([
+        {"_id": "65a000000000000000000001", "role": "user", "firebaseId": "fb-1", "email": "One@Example.com"},
+        {"_id": "65a000000000000000000002", "role": "user"},
+        {"_id": "65a000000000000000000003", "role": "admin", "email": "admin@example.com"},
+    ])
+    one, two = "65a000000000000000000001", "65a000000000000000000002"
+    interactions = read_interaction_columns([
+        {"userId": one, "bookId": "b1", "interactionType": "view"},
+        {"userId": one, "bookId": "b1", "interactionType": "wishlist"},
+        {"userId": two, "bookId": "b2", "interactionType": "rating"},
+    ])
+    reviews = read_review_columns([
+        {"userId": one, "productId": "b2", "rating": 5},
+        {"userId": two, "productId": "b2", "rating": None},
+    ])
+    orders = read_order_columns([
+        # matched by firebaseId, by email (case-insensitively), and not at all for a non-customer
+        {"firebaseId": "fb-1", "products": [{"productId": "b1", "quantity": 2, "price": 3}]},
+        {"email": "one@example.com", "products": [{"productId": "b3", "price": 11}]},
+        {"email": "admin@example.com", "products": [{"productId": "b3", "price": 50}]},
+    ])
+
+    raw, normalized = build_interaction_frame(interactions, reviews, orders, registry)
+
+    expected = {(one, "b1"): 1.0 + 2.0 + 6.0, (one, "b2"): 5.0, (one, "b3"): 11.0, (two, "b2"): 4.0}
+    assert dict(zip(zip(raw["userId"], raw["productId"]), raw["raw_value"])) == expected
+    assert list(zip(raw["userId"], raw["productId"])) == sorted(expected)
+    # summed values are spread over 1..5 between the smallest and the largest
+    strengths = dict(zip(zip(normalized["userId"], normalized["productId"]), normalized["interaction_strength"]))
+    assert strengths == pytest.approx({key: 1.0 + 4.0 * (value - 4.0) / 7.0 for key, value in expected.items()})
+
+
+
+def test_book_text_keeps_only_the_newest_reviews(monkeypatch):
+    monkeypatch.setattr(scoring, "REVIEW_TEXT_LIMIT", 2)
+    day = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    # the cursor hands reviews back out of date order
+    reviews = read_review_columns([
+        {"productId": "b1", "content": "newest", "createdAt": day + timedelta(days=3)},
+        {"productId": "b1", "content": "undated"},
+        {"productId": "b1", "content": "oldest", "createdAt": day},
+        {"productId": "b1", "content": "middle", "createdAt": day + timedelta(days=1)},
+    ])
+
+    books_df = prepare_books_dataframe([{"_id": "b1", "title": "title"}], [], [], reviews)
+
+    assert books_df.loc[0, "text"] == "title middle newest"
+
+TEXTS = [
+    "dragon empire fire queen",
+    "space ship robot future",
+    "the dragon and the robot",
+    "murder detective city night",
+    "space dragon",
+    "secret letter island",
+    "dragon empire fire queen",
+]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_hashed_features_match_a_single_pass_over_every_text(workers, monkeypatch):
+    monkeypatch.setattr(scoring, "FEATURE_CHUNK_SIZE", 2)
+    monkeypatch.setattr(scoring, "FEATURE_WORKERS", workers)
+    monkeypatch.setattr(scoring, "TEXT_FEATURE_CACHE", OrderedDict())
+    vectorizer = HashingTfidf(n_features=2**10)
+    hasher = HashingVectorizer(
+        n_features=2**10,
+        ngram_range=(1, 2),
+        stop_words="english",
+        alternate_sign=False,
+        norm=None
+    )
+    expected = TfidfTransformer().fit_transform(hasher.transform(TEXTS))
+
+    features = vectorizer.fit_transform(TEXTS)
+    assert abs(features - expected).max() < 1e-12
+    # later transforms reuse the cached counts and the fitted idf
+    assert len(scoring.TEXT_FEATURE_CACHE) == len(set(TEXTS))
+    restored = HashingTfidf(n_features=2**10, idf=vectorizer.idf_)
+    assert abs(restored.transform(TEXTS[2:4]) - expected[2:4]).max() < 1e-12
+
+
+def _training_interactions(seed=0, n_users=40, n_books=25):
+    rng = np.random.default_rng(seed)
+    drawn = zip(rng.integers(0, n_users, 300), rng.integers(0, n_books, 300))
+    pairs = {(f"u{user}", f"b{book}") for user, book in drawn}
+    interaction_df = pd.DataFrame(sorted(pairs), columns=["userId", "productId"])
+    return interaction_df.assign(weight=rng.uniform(1.0, 5.0, len(pairs))), [f"b{book}" for book in range(n_books)]
+
+
+def _als_loss(weights, user_factors_df, item_factors_df):
+    # the implicit-feedback objective the ALS steps descend
+    preference = (weights > 0).astype(float)
+    confidence = 1.0 + scoring.ALS_ALPHA * weights
+    users, items = user_factors_df.to_numpy(), item_factors_df.to_numpy()
+    fit = (confidence * (preference - users @ items.T) ** 2).sum()
+    return fit + scoring.ALS_REGULARIZATION * ((users ** 2).sum() + (items ** 2).sum())
+
+
+def test_warm_started_svd_recovers_the_cold_fit():
+    interaction_df, book_ids = _training_interactions()
+    _, _, cold_users, cold_items = compute_collaborative_scores(
+        interaction_df, book_ids, algorithm="svd", n_components=5
+    )
+    _, _, warm_users, warm_items = compute_collaborative_scores(
+        interaction_df, book_ids, algorithm="svd", n_components=5, warm_start=cold_items
+    )
+
+    cold = cold_users.to_numpy() @ cold_items.to_numpy().T
+    warm = warm_users.to_numpy() @ warm_items.to_numpy().T
+    assert np.abs(warm - cold).max() < 1e-2 * np.abs(cold).max()
+
+
+def test_warm_started_als_keeps_descending_from_the_previous_fit():
+    interaction_df, book_ids = _training_interactions()
+    weights = build_user_item_matrix(interaction_df, book_ids).matrix.toarray()
+    _, _, cold_users, cold_items = compute_collaborative_scores(
+        interaction_df, book_ids, algorithm="als", n_components=5
+    )
+    _, _, warm_users, warm_items = compute_collaborative_scores(
+        interaction_df, book_ids, algorithm="als", n_components=5, warm_start=cold_items
+    )
+
+    assert _als_loss(weights, warm_users, warm_items) <= _als_loss(weights, cold_users, cold_items)
+
+
+def test_svd_fold_in_scores_users_like_the_fit():
+    interaction_df, book_ids = _training_interactions()
+    cf_scores, _, _, item_factors_df = compute_collaborative_scores(
+        interaction_df, book_ids, algorithm="svd", n_components=5
+    )
+    folded = fold_in_collaborative_scores(interaction_df, item_factors_df, algorithm="svd")
+
+    users = list(cf_scores.index)
+    assert np.allclose(folded.block(folded.positions(users)), cf_scores.block(cf_scores.positions(users)))
+
+
+def test_warm_start_gives_way_to_a_periodic_cold_refit(monkeypatch):
+    monkeypatch.setattr(scoring, "CF_ALGORITHM", "svd")
+    monkeypatch.setattr(scoring, "CF_COLD_REFIT_EVERY", 3)
+    factors = pd.DataFrame(np.ones((2, 2)), index=["b0", "b1"])
+
+    def state(generation, algorithm="svd"):
+        return {"item_factors_df": factors, "cf_model": {"algorithm": algorithm, "generation": generation}}
+
+    assert warm_start_factors(state(1)) is factors
+    assert warm_start_factors(state(2)) is None
+    assert warm_start_factors(state(0, algorithm="als")) is None
+    assert warm_start_factors(None) is None
+
+
+def test_sparse_user_item_matrix_matches_pivot_table():
+    interaction_df = pd.DataFrame(
+        [("u2", "b1", 1.0), ("u1", "b3", 2.0), ("u2", "b1", 0.5), ("u3", "b0", 4.0), ("u1", "gone", 9.0)],
+        columns=["userId", "productId", "weight"]
+    )
+    pivot = interaction_df.pivot_table(
+        index="userId", columns="productId", values="weight", aggfunc="sum", fill_value=0.0
+    )
+
+    matrix = build_user_item_matrix(interaction_df)
+    assert matrix.user_ids == list(pivot.index) and list(matrix.book_ids) == list(pivot.columns)
+    assert np.array_equal(matrix.matrix.toarray(), pivot.to_numpy())
+
+    # against a fixed catalog, books outside it are dropped and the catalog order is kept
+    catalog = ["b3", "b2", "b1", "b0"]
+    matrix = build_user_item_matrix(interaction_df, catalog)
+    expected = pivot.reindex(columns=catalog, fill_value=0.0)
+    assert list(matrix.book_ids) == catalog
+    assert np.array_equal(matrix.matrix.toarray(), expected.to_numpy())
+
+
+def test_trending_decays_events_by_age_and_fallback_skips_consumed_books():
+    books_df = pd.DataFrame({
+        "bookId": ["b0", "b1", "b2", "b3", "b4"],
+        "genreId": ["g0", "g0", "g1", "g1", "g0"],
+        "authorId": ["a0", "a1", "a0", "a1", "a0"],
+        "soldQuantity": [0, 0, 0, 0, 50],
+        "reviewsCount": [0, 0, 0, 0, 0],
+        "averageRating": [0.0, 0.0, 0.0, 0.0, 0.0],
+    })
+    now = datetime(2026, 1, 15, tzinfo=timezone.utc)
+    half_life = timedelta(days=scoring.TRENDING_HALF_LIFE_DAYS)
+    # same weight per event: b0 one half-life old, b1 fresh, b3 two half-lives old, an unknown book dropped
+    events = [(
+        ["b0", "b1", "b3", "missing"],
+        [4.0, 4.0, 4.0, 4.0],
+        [(now - half_life).timestamp(), now.timestamp(), (now - 2 * half_life).timestamp(), now.timestamp()],
+    )]
+    index = TrendingIndex.build(books_df, ["b4", "b2", "b3", "b1", "b0"], events, now=now)
+
+    assert np.allclose(index.current_scores(now), [2.0, 4.0, 0.0, 1.0, 0.0])
+    assert np.allclose(index.current_scores(now + half_life), [1.0, 2.0, 0.0, 0.5, 0.0])
+    # books without events keep their static popularity order after the trending ones
+    assert [index.book_ids[p] for p in index.ranked("trending")] == ["b1", "b0", "b3", "b4", "b2"]
+    assert [index.book_ids[p] for p in index.ranked("popular")] == ["b4", "b2", "b3", "b1", "b0"]
+    assert [index.book_ids[p] for p in index.ranked("trending", ("genre", "g1"))] == ["b3", "b2"]
+
+    # a later event moves the ranking on, decaying what was there before
+    assert index.add(["b3", "missing"], [4.0, 4.0], [(now + half_life).timestamp()] * 2, now=now + half_life) == 1
+    assert np.allclose(index.current_scores(now + half_life), [1.0, 2.0, 0.0, 4.5, 0.0])
+    assert [index.book_ids[p] for p in index.ranked("trending", limit=2)] == ["b3", "b1"]
+
+    # the genre read most goes first, topped up with trending overall, and consumed books are never offered
+    assert index.fallback([2, 3], 3) == ["b1", "b0", "b4"]
+    assert index.fallback([1], 2) == ["b0", "b4"]
+    assert index.fallback([], 2) == ["b3", "b1"]
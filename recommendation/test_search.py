@@ -0,0 +1,100 @@
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from search import SEARCH_BM25_B, SEARCH_BM25_K1, SEARCH_TITLE_BOOST, SearchIndex, build_search_vectorizer
+
+WORDS = ["river", "stone", "garden", "night", "winter", "glass", "harbor", "letters", "silent", "ember"]
+
+
+def _books(seed, n_books=30, prefix="b"):
+    rng = np.random.default_rng(seed)
+    titles = [" ".join(rng.choice(WORDS, size=2)) for _ in range(n_books)]
+    return pd.DataFrame({
+        "bookId": [f"{prefix}{book}" for book in range(n_books)],
+        "title": titles,
+        "text": [f"{title} " + " ".join(rng.choice(WORDS, size=rng.integers(3, 12))) for title in titles],
+    })
+
+
+def _bm25_by_brute_force(books_df, query):
+    # the textbook formula over per-book term counts, title terms boosted
+    analyze = build_search_vectorizer().build_analyzer()
+    counts = []
+    for text, title in zip(books_df["text"], books_df["title"]):
+        count = Counter(analyze(text))
+        for term in analyze(title):
+            count[term] += SEARCH_TITLE_BOOST
+        counts.append(count)
+    average_length = np.mean([sum(count.values()) for count in counts])
+    scores = {}
+    for book_id, count in zip(books_df["bookId"], counts):
+        norm = SEARCH_BM25_K1 * (1.0 - SEARCH_BM25_B + SEARCH_BM25_B * sum(count.values()) / average_length)
+        score = 0.0
+        for term in dict.fromkeys(analyze(query)):
+            frequency = sum(1 for other in counts if other[term])
+            if count[term]:
+                idf = np.log1p((len(counts) - frequency + 0.5) / (frequency + 0.5))
+                score += idf * count[term] * (SEARCH_BM25_K1 + 1.0) / (count[term] + norm)
+        if score > 0:
+            scores[book_id] = score
+    return scores
+
+
+def _assert_ranked_like(hits, expected, limit):
+    ranked = sorted(expected.items(), key=lambda item: -item[1])[:limit]
+    assert len(hits) == len(ranked)
+    for (book_id, score), (_, expected_score) in zip(hits, ranked):
+        assert score == pytest.approx(expected[book_id], rel=1e-5)
+        assert score == pytest.approx(expected_score, rel=1e-5)
+
+
+@pytest.mark.parametrize("query", ["river", "Silent Émber", "glass harbor winter"])
+def test_bm25_scores_match_the_textbook_formula(query):
+    books_df = _books(3)
+    index = SearchIndex.build(books_df)
+
+    hits, matched = index.search(query, 10, prefix=False)
+
+    expected = _bm25_by_brute_force(books_df, query)
+    assert matched == len(expected)
+    _assert_ranked_like(hits, expected, 10)
+
+
+def test_prefix_matches_the_best_completion_per_book():
+    books_df = pd.DataFrame({
+        "bookId": ["b0", "b1", "b2"],
+        "title": ["", "", ""],
+        "text": ["river stone", "riverside garden", "garden night"],
+    })
+    index = SearchIndex.build(books_df)
+
+    hits, matched = index.search("riv", 10)
+    assert matched == 2 and {book_id for book_id, _ in hits} == {"b0", "b1"}
+    assert index.search("riv", 10, prefix=False) == ([], 0)
+
+
+@pytest.mark.parametrize("extra_books", [1, 12])
+def test_refreshed_index_scores_like_a_full_rebuild(extra_books):
+    books_df = _books(7)
+    index = SearchIndex.build(books_df)
+    # one book rewritten, one removed, some added: a small change stays in a delta, a big one merges
+    rewritten = books_df.iloc[[4]].assign(text=lambda df: df["title"] + " ember ember harbor")
+    changed_df = pd.concat([rewritten, _books(8, extra_books, "n")])
+    current_df = pd.concat([books_df.drop(index=[4, 9]), changed_df])
+
+    refreshed = index.refresh(current_df["bookId"], changed_df)
+
+    assert len(refreshed) == len(current_df)
+    assert len(refreshed.segments) == (2 if extra_books == 1 else 1)
+    # a delta still counts masked rows in document frequencies, so it matches the same books; merged, it scores exactly
+    compacted = SearchIndex([refreshed.compacted()])
+    for query in ("ember harbor", "stone", "night letters"):
+        expected = _bm25_by_brute_force(current_df, query)
+        hits, matched = refreshed.search(query, 50, prefix=False)
+        assert matched == len(expected) and {book_id for book_id, _ in hits} == set(expected)
+        hits, matched = compacted.search(query, 50, prefix=False)
+        assert matched == len(expected)
+        assert dict(hits) == pytest.approx(expected, rel=1e-5)
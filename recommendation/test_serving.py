@@ -0,0 +1,59 @@
+import pipeline
+from artifacts import get_model_state
+from caches import CACHE_VERSION
+from serving import load_serving_entry
+from store import save_serving_version
+
+
+def _rewrite_elsewhere(db, document):
+    # another service process rewrites the document; this process's cache never hears of it
+    reordered = list(reversed(document["recommendedProductIds"]))
+    db.recommendation.update_one(
+        {"userId": {"$in": [document["userId"]]}},
+        {"$set": {"recommendedProductIds": reordered, "metadata": {**document["metadata"], "contentHash": "rewritten"}}}
+    )
+    return reordered
+
+
+def test_cache_hits_are_checked_against_the_stored_document(db):
+    pipeline.run_pipeline(top_n=12, cf_weight=0.6, cb_weight=0.4, db=db)
+    state = get_model_state(db)
+    document = next(db.recommendation.find({"recommendationMethod": "hybrid"}))
+    user_id = str(document["userId"])
+
+    entry, cached = load_serving_entry(db, state, user_id)
+    assert not cached and len(entry[0]) == len(document["recommendedProductIds"])
+    assert load_serving_entry(db, state, user_id)[1]
+
+    reordered = _rewrite_elsewhere(db, document)
+    stale, cached = load_serving_entry(db, state, user_id, verify=False)
+    assert cached and list(stale[0]) == list(entry[0])
+
+    fresh, cached = load_serving_entry(db, state, user_id, verify=True)
+    assert not cached
+    assert list(fresh[0]) == list(state["book_index"].get_indexer([str(ref) for ref in reordered]))
+    assert load_serving_entry(db, state, user_id)[1]
+
+
+def test_a_version_bump_elsewhere_clears_the_cache_at_the_next_check(db, monkeypatch):
+    pipeline.run_pipeline(top_n=12, cf_weight=0.6, cb_weight=0.4, db=db)
+    state = get_model_state(db)
+    document = next(db.recommendation.find({"recommendationMethod": "hybrid"}))
+    user_id = str(document["userId"])
+    entry, _ = load_serving_entry(db, state, user_id)
+
+    # cache hits inside the interval cost no round trip, not even for the version marker
+    round_trips = db.round_trips
+    assert load_serving_entry(db, state, user_id)[1]
+    assert db.round_trips == round_trips
+
+    reordered = _rewrite_elsewhere(db, document)
+    save_serving_version(db)
+    stale, cached = load_serving_entry(db, state, user_id)
+    assert cached and list(stale[0]) == list(entry[0])
+
+    monkeypatch.setattr(CACHE_VERSION, "interval", 0)
+    fresh, cached = load_serving_entry(db, state, user_id)
+    assert not cached
+    assert list(fresh[0]) == list(state["book_index"].get_indexer([str(ref) for ref in reordered]))
+    assert load_serving_entry(db, state, user_id)[1]
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+from similarity import SimilarityIndex
+
+
+def _catalog(seed, n_books=25):
+    rng = np.random.default_rng(seed)
+    book_ids = [f"b{book}" for book in range(n_books)]
+    book_matrix = normalize(sparse.random(n_books, 40, density=0.15, random_state=seed, format="csr"))
+    item_features = rng.normal(size=(n_books, 6))
+    return book_ids, book_matrix, item_features
+
+
+def _neighbors_by_brute_force(features, k):
+    unit = normalize(features)
+    cosines = unit @ unit.T
+    neighbors = []
+    for row, scores in enumerate(cosines):
+        others = [column for column in range(len(scores)) if column != row]
+        order = sorted(others, key=lambda column: (-scores[column], column))
+        neighbors.append([column for column in order if scores[column] > 1e-9][:k])
+    return neighbors
+
+
+@pytest.mark.parametrize("chunk_size", [3, 512])
+def test_neighbour_lists_match_a_brute_force_cosine_ranking(chunk_size):
+    book_ids, book_matrix, item_features = _catalog(5)
+
+    index = SimilarityIndex.build(book_ids, book_matrix, item_features, k=4, chunk_size=chunk_size)
+
+    for kind, features in (("content", book_matrix.toarray()), ("collaborative", item_features)):
+        expected = _neighbors_by_brute_force(features, 4)
+        for position in range(len(book_ids)):
+            candidates, scores = index.candidates(position, kind)
+            assert candidates.tolist() == expected[position]
+            assert np.all(np.diff(scores) <= 0)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 512])
+def test_refresh_matches_a_full_rebuild(chunk_size):
+    book_ids, book_matrix, item_features = _catalog(8)
+    index = SimilarityIndex.build(book_ids, book_matrix, item_features, k=4)
+    # the catalog comes back in another order: b3 is edited into a near copy of b0, b7 is gone and b25 is new
+    rng = np.random.default_rng(8)
+    new_ids = [book_ids[position] for position in rng.permutation(len(book_ids)) if position != 7] + ["b25"]
+    rows = {
+        book_id: (book_matrix[position].toarray(), item_features[position])
+        for position, book_id in enumerate(book_ids)
+    }
+    rows["b3"] = (rows["b0"][0] + 0.05 * rng.random((1, 40)), rows["b0"][1] + 0.05 * rng.normal(size=6))
+    rows["b25"] = (sparse.random(1, 40, density=0.3, random_state=1).toarray(), rng.normal(size=6))
+    new_matrix = normalize(sparse.csr_matrix(np.vstack([rows[book_id][0] for book_id in new_ids])))
+    new_features = np.vstack([rows[book_id][1] for book_id in new_ids])
+
+    refreshed = index.refresh(new_ids, new_matrix, new_features, ["b3", "b25"], k=4, chunk_size=chunk_size)
+    rebuilt = SimilarityIndex.build(new_ids, new_matrix, new_features, k=4)
+
+    for kind in SimilarityIndex.KINDS:
+        for position in range(len(new_ids)):
+            candidates, scores = refreshed.candidates(position, kind)
+            expected, expected_scores = rebuilt.candidates(position, kind)
+            assert candidates.tolist() == expected.tolist()
+            assert np.allclose(scores, expected_scores, atol=1e-6)
+        # the edit moved b3 into the list of the book it now resembles
+        assert new_ids.index("b3") in refreshed.candidates(new_ids.index("b0"), kind)[0]
@@ -0,0 +1,128 @@
+from datetime import datetime, timezone
+
+import numpy as np
+from bson import ObjectId
+
+import benchmark
+from store import (
+    UserRegistry,
+    fetch_user_history,
+    read_interaction_columns,
+    read_order_columns,
+    read_review_columns,
+    stream_collection,
+)
+
+
+def _at(day):
+    return datetime(2025, 3, day, tzinfo=timezone.utc)
+
+
+def test_interaction_columns_keep_only_weighted_signals():
+    user = ObjectId()
+    documents = iter([
+        {"userId": user, "bookId": "b1", "interactionType": "view", "createdAt": _at(1)},
+        {"userId": user, "bookId": "b2", "interactionType": "order", "quantity": 2, "price": 3.5},
+        {"userId": user, "bookId": "b3", "interactionType": "share"},
+        {"userId": None, "bookId": "b4", "interactionType": "wishlist"},
+        {"userId": str(user), "interactionType": "wishlist"},
+    ])
+
+    columns = read_interaction_columns(documents)
+
+    assert columns["userId"] == [str(user), str(user)]
+    assert columns["productId"] == ["b1", "b2"]
+    assert columns["weight"].tolist() == [1.0, 7.0]
+    assert columns["timestamp"][0] == _at(1).timestamp() and np.isnan(columns["timestamp"][1])
+
+
+def test_order_lines_point_back_at_their_completed_order():
+    documents = iter([
+        {"userId": "u1", "products": [{"productId": "b1", "price": 2}, {"productId": "b2", "price": 0}]},
+        {"userId": "u2", "completed": False, "products": [{"productId": "b3", "price": 4}]},
+        {"email": "u3@example.com", "products": [{"price": 9}, {"productId": "b4", "quantity": 3, "price": 1}]},
+        {"userId": "u4", "products": []},
+    ])
+
+    columns = read_order_columns(documents)
+
+    assert [order["userId"] or order["email"] for order in columns["orders"]] == ["u1", "u3@example.com"]
+    assert columns["orderIndex"].tolist() == [0, 1]
+    assert columns["productId"] == ["b1", "b4"]
+    assert columns["weight"].tolist() == [2.0, 3.0]
+
+
+def test_streamed_collections_advance_the_watermark():
+    db = benchmark.FakeDatabase()
+    ids = [ObjectId() for _ in range(3)]
+    db.add_collection("genre", [
+        {"_id": ids[0], "name": "a", "updatedAt": _at(4)},
+        {"_id": ids[1], "name": "b", "createdAt": _at(9)},
+        {"_id": ids[2], "name": "c"},
+    ])
+    watermark = {}
+
+    names = [genre["name"] for genre in stream_collection(db, "genre", watermark=watermark)]
+
+    assert names == ["a", "b", "c"]
+    assert watermark == {"genre": {"updatedAt": _at(9), "_id": ids[2]}}
+
+
+def test_user_history_comes_back_in_one_round_trip():
+    alice, bob = ObjectId(), ObjectId()
+    registry = UserRegistry([
+        {"_id": alice, "role": "user", "firebaseId": "fb-alice", "email": "alice@example.com"},
+        {"_id": bob, "role": "user"},
+    ])
+    db = benchmark.FakeDatabase()
+    db.add_collection("interaction", [
+        {"userId": alice, "bookId": "b1", "interactionType": "view"},
+        {"userId": str(bob), "bookId": "b2", "interactionType": "wishlist"},
+    ])
+    db.add_collection("review", [{"userId": str(alice), "productId": "b3", "rating": 4}])
+    db.add_collection("order", [
+        {"firebaseId": "fb-alice", "products": [{"productId": "b4", "price": 2}]},
+        {"email": "alice@example.com", "products": [{"productId": "b5", "price": 3}]},
+        {"customerId": bob, "products": [{"productId": "b6", "price": 4}]},
+    ])
+
+    interactions, reviews, order_columns = fetch_user_history(db, [str(alice)], registry)
+
+    assert db.round_trips == 1
+    assert interactions["productId"] == ["b1"] and interactions["userId"] == [str(alice)]
+    assert reviews["productId"] == read_review_columns(db.review.find())["productId"] == ["b3"]
+    assert order_columns["productId"] == ["b4", "b5"]
+    # the stored documents are not tagged with the collection they came from
+    assert all(set(order) <= {"_id", "firebaseId", "email", "customerId", "products"} for order in db.order.find())
+
+
+def test_user_registry_resolves_every_identifier_to_one_code():
+    alice, bob, carol = ObjectId(), ObjectId(), ObjectId()
+    registry = UserRegistry([
+        {"_id": alice, "role": "user", "firebaseId": "fb-alice", "email": " Alice@Example.com "},
+        {"_id": str(bob), "role": "user"},
+        {"_id": carol, "role": "admin", "firebaseId": "fb-carol"},
+        {"_id": "not-an-object-id", "role": "user"},
+    ])
+
+    assert len(registry) == 2 and registry.primary_ids() == [str(alice), str(bob)]
+    assert registry.resolve("fb-alice") == registry.resolve(str(alice)) == str(alice)
+    assert registry.resolve("fb-carol") == "fb-carol" and "fb-carol" not in registry
+    assert registry.by_email("alice@example.com") == str(alice) and registry.by_email("bob@example.com") is None
+    assert registry.user_ref("fb-alice") == alice and registry.user_ref(str(bob)) == bob
+    assert registry.user_ref("nobody") is None
+
+    # an update copies the registry: existing codes stay put, new users append, the original is untouched
+    dave = ObjectId()
+    updated = registry.updated([
+        {"_id": bob, "role": "user", "firebaseId": "fb-bob", "email": "bob@example.com"},
+        {"_id": dave, "role": "user"},
+    ])
+    assert updated.get("fb-bob").code == registry.get(str(bob)).code == 1
+    assert updated.by_email("bob@example.com") == str(bob) and updated.user_ref(str(dave)) == dave
+    assert "fb-bob" not in registry and len(registry) == 2
+
+    # a subset keeps the refs of the users it was asked for, deduplicated, under fresh codes
+    subset = updated.subset([str(dave), "fb-alice", str(alice), "nobody"])
+    assert subset.primary_ids() == [str(dave), str(alice)]
+    assert subset.user_ref(str(dave)) == dave and subset.user_ref(str(alice)) == alice